@@ -96,6 +96,7 @@ def sync_account_from_stripe_data(data, user=None):
     obj, created = models.Account.objects.get_or_create(
         **kwargs
     )
+    original = utils.snapshot(obj)
     common_attrs = (
         "business_name", "business_url", "charges_enabled", "country",
         "default_currency", "details_submitted", "display_name",
@@ -118,7 +119,7 @@ def sync_account_from_stripe_data(data, user=None):
 
     # that's all we get for standard and express accounts!
     if data["type"] != "custom":
-        obj.save()
+        utils.save_changes(obj, original)
         return obj
 
     # otherwise we continue on to gather a range of details available
@@ -199,7 +200,7 @@ def sync_account_from_stripe_data(data, user=None):
     obj.verification_due_by = utils.convert_tstamp(data["verification"], "due_by")
     obj.verification_fields_needed = data["verification"]["fields_needed"]
 
-    obj.save()
+    utils.save_changes(obj, original)
 
     # sync any external accounts (bank accounts only for now) included
     for external_account in data["external_accounts"]["data"]:
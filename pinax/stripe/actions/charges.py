@@ -1,12 +1,13 @@
 import decimal
 
 from django.conf import settings
-from django.db.models import Q
+from django.db.models import Max, Min, Q
+from django.utils import timezone
 
 import stripe
 from six import string_types
 
-from .. import hooks, models, utils
+from .. import bulk, hooks, models, utils
 
 
 def calculate_refund_amount(charge, amount=None):
@@ -151,11 +152,37 @@ def sync_charges_for_customer(customer):
     """
     Populate database with all the charges for a customer.
 
+    Only the charges created since the newest one already synced are listed,
+    a page at a time, and each page is written with a bulk upsert.
+
     Args:
         customer: a pinax.stripe.models.Customer object
     """
-    for charge in customer.stripe_customer.charges().data:
-        sync_charge_from_stripe_data(charge)
+    params = {
+        "customer": customer.stripe_id,
+        "stripe_account": customer.stripe_account_stripe_id,
+        "limit": 100,
+    }
+    latest = customer.charges.aggregate(latest=Max("charge_created"))["latest"]
+    if latest is not None:
+        # charges created in the same second as the newest one are synced again
+        params["created"] = {"gte": utils.convert_datetime_for_api(latest)}
+    try:
+        listed = stripe.Charge.auto_paging_iter(**params)
+    except AttributeError:
+        listed = iter(stripe.Charge.list(**params).data)
+
+    for page in bulk.chunked(listed, params["limit"]):
+        invoices = {
+            invoice.stripe_id: invoice
+            for invoice in models.Invoice.objects.filter(
+                stripe_id__in=[data["invoice"] for data in page if data["invoice"]]
+            )
+        }
+        bulk.upsert(
+            models.Charge,
+            ((data["id"], charge_defaults(data, customer, invoices.get(data["invoice"]))) for data in page)
+        )
 
 
 def sync_charge(stripe_id, stripe_account=None):
@@ -175,47 +202,81 @@ def sync_charge_from_stripe_data(data):
     Returns:
         a pinax.stripe.models.Charge object
     """
+    obj, _ = models.Charge.objects.get_or_create(stripe_id=data["id"])
+    original = utils.snapshot(obj)
+    defaults = charge_defaults(
+        data,
+        models.Customer.objects.filter(stripe_id=data["customer"]).first(),
+        models.Invoice.objects.filter(stripe_id=data["invoice"]).first()
+    )
+    for name, value in defaults.items():
+        setattr(obj, name, value)
+    utils.save_changes(obj, original)
+    return obj
+
+
+def charge_defaults(data, customer, invoice):
+    """
+    Args:
+        data: the data representing a charge object in the Stripe API
+        customer: the pinax.stripe.models.Customer of the charge, or None
+        invoice: the pinax.stripe.models.Invoice of the charge, or None
+
+    Returns:
+        the values of the fields of a pinax.stripe.models.Charge; fields the
+        data does not tell about are left out
+    """
     source = data.get('source', {})
     source_id = source.get('id') if source is not None else str(data.get('payment_method', ''))
-
-    obj, _ = models.Charge.objects.get_or_create(stripe_id=data["id"])
-    obj.customer = models.Customer.objects.filter(stripe_id=data["customer"]).first()
-    obj.source = source_id
-    obj.currency = data["currency"]
-    obj.invoice = models.Invoice.objects.filter(stripe_id=data["invoice"]).first()
-    obj.amount = utils.convert_amount_for_db(data["amount"], obj.currency)
-    obj.paid = data["paid"]
-    obj.refunded = data["refunded"]
-    obj.captured = data["captured"]
-    obj.disputed = data["dispute"] is not None
-    obj.charge_created = utils.convert_tstamp(data, "created")
+    currency = data["currency"]
+
+    defaults = {
+        "customer": customer,
+        "source": source_id,
+        "currency": currency,
+        "invoice": invoice,
+        "amount": utils.convert_amount_for_db(data["amount"], currency),
+        "paid": data["paid"],
+        "refunded": data["refunded"],
+        "captured": data["captured"],
+        "disputed": data["dispute"] is not None,
+        "charge_created": utils.convert_tstamp(data, "created"),
+        "transfer_group": data.get("transfer_group"),
+        "outcome": data.get("outcome"),
+    }
     if data.get("description"):
-        obj.description = data["description"]
+        defaults["description"] = data["description"]
     if data.get("amount_refunded"):
-        obj.amount_refunded = utils.convert_amount_for_db(data["amount_refunded"], obj.currency)
+        defaults["amount_refunded"] = utils.convert_amount_for_db(data["amount_refunded"], currency)
     if data["refunded"]:
-        obj.amount_refunded = obj.amount
+        defaults["amount_refunded"] = defaults["amount"]
     balance_transaction = data.get("balance_transaction")
     if balance_transaction and not isinstance(balance_transaction, string_types):
-        obj.available = balance_transaction["status"] == "available"
-        obj.available_on = utils.convert_tstamp(
+        defaults["available"] = balance_transaction["status"] == "available"
+        defaults["available_on"] = utils.convert_tstamp(
             balance_transaction, "available_on"
         )
-        obj.fee = utils.convert_amount_for_db(
+        defaults["fee"] = utils.convert_amount_for_db(
             balance_transaction["fee"], balance_transaction["currency"]
         )
-        obj.fee_currency = balance_transaction["currency"]
-    obj.transfer_group = data.get("transfer_group")
-    obj.outcome = data.get("outcome")
-    obj.save()
-    return obj
+        defaults["fee_currency"] = balance_transaction["currency"]
+    return defaults
 
 
-def update_charge_availability():
+def update_charge_availability(from_balance_transactions=False):
     """
     Update `available` and `available_on` attributes of Charges.
 
     We only bother checking those Charges that can become available.
+
+    By default each of these charges is retrieved from Stripe. With
+    `from_balance_transactions` the charge balance transactions that became
+    available are listed instead, once per account and only as far back as
+    the oldest pending charge, and the matching charges are updated in bulk.
+
+    Args:
+        from_balance_transactions: list balance transactions instead of
+                                   retrieving each pending charge
     """
     charges = models.Charge.objects.filter(
         paid=True,
@@ -225,8 +286,62 @@ def update_charge_availability():
     ).select_related(
         "customer"
     )
+    if from_balance_transactions:
+        pending = charges.values(
+            "customer__stripe_account__stripe_id"
+        ).annotate(
+            oldest=Min("charge_created")
+        ).order_by()
+        for row in pending:
+            update_charge_availability_for_account(
+                charges,
+                row["customer__stripe_account__stripe_id"],
+                created=row["oldest"]
+            )
+        return
+
     for c in charges.iterator():
         sync_charge(
             c.stripe_id,
             stripe_account=c.customer.stripe_account
         )
+
+
+def update_charge_availability_for_account(charges, stripe_account, created=None):
+    """
+    Update the pending charges of an account from its available balance transactions
+
+    Args:
+        charges: the queryset of pending pinax.stripe.models.Charge objects
+        stripe_account: the Stripe id of the connected account, or None for
+                        the platform account
+        created: optionally, the datetime.datetime of the oldest pending
+                 charge; older balance transactions are not listed
+    """
+    params = {
+        "available_on": {"lte": utils.convert_datetime_for_api(timezone.now())},
+        "type": "charge",
+        "stripe_account": stripe_account,
+        "limit": 100,
+    }
+    if created is not None:
+        params["created"] = {"gte": utils.convert_datetime_for_api(created)}
+    try:
+        listed = stripe.BalanceTransaction.auto_paging_iter(**params)
+    except AttributeError:
+        listed = iter(stripe.BalanceTransaction.list(**params).data)
+
+    for page in bulk.chunked(listed, params["limit"]):
+        transactions = {bt["source"]: bt for bt in page if bt.get("source")}
+        known = charges.filter(stripe_id__in=list(transactions)).values_list("stripe_id", flat=True)
+        bulk.upsert(models.Charge, (
+            (stripe_id, {
+                "available": transactions[stripe_id]["status"] == "available",
+                "available_on": utils.convert_tstamp(transactions[stripe_id], "available_on"),
+                "fee": utils.convert_amount_for_db(
+                    transactions[stripe_id]["fee"], transactions[stripe_id]["currency"]
+                ),
+                "fee_currency": transactions[stripe_id]["currency"],
+            })
+            for stripe_id in known
+        ))
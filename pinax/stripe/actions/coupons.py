@@ -1,39 +1,52 @@
 import stripe
 
-from .. import models, utils
+from .. import bulk, catalog, models, utils
 
 
 def sync_coupons():
     """
     Synchronizes all coupons from the Stripe API
+
+    Returns:
+        a pinax.stripe.bulk.UpsertSummary
     """
     try:
         coupons = stripe.Coupon.auto_paging_iter()
     except AttributeError:
         coupons = iter(stripe.Coupon.all().data)
 
-    for coupon in coupons:
-        defaults = dict(
-            amount_off=(
-                utils.convert_amount_for_db(coupon["amount_off"], coupon["currency"])
-                if coupon["amount_off"]
-                else None
-            ),
-            currency=coupon["currency"] or "",
-            duration=coupon["duration"],
-            duration_in_months=coupon["duration_in_months"],
-            max_redemptions=coupon["max_redemptions"],
-            metadata=coupon["metadata"],
-            percent_off=coupon["percent_off"],
-            redeem_by=utils.convert_tstamp(coupon["redeem_by"]) if coupon["redeem_by"] else None,
-            times_redeemed=coupon["times_redeemed"],
-            valid=coupon["valid"],
-        )
-        obj, created = models.Coupon.objects.get_or_create(
-            stripe_id=coupon["id"],
-            defaults=defaults
-        )
-        utils.update_with_defaults(obj, defaults, created)
+    summary = bulk.upsert(
+        models.Coupon,
+        ((coupon["id"], coupon_defaults(coupon)) for coupon in coupons)
+    )
+    catalog.invalidate(models.Coupon)
+    return summary
+
+
+def coupon_defaults(coupon):
+    """
+    Args:
+        coupon: the data representing a Coupon object in the Stripe API
+
+    Returns:
+        the values of the fields of a pinax.stripe.models.Coupon
+    """
+    return dict(
+        amount_off=(
+            utils.convert_amount_for_db(coupon["amount_off"], coupon["currency"])
+            if coupon["amount_off"]
+            else None
+        ),
+        currency=coupon["currency"] or "",
+        duration=coupon["duration"],
+        duration_in_months=coupon["duration_in_months"],
+        max_redemptions=coupon["max_redemptions"],
+        metadata=coupon["metadata"],
+        percent_off=coupon["percent_off"],
+        redeem_by=utils.convert_tstamp(coupon["redeem_by"]) if coupon["redeem_by"] else None,
+        times_redeemed=coupon["times_redeemed"],
+        valid=coupon["valid"],
+    )
 
 def sync_coupon_from_stripe_data(stripe_coupon):
 
@@ -48,6 +61,7 @@ def sync_coupon_from_stripe_data(stripe_coupon):
     """
 
     obj, _ = models.Coupon.objects.get_or_create(stripe_id=stripe_coupon["id"])
+    original = utils.snapshot(obj)
 
     currency = stripe_coupon.get("currency") or "usd"
     amount_off = stripe_coupon.get("amount_off") or 0
@@ -64,7 +78,7 @@ def sync_coupon_from_stripe_data(stripe_coupon):
     obj.times_redeemed = stripe_coupon.get("times_redeemed")
     obj.valid = stripe_coupon.get("valid")
 
-    obj.save()
+    utils.save_changes(obj, original)
     return obj
 
 def create(duration, c_id=None, currency="usd", amount_off=None, duration_in_months=None, max_redemptions=None,
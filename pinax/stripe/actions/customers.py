@@ -52,7 +52,8 @@ def _create_without_account(user, card=None, plan=settings.PINAX_STRIPE_DEFAULT_
         }
     )
     if not created:
-        cus.stripe_id = stripe_customer["id"]  # sync_customer will call cus.save()
+        cus.stripe_id = stripe_customer["id"]
+        cus.save()
     sync_customer(cus, stripe_customer)
     if plan and charge_immediately:
         invoices.create_and_pay(cus)
@@ -87,7 +88,8 @@ def _create_with_account(user, stripe_account, card=None, plan=settings.PINAX_ST
     else:
         logger.debug("Update local customer %s with new remote customer %s for user %s, and account %s",
                      cus.stripe_id, stripe_customer["id"], user, stripe_account)
-        cus.stripe_id = stripe_customer["id"]  # sync_customer() will call cus.save()
+        cus.stripe_id = stripe_customer["id"]
+        cus.save()
     sync_customer(cus, stripe_customer)
     if plan and charge_immediately:
         invoices.create_and_pay(cus)
@@ -139,6 +141,7 @@ def get_customer_for_user(user, stripe_account=None):
 
 
 def purge_local(customer):
+    subscriptions.invalidate_active_subscription(customer)
     customer.user_accounts.all().delete()
     customer.user = None
     customer.date_purged = timezone.now()
@@ -163,12 +166,13 @@ def purge(customer):
     purge_local(customer)
 
 
-def link_customer(event):
+def link_customer(event, save=True):
     """
     Links a customer referenced in a webhook event message to the event object
 
     Args:
         event: the pinax.stripe.models.Event object to link
+        save: if False, the event is not saved and saving it is up to the caller
     """
 
     customer_crud_events = [
@@ -185,7 +189,8 @@ def link_customer(event):
         customer = models.Customer.objects.filter(stripe_id=cus_id).first()
         if customer is not None:
             event.customer = customer
-            event.save()
+            if save:
+                event.save()
 
 
 def set_default_source(customer, source):
@@ -206,6 +211,9 @@ def sync_customer(customer, cu=None):
     """
     Synchronizes a local Customer object with details from the Stripe API
 
+    The payment sources and subscriptions of the customer are synchronized in
+    bulk, with a fixed number of queries.
+
     Args:
         customer: a Customer object
         cu: optionally, data from the Stripe API representing the customer
@@ -220,15 +228,14 @@ def sync_customer(customer, cu=None):
         purge_local(customer)
         return
 
+    original = utils.snapshot(customer)
     customer.account_balance = utils.convert_amount_for_db(cu["account_balance"], cu["currency"])
     customer.currency = cu["currency"] or ""
     customer.delinquent = cu["delinquent"]
     customer.default_source = cu["default_source"] or ""
-    customer.save()
-    for source in cu["sources"]["data"]:
-        sources.sync_payment_source_from_stripe_data(customer, source)
-    for subscription in cu["subscriptions"]["data"]:
-        subscriptions.sync_subscription_from_stripe_data(customer, subscription)
+    utils.save_changes(customer, original)
+    sources.sync_payment_sources_from_stripe_data(customer, cu["sources"])
+    subscriptions.sync_subscriptions_from_stripe_data(customer, cu["subscriptions"])
 
     discount = cu["discount"]
     if discount:
@@ -1,9 +1,32 @@
-from .. import models
+import collections
+import datetime
+import json
+import logging
+import os
+import socket
+import threading
+import uuid
+
+from django.db import IntegrityError, connection, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+import stripe
+from six import string_types
+
+from .. import bulk, models
+from ..conf import settings
 from ..webhooks import registry
 
+logger = logging.getLogger(__name__)
+
+_duplicates_lock = threading.Lock()
+_duplicates = {"count": 0}
+
 
 def add_event(stripe_id, kind, livemode, message, api_version="",
-              request_id="", pending_webhooks=0):
+              request_id="", pending_webhooks=0, process=True, validated=False,
+              claim=None):
     """
     Adds and processes an event from a received webhook
 
@@ -15,6 +38,18 @@ def add_event(stripe_id, kind, livemode, message, api_version="",
         api_version: the version of the Stripe API used
         request_id: the id of the request that initiated the webhook
         pending_webhooks: the number of pending webhooks
+        process: if False, only record the event and leave it for
+                 `process_event` (e.g. the `process_events` command)
+        validated: True if the message is known to be authentic, e.g. its
+                   signature was verified; webhooks validated by signature
+                   will then not fetch the event again
+        claim: if True, the event is recorded claimed, so that the
+               process_events workers skip it while the caller processes
+               it; defaults to `process`
+
+    Returns:
+        the pinax.stripe.models.Event object that was created, or None if an
+        event with the same stripe_id was already recorded
     """
     stripe_account_id = message.get("account")
     if stripe_account_id:
@@ -23,22 +58,484 @@ def add_event(stripe_id, kind, livemode, message, api_version="",
         )
     else:
         stripe_account = None
-    event = models.Event.objects.create(
-        stripe_account=stripe_account,
-        stripe_id=stripe_id,
-        kind=kind,
-        livemode=livemode,
-        webhook_message=message,
-        api_version=api_version,
-        request=request_id,
-        pending_webhooks=pending_webhooks
-    )
-    WebhookClass = registry.get(kind)
+    if claim is None:
+        claim = process
+    claim = {"claimed_by": worker_name(), "claimed_at": timezone.now()} if claim else {}
+    try:
+        with transaction.atomic():
+            event = models.Event.objects.create(
+                stripe_account=stripe_account,
+                stripe_id=stripe_id,
+                kind=kind,
+                livemode=livemode,
+                webhook_message=message,
+                validated_message=message if validated else None,
+                api_version=api_version,
+                request=request_id,
+                pending_webhooks=pending_webhooks,
+                partition_key=partition_key(message),
+                **claim
+            )
+    except IntegrityError:
+        if not dupe_event_exists(stripe_id):
+            raise
+        with _duplicates_lock:
+            _duplicates["count"] += 1
+        logger.info("Ignoring duplicate event %s (%s)", stripe_id, kind)
+        return None
+    if process:
+        process_event(event)
+    return event
+
+
+def process_event(event):
+    """
+    Runs the registered webhook handler for an event, if there is one
+
+    Args:
+        event: the pinax.stripe.models.Event object to process
+    """
+    WebhookClass = registry.get(event.kind)
     if WebhookClass is not None:
         webhook = WebhookClass(event)
         webhook.process()
 
 
+def coalesce_key(event):
+    """
+    Args:
+        event: a pinax.stripe.models.Event object
+
+    Returns:
+        a tuple of the Connect account, type and id of the object the event is
+        about, or None if the event must be processed on its own
+    """
+    WebhookClass = registry.get(event.kind)
+    if WebhookClass is None or not WebhookClass.coalesce:
+        return None
+    obj = (event.webhook_message.get("data") or {}).get("object") or {}
+    if not obj.get("id"):
+        return None
+    return event.webhook_message.get("account"), obj.get("object"), obj["id"]
+
+
+def coalesce_events(events, window=None):
+    """
+    Groups events about the same object, so that only the newest is synced
+
+    Events are grouped when their webhook only syncs their object (see
+    `Webhook.coalesce`), they are about the same object and they were received
+    within `window` seconds of the first event of the group.
+
+    Args:
+        events: pinax.stripe.models.Event objects in the order they were received
+        window: seconds, defaults to PINAX_STRIPE_EVENT_COALESCE_WINDOW; events
+                are not grouped when 0
+
+    Returns:
+        a list of lists of events, each in the order they were received, in the
+        order their last event was received; see `process_coalesced`
+    """
+    if window is None:
+        window = settings.PINAX_STRIPE_EVENT_COALESCE_WINDOW
+    window = datetime.timedelta(seconds=window)
+    groups = []
+    open_groups = {}
+    for position, event in enumerate(events):
+        key = coalesce_key(event) if window else None
+        group = open_groups.get(key)
+        if group is None or event.created_at - group[1][0].created_at > window:
+            group = [position, []]
+            groups.append(group)
+            if key is not None:
+                open_groups[key] = group
+        group[0] = position
+        group[1].append(event)
+    return [group for _, group in sorted(groups, key=lambda group: group[0])]
+
+
+def process_coalesced(events):
+    """
+    Processes events about the same object, see `coalesce_events`
+
+    The newest event is processed first, holding back its signal, then the
+    older ones are validated, signaled and marked processed without syncing
+    their object again, and the signal of the newest one is sent last, so that
+    signals are sent in the order the events were received. When the newest
+    event turns out to be invalid, the older ones are processed on their own.
+    When processing an older one raises, the newest one is scheduled for a
+    retry so that it is processed, and signaled, again later.
+
+    Args:
+        events: pinax.stripe.models.Event objects in the order they were received
+    """
+    newest = events[-1]
+    if len(events) == 1:
+        process_event(newest)
+        return
+    webhook = registry.get(newest.kind)(newest)
+    webhook.process(hold_signal=True)
+    try:
+        for event in events[:-1]:
+            WebhookClass = registry.get(event.kind)
+            if WebhookClass is not None:
+                WebhookClass(event).process(coalesced=bool(newest.processed or newest.valid))
+    except Exception as e:
+        if newest.valid and not newest.processed:
+            webhook.schedule_retry(e)
+        raise
+    webhook.release_signal()
+
+
+def pending_events():
+    """
+    Returns the events that were recorded but not processed yet, those
+    whose processing raised and that are due for another attempt, and those
+    that were validated but whose processing never finished, once their
+    claim expired (e.g. the worker died while holding back the signal of a
+    coalesced event, see `process_coalesced`)
+
+    Events that failed validation, that are waiting for their next attempt or
+    that were moved to the dead letters are left out, as are events that have
+    no registered webhook handler.
+
+    Returns:
+        a queryset of pinax.stripe.models.Event objects in the order they
+        were received
+    """
+    now = timezone.now()
+    expired = now - datetime.timedelta(seconds=settings.PINAX_STRIPE_EVENT_CLAIM_TIMEOUT)
+    return models.Event.objects.filter(
+        Q(valid__isnull=True, next_attempt_at__isnull=True) |
+        Q(valid=True, next_attempt_at__isnull=True, claimed_at__lt=expired) |
+        Q(next_attempt_at__lte=now),
+        processed=False,
+        dead_lettered_at__isnull=True,
+        kind__in=list(registry.keys())
+    ).exclude(
+        valid=False
+    ).order_by("pk")
+
+
+def requeue_events(queryset):
+    """
+    Schedules events that are not processed, e.g. dead letters, to be
+    processed again right away with a fresh number of attempts
+
+    Args:
+        queryset: a queryset of pinax.stripe.models.Event objects
+
+    Returns:
+        the number of events requeued
+    """
+    return queryset.filter(processed=False).update(
+        valid=None,
+        attempts=0,
+        next_attempt_at=timezone.now(),
+        dead_lettered_at=None,
+        claimed_by="",
+        claimed_at=None
+    )
+
+
+def partition_key(message):
+    """
+    Args:
+        message: the data of a webhook
+
+    Returns:
+        the key of the events to process in order: the customer the event is
+        about, or else its object, within its Connect account
+    """
+    obj = (message.get("data") or {}).get("object") or {}
+    key = obj.get("id") if obj.get("object") == "customer" else obj.get("customer")
+    if isinstance(key, dict):
+        key = key.get("id")
+    key = key or obj.get("id")
+    if not key:
+        return ""
+    if message.get("account"):
+        key = "{}/{}".format(message["account"], key)
+    return key[:191]
+
+
+def worker_name():
+    """
+    Returns:
+        a name for a worker claiming events, unique across hosts and runs
+    """
+    return "{}:{}:{}".format(socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])[-100:]
+
+
+def claim_events(worker, limit):
+    """
+    Claims pending events for a worker, so that other workers skip them
+
+    The events are selected with `SELECT ... FOR UPDATE SKIP LOCKED` where the
+    database supports it, so that concurrent workers, on any host, claim
+    different events without waiting for each other. A claim expires after
+    PINAX_STRIPE_EVENT_CLAIM_TIMEOUT seconds, after which the event can be
+    claimed again, e.g. when the worker died. An event is not claimed while
+    an earlier event with the same partition key waits for its next attempt,
+    so that the events of a customer stay in order across retries.
+
+    Args:
+        worker: the name of the worker, see `worker_name`
+        limit: the maximum number of events to claim
+
+    Returns:
+        a list of the claimed pinax.stripe.models.Event objects in the order
+        they were received
+    """
+    now = timezone.now()
+    unclaimed = Q(claimed_at__isnull=True) | Q(
+        claimed_at__lt=now - datetime.timedelta(seconds=settings.PINAX_STRIPE_EVENT_CLAIM_TIMEOUT)
+    )
+    with transaction.atomic():
+        where, params = behind_retry_condition(now)
+        qs = pending_events().filter(unclaimed).extra(where=[where], params=params)
+        if getattr(connection.features, "has_select_for_update_skip_locked", False):
+            qs = qs.select_for_update(skip_locked=True)
+        elif connection.features.has_select_for_update:
+            qs = qs.select_for_update()
+        pks = list(qs.values_list("pk", flat=True)[:limit])
+        # another worker may have claimed some of them if rows cannot be locked
+        models.Event.objects.filter(pk__in=pks).filter(unclaimed).update(claimed_by=worker, claimed_at=now)
+    events = list(models.Event.objects.filter(pk__in=pks, claimed_by=worker).order_by("pk"))
+    for event in events:
+        if not event.partition_key:
+            # recorded before events had a partition key
+            event.partition_key = partition_key(event.webhook_message)
+            if event.partition_key:
+                event.save(update_fields=["partition_key"])
+    return events
+
+
+def retrying_events(now):
+    """
+    Returns the events whose processing raised and that wait for their next
+    attempt, and so hold back the later events with the same partition key
+    """
+    return models.Event.objects.filter(
+        processed=False,
+        dead_lettered_at__isnull=True,
+        next_attempt_at__gt=now
+    ).exclude(
+        partition_key=""
+    ).exclude(
+        valid=False
+    )
+
+
+def behind_retry_condition(now):
+    """
+    Returns the SQL, and its parameters, of a condition on the events table
+    that holds when no earlier event with the same partition key is waiting
+    for its next attempt, see `retrying_events`
+
+    The condition is a correlated NOT EXISTS of a fixed size, however many
+    partitions wait on a retry (Exists and OuterRef need Django 1.11).
+    """
+    qn = connection.ops.quote_name
+    table = qn(models.Event._meta.db_table)
+    pk = qn(models.Event._meta.pk.column)
+    key = qn(models.Event._meta.get_field("partition_key").column)
+    retrying = retrying_events(now).order_by().values("pk")
+    sql, params = retrying.query.get_compiler(connection=connection).as_sql()
+    where = (
+        "NOT EXISTS (SELECT 1 FROM {table} retrying WHERE retrying.{key} = {table}.{key}"
+        " AND retrying.{pk} < {table}.{pk} AND retrying.{pk} IN ({sql}))"
+    ).format(table=table, pk=pk, key=key, sql=sql)
+    return where, params
+
+
+def group_claimed_events(events, worker):
+    """
+    Groups the events claimed by a worker by partition key
+
+    Args:
+        events: the events claimed by the worker, in the order they were received
+        worker: the name of the worker
+
+    Returns:
+        a tuple of a list of groups of events, each to be processed in order,
+        and a list of the events to hand back with `defer_events` because an
+        earlier event with the same partition key is pending but claimed by
+        another worker
+    """
+    groups = collections.OrderedDict()
+    for event in events:
+        groups.setdefault(event.partition_key or event.pk, []).append(event)
+    earliest = {}
+    if events:
+        earlier = pending_events().filter(
+            partition_key__in=set(event.partition_key for event in events if event.partition_key),
+            pk__lt=events[-1].pk
+        ).exclude(
+            claimed_by=worker
+        ).values_list("partition_key", "pk")
+        for key, pk in earlier:
+            earliest[key] = min(earliest.get(key, pk), pk)
+    ready = []
+    deferred = []
+    for key, group in groups.items():
+        if key in earliest and earliest[key] < group[0].pk:
+            deferred.extend(group)
+        else:
+            ready.append(group)
+    return ready, deferred
+
+
+def defer_events(events, delay):
+    """
+    Hands claimed events back, to be claimed again in `delay` seconds
+
+    Args:
+        events: the claimed pinax.stripe.models.Event objects
+        delay: seconds
+    """
+    claimed_at = timezone.now() - datetime.timedelta(seconds=settings.PINAX_STRIPE_EVENT_CLAIM_TIMEOUT - delay)
+    models.Event.objects.filter(pk__in=[event.pk for event in events]).update(claimed_at=claimed_at)
+
+
+def sync_since(created=None, stripe_account=None):
+    """
+    Catch up with the events the webhook view missed, e.g. during an outage
+
+    Events are listed from the Stripe API, starting at the checkpoint of the
+    previous run, and the ones not recorded yet are added and processed in
+    the order they happened. They are trusted as they come from the API, so
+    webhooks do not fetch them again. When an event could not be recorded,
+    the checkpoint only moves up to its creation time, so that the next run
+    lists it again.
+
+    Args:
+        created: optionally, a timestamp; list the events created at or after
+                 it instead of those since the previous run
+        stripe_account: optionally, the Stripe id of a connected account whose
+                        events to list
+
+    Returns:
+        the number of events that were added
+    """
+    name = "sync_since:{}".format(stripe_account) if stripe_account else "sync_since"
+    checkpoint, _ = models.SyncCheckpoint.objects.get_or_create(name=name)
+    if created is None and checkpoint.cursor:
+        created = int(checkpoint.cursor)
+    params = {"stripe_account": stripe_account}
+    if created is not None:
+        params["created"] = {"gte": created}
+    missing, newest = list_missing_events(params)
+    added, failed = add_missing_events(missing, stripe_account)
+
+    if failed is not None:
+        checkpoint.cursor = str(failed)
+        checkpoint.updated_at = timezone.now()
+        checkpoint.save()
+    elif newest is not None:
+        checkpoint.cursor = str(newest)
+        checkpoint.updated_at = checkpoint.completed_at = timezone.now()
+        checkpoint.save()
+    return added
+
+
+def list_missing_events(params):
+    """
+    List events from the Stripe API and keep those not recorded yet
+
+    Args:
+        params: the parameters of the list request
+
+    Returns:
+        a tuple of the missing event messages, newest first as Stripe lists
+        them, and the creation timestamp of the newest listed event (None if
+        nothing was listed)
+    """
+    try:
+        listed = stripe.Event.auto_paging_iter(**params)
+    except AttributeError:
+        listed = iter(stripe.Event.list(**params).data)
+
+    missing = []
+    newest = None
+    for chunk in bulk.chunked(listed, 100):
+        newest = newest or chunk[0]["created"]
+        known = set(
+            models.Event.objects.filter(
+                stripe_id__in=[message["id"] for message in chunk]
+            ).values_list("stripe_id", flat=True)
+        )
+        missing.extend(message for message in chunk if message["id"] not in known)
+    return missing, newest
+
+
+def add_missing_events(missing, stripe_account=None):
+    """
+    Add and process the events listed by `list_missing_events`, oldest first
+
+    Returns:
+        a tuple of the number of events that were added, and the creation
+        timestamp of the oldest event that could not be recorded (None if all
+        of them were)
+    """
+    added = 0
+    failed = None
+    for message in reversed(missing):
+        try:
+            event = add_listed_event(message, stripe_account)
+        except Exception:
+            logger.exception("Error adding event %s (%s)", message["id"], message["type"])
+            if failed is None:
+                failed = message["created"]
+            continue
+        if event is None:
+            continue
+        added += 1
+        try:
+            process_event(event)
+        except Exception:
+            # the error was recorded as an EventProcessingException by the
+            # webhook, and the event is left for process_events to retry
+            logger.exception("Error processing event %s (%s)", event.stripe_id, event.kind)
+    return added, failed
+
+
+def add_listed_event(message, stripe_account=None):
+    """
+    Record an event listed from the Stripe API, without processing it
+
+    The event is recorded claimed, as the caller processes it right away.
+
+    Returns:
+        the pinax.stripe.models.Event object that was created, or None if it
+        was already recorded
+    """
+    message = json.loads(json.dumps(message, sort_keys=True, cls=stripe.StripeObjectEncoder))
+    if stripe_account:
+        message.setdefault("account", stripe_account)
+    request = message.get("request") or ""
+    return add_event(
+        stripe_id=message["id"],
+        kind=message["type"],
+        livemode=message["livemode"],
+        message=message,
+        api_version=message.get("api_version") or "",
+        request_id=request if isinstance(request, string_types) else request.get("id") or "",
+        pending_webhooks=message.get("pending_webhooks") or 0,
+        process=False,
+        validated=True,
+        claim=True
+    )
+
+
+def duplicate_event_count():
+    """
+    Returns the number of duplicate events ignored by `add_event` since the
+    process started
+    """
+    return _duplicates["count"]
+
+
 def dupe_event_exists(stripe_id):
     """
     Checks if a duplicate event exists
@@ -1,4 +1,4 @@
-from .. import models
+from .. import models, utils
 
 
 def create_bank_account(account, account_number, country, currency, **kwargs):
@@ -52,6 +52,7 @@ def sync_bank_account_from_stripe_data(data):
     obj, created = models.BankAccount.objects.get_or_create(
         **kwargs
     )
+    original = utils.snapshot(obj)
     top_level_attrs = (
         "account_holder_name", "account_holder_type",
         "bank_name", "country", "currency", "default_for_currency",
@@ -60,5 +61,5 @@ def sync_bank_account_from_stripe_data(data):
     )
     for a in top_level_attrs:
         setattr(obj, a, data.get(a))
-    obj.save()
+    utils.save_changes(obj, original)
     return obj
@@ -2,10 +2,12 @@ import decimal
 
 import stripe
 from django.core.exceptions import MultipleObjectsReturned
+from django.db import transaction
+from django.db.models import Max
 from django.utils.encoding import smart_str
 
 from . import charges, subscriptions
-from .. import hooks, models, utils
+from .. import bulk, catalog, hooks, models, utils
 from ..conf import settings
 
 
@@ -83,13 +85,15 @@ def pay(invoice, send_receipt=True):
     return False
 
 
-def sync_invoice_from_stripe_data(stripe_invoice, send_receipt=settings.PINAX_STRIPE_SEND_EMAIL_RECEIPTS):
+def sync_invoice_from_stripe_data(stripe_invoice, send_receipt=settings.PINAX_STRIPE_SEND_EMAIL_RECEIPTS, retrieved=None):
     """
     Synchronizes a local invoice with data from the Stripe API
 
     Args:
         stripe_invoice: data that represents the invoice from the Stripe API
         send_receipt: if True, send the receipt as a result of paying
+        retrieved: optionally, what `retrieve_invoice_objects` returned for
+                   this invoice, so that no Stripe API call is made here
 
     Returns:
         the pinax.stripe.models.Invoice that was created or updated
@@ -99,23 +103,21 @@ def sync_invoice_from_stripe_data(stripe_invoice, send_receipt=settings.PINAX_ST
     period_start = utils.convert_tstamp(stripe_invoice, "period_start")
     date = utils.convert_tstamp(stripe_invoice, "date")
     sub_id = stripe_invoice.get("subscription")
-    stripe_account_id = c.stripe_account_stripe_id
     invoice_stripe_id = stripe_invoice.get("id")
-    charge_id = stripe_invoice.get("charge")
+    if retrieved is None:
+        retrieved = retrieve_invoice_objects(c, stripe_invoice)
+    stripe_charge, stripe_subscriptions = retrieved
 
-    if charge_id:
-        charge = charges.sync_charge(charge_id, stripe_account=stripe_account_id)
+    if stripe_charge is not None:
+        charge = charges.sync_charge_from_stripe_data(stripe_charge)
         if send_receipt: hooks.hookset.send_receipt(charge)
     else:
         charge = None
 
     subscription = None
-    try:
-        stripe_subscription = subscriptions.retrieve(c, sub_id)
-        if stripe_subscription:
-            subscription = subscriptions.sync_subscription_from_stripe_data(c, stripe_subscription)
-    except stripe.InvalidRequestError:
-        pass
+    stripe_subscription = stripe_subscriptions.get(sub_id) if sub_id else None
+    if stripe_subscription:
+        subscription = subscriptions.sync_subscription_from_stripe_data(c, stripe_subscription)
 
     defaults = dict(
         customer=c,
@@ -152,23 +154,76 @@ def sync_invoice_from_stripe_data(stripe_invoice, send_receipt=settings.PINAX_ST
         charge.save()
 
     invoice = utils.update_with_defaults(invoice, defaults, created)
-    sync_invoice_items(invoice, stripe_invoice["lines"].get("data", []))
+    sync_invoice_items(invoice, stripe_invoice["lines"].get("data", []), stripe_subscriptions)
 
     return invoice
 
 
+def retrieve_invoice_objects(customer, stripe_invoice):
+    """
+    Retrieve the charge and subscriptions an invoice refers to from the Stripe
+    API, without writing anything
+
+    Args:
+        customer: the pinax.stripe.models.Customer of the invoice
+        stripe_invoice: data that represents the invoice from the Stripe API
+
+    Returns:
+        a tuple of the data of the charge (None if the invoice has none) and
+        a dict of the data of the subscriptions of the invoice and of its
+        line items by Stripe id (None for a subscription that does not exist
+        or belongs to another customer)
+    """
+    charge_id = stripe_invoice.get("charge")
+    stripe_charge = charges.retrieve(charge_id, stripe_account=customer.stripe_account_stripe_id) if charge_id else None
+
+    stripe_subscriptions = {}
+    sub_id = stripe_invoice.get("subscription")
+    if sub_id:
+        try:
+            stripe_subscriptions[sub_id] = subscriptions.retrieve(customer, sub_id)
+        except stripe.InvalidRequestError:
+            pass
+    for item in stripe_invoice["lines"].get("data", []):
+        if item["type"] == "subscription" and item["id"] not in stripe_subscriptions:
+            stripe_subscriptions[item["id"]] = subscriptions.retrieve(customer, item["id"])
+    return stripe_charge, stripe_subscriptions
+
+
 def sync_invoices_for_customer(customer):
     """
     Synchronizes all invoices for a customer
 
+    Only the invoices dated since the newest one already synced are listed, a
+    page at a time. The charges and subscriptions of a page are retrieved
+    first, then the page is written in one transaction.
+
     Args:
         customer: the customer for whom to synchronize all invoices
     """
-    for invoice in customer.stripe_customer.invoices().data:
-        sync_invoice_from_stripe_data(invoice, send_receipt=False)
+    params = {
+        "customer": customer.stripe_id,
+        "stripe_account": customer.stripe_account_stripe_id,
+        "limit": 100,
+    }
+    latest = customer.invoices.aggregate(latest=Max("date"))["latest"]
+    if latest is not None:
+        # invoices dated in the same second as the newest one are synced again
+        params["date"] = {"gte": utils.convert_datetime_for_api(latest)}
+    try:
+        listed = stripe.Invoice.auto_paging_iter(**params)
+    except AttributeError:
+        listed = iter(stripe.Invoice.list(**params).data)
 
+    for page in bulk.chunked(listed, params["limit"]):
+        # the Stripe API is called before the transaction, which only writes
+        retrieved = [retrieve_invoice_objects(customer, invoice) for invoice in page]
+        with transaction.atomic():
+            for invoice, objects in zip(page, retrieved):
+                sync_invoice_from_stripe_data(invoice, send_receipt=False, retrieved=objects)
 
-def sync_invoice_items(invoice, items):
+
+def sync_invoice_items(invoice, items, stripe_subscriptions=None):
     """
     Synchronizes all invoice line items for a particular invoice
 
@@ -179,57 +234,71 @@ def sync_invoice_items(invoice, items):
     For example, going through the invoiceitems resource you don't get a "type"
     field on the object.
 
+    Existing items are loaded and the referenced plans resolved (through the
+    catalog cache) with one query each, then new, changed and removed items
+    are inserted, updated and deleted in bulk; items that did not change are
+    not written.
+
     Args:
         invoice_: the invoice objects to synchronize
         items: the data from the Stripe API representing the line items
+        stripe_subscriptions: optionally, the subscriptions of the line items
+                              already retrieved from the Stripe API, by id
         :param invoice:
-    """
 
-    # clear any existing invoice item
-    invoice.items.all().delete()
+    Returns:
+        an UpsertSummary of the synced items
+    """
+    items = list(items)
+    existing = list(invoice.items.values_list("pk", flat=True))
+    plans = catalog.get_many(
+        models.Plan,
+        [item["plan"]["id"] for item in items if item.get("plan")],
+        stripe_account=invoice.customer.stripe_account
+    )
+    item_subscriptions = {}
+    if invoice.subscription:
+        item_subscriptions[invoice.subscription.stripe_id] = invoice.subscription
 
+    rows = []
     for item in items:
-        period_end = utils.convert_tstamp(item["period"], "end")
-        period_start = utils.convert_tstamp(item["period"], "start")
-
-        plan = None
-        if item.get("plan"):
-            try:
-                plan = models.Plan.objects.get(stripe_id=item["plan"]["id"])
-            except models.Plan.DoesNotExist:
-                pass
+        plan = plans.get(item["plan"]["id"]) if item.get("plan") else None
 
         if item["type"] == "subscription":
-            if invoice.subscription and invoice.subscription.stripe_id == item["id"]:
-                item_subscription = invoice.subscription
-            else:
-                stripe_subscription = subscriptions.retrieve(
-                    invoice.customer,
-                    item["id"]
-                )
-                item_subscription = subscriptions.sync_subscription_from_stripe_data(
+            if item["id"] not in item_subscriptions:
+                if stripe_subscriptions is not None and item["id"] in stripe_subscriptions:
+                    stripe_subscription = stripe_subscriptions[item["id"]]
+                else:
+                    stripe_subscription = subscriptions.retrieve(
+                        invoice.customer,
+                        item["id"]
+                    )
+                item_subscriptions[item["id"]] = subscriptions.sync_subscription_from_stripe_data(
                     invoice.customer,
                     stripe_subscription
                 ) if stripe_subscription else None
+            item_subscription = item_subscriptions[item["id"]]
             if plan is None and item_subscription is not None and item_subscription.plan is not None:
                 plan = item_subscription.plan
         else:
             item_subscription = None
 
-        defaults = dict(
+        rows.append((item["id"], dict(
             amount=utils.convert_amount_for_db(item["amount"], item["currency"]),
             currency=item["currency"],
             proration=item["proration"],
             description=item.get("description") or "",
             line_type=item["type"],
             plan=plan,
-            period_start=period_start,
-            period_end=period_end,
+            period_start=utils.convert_tstamp(item["period"], "start"),
+            period_end=utils.convert_tstamp(item["period"], "end"),
             quantity=item.get("quantity"),
             subscription=item_subscription
-        )
-        inv_item, inv_item_created = invoice.items.get_or_create(
-            stripe_id=item["id"],
-            defaults=defaults
-        )
-        utils.update_with_defaults(inv_item, defaults, inv_item_created)
+        )))
+
+    summary = bulk.upsert(models.InvoiceItem, rows, invoice=invoice)
+    synced = set(obj.pk for obj in summary.objects)
+    removed = [pk for pk in existing if pk not in synced]
+    for chunk in bulk.chunked(removed, settings.PINAX_STRIPE_BULK_CHUNK_SIZE):
+        models.InvoiceItem.objects.filter(pk__in=chunk).delete()
+    return summary
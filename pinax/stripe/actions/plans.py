@@ -1,31 +1,38 @@
 import stripe
 
-from .. import models, utils
+from .. import bulk, catalog, models, utils
 
 
 def sync_plans():
     """
     Synchronizes all plans from the Stripe API
+
+    Returns:
+        a pinax.stripe.bulk.UpsertSummary
     """
     try:
         plans = stripe.Plan.auto_paging_iter()
     except AttributeError:
         plans = iter(stripe.Plan.all().data)
 
-    for plan in plans:
-        sync_plan(plan)
+    summary = bulk.upsert(
+        models.Plan,
+        ((plan["id"], plan_defaults(plan)) for plan in plans),
+        stripe_account=None
+    )
+    catalog.invalidate(models.Plan)
+    return summary
 
 
-def sync_plan(plan, event=None):
+def plan_defaults(plan):
     """
-    Synchronizes a plan from the Stripe API
-
     Args:
         plan: data from Stripe API representing a plan
-        event: the event associated with the plan
-    """
 
-    defaults = {
+    Returns:
+        the values of the fields of a pinax.stripe.models.Plan
+    """
+    return {
         "amount": utils.convert_amount_for_db(plan["amount"], plan["currency"]),
         "currency": plan["currency"] or "",
         "interval": plan["interval"],
@@ -36,6 +43,18 @@ def sync_plan(plan, event=None):
         "metadata": plan["metadata"]
     }
 
+
+def sync_plan(plan, event=None):
+    """
+    Synchronizes a plan from the Stripe API
+
+    Args:
+        plan: data from Stripe API representing a plan
+        event: the event associated with the plan
+    """
+
+    defaults = plan_defaults(plan)
+
     obj, created = models.Plan.objects.get_or_create(
         stripe_id=plan["id"],
         defaults=defaults
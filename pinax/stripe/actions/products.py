@@ -1,36 +1,41 @@
 import stripe
 from django.utils.encoding import smart_str
 
-from .. import utils
-from .. import models
+from .. import bulk, catalog, models, utils
 from .. actions import skus
 
 def sync_products():
     """
     Synchronizes all the products from the Stripe API
+
+    Returns:
+        a pinax.stripe.bulk.UpsertSummary
     """
     try:
         products = stripe.Product.auto_paging_iter()
     except AttributeError:
         products = iter(stripe.Product.list().data)
 
-    for product in products:
-        sync_product_from_stripe_data(product)
+    summary = bulk.upsert(
+        models.Product,
+        ((product["id"], product_defaults(product)) for product in products)
+    )
+    for obj in summary.objects:
+        skus.sync_skus_from_product(obj)
+    catalog.invalidate(models.Product)
+    catalog.invalidate(models.Sku)
+    return summary
 
-def sync_product_from_stripe_data(stripe_product):
-    """
-    Create or update the product represented by the data from a Stripe API query.
 
+def product_defaults(stripe_product):
+    """
     Args:
-        stripe_product: the data representing a sku object in the Stripe API
+        stripe_product: the data representing a product object in the Stripe API
 
     Returns:
-        a pinax.stripe.models.Product object
+        the values of the fields of a pinax.stripe.models.Product
     """
-
-    stripe_product_id = stripe_product["id"]
-
-    defaults = {
+    return {
         'active': stripe_product.get("active"),
         'attributes': stripe_product.get("attributes"),
         'caption': stripe_product.get("caption"),
@@ -43,6 +48,22 @@ def sync_product_from_stripe_data(stripe_product):
         'shippable': stripe_product.get("shippable")
     }
 
+
+def sync_product_from_stripe_data(stripe_product):
+    """
+    Create or update the product represented by the data from a Stripe API query.
+
+    Args:
+        stripe_product: the data representing a sku object in the Stripe API
+
+    Returns:
+        a pinax.stripe.models.Product object
+    """
+
+    stripe_product_id = stripe_product["id"]
+
+    defaults = product_defaults(stripe_product)
+
     obj, created = models.Product.objects.get_or_create(stripe_id=stripe_product_id)
     obj = utils.update_with_defaults(obj, defaults, created)
     skus.sync_skus_from_product(obj)
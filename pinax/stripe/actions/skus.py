@@ -1,7 +1,7 @@
 import stripe
 from django.utils.encoding import smart_str
 
-from .. import models
+from .. import catalog, models
 from .. import utils
 
 
@@ -153,7 +153,7 @@ def sync_skus():
         skus = iter(stripe.SKU.list().data)
 
     for stripe_sku in skus:
-        product = models.Product.objects.get(stripe_id=stripe_sku["product"])
+        product = catalog.get(models.Product, stripe_sku["product"])
 
         defaults = dict(
             product=product,
@@ -174,6 +174,7 @@ def sync_skus():
             defaults=defaults
         )
         utils.update_with_defaults(obj, defaults, created)
+    catalog.invalidate(models.Sku)
 
 def sync_sku_from_stripe_data(stripe_sku):
     """
@@ -186,8 +187,9 @@ def sync_sku_from_stripe_data(stripe_sku):
         a pinax.stripe.models.Sku object
     """
 
-    product = models.Product.objects.get(stripe_id=stripe_sku["product"])
+    product = catalog.get(models.Product, stripe_sku["product"])
     obj, _ = models.Sku.objects.get_or_create(stripe_id=stripe_sku["id"])
+    original = utils.snapshot(obj)
 
     obj.product = product
     obj.price = utils.convert_amount_for_db(stripe_sku["price"], stripe_sku["currency"])
@@ -201,7 +203,7 @@ def sync_sku_from_stripe_data(stripe_sku):
     obj.active = stripe_sku["active"]
     obj.updated = utils.convert_tstamp(stripe_sku, "updated")
 
-    obj.save()
+    utils.save_changes(obj, original)
     return obj
 
 def sync_skus_from_product(product):
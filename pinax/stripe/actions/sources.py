@@ -1,4 +1,4 @@
-from .. import models, utils
+from .. import bulk, models, utils
 
 
 def create_card(customer, token):
@@ -36,15 +36,16 @@ def delete_card_object(source):
         return models.Card.objects.filter(stripe_id=source).delete()
 
 
-def sync_card(customer, source):
+def card_defaults(customer, source):
     """
-    Synchronizes the data for a card locally for a given customer
-
     Args:
-        customer: the customer to create or update a card for
+        customer: the customer the card belongs to
         source: data representing the card from the Stripe API
+
+    Returns:
+        the values of the fields of a pinax.stripe.models.Card
     """
-    defaults = dict(
+    return dict(
         customer=customer,
         name=source["name"] or "",
         address_line_1=source["address_line1"] or "",
@@ -65,6 +66,17 @@ def sync_card(customer, source):
         last4=source["last4"] or "",
         fingerprint=source["fingerprint"] or ""
     )
+
+
+def sync_card(customer, source):
+    """
+    Synchronizes the data for a card locally for a given customer
+
+    Args:
+        customer: the customer to create or update a card for
+        source: data representing the card from the Stripe API
+    """
+    defaults = card_defaults(customer, source)
     card, created = models.Card.objects.get_or_create(
         stripe_id=source["id"],
         defaults=defaults
@@ -72,15 +84,16 @@ def sync_card(customer, source):
     return utils.update_with_defaults(card, defaults, created)
 
 
-def sync_bitcoin(customer, source):
+def bitcoin_defaults(customer, source):
     """
-    Synchronizes the data for a Bitcoin receiver locally for a given customer
-
     Args:
-        customer: the customer to create or update a Bitcoin receiver for
+        customer: the customer the Bitcoin receiver belongs to
         source: data reprenting the Bitcoin receiver from the Stripe API
+
+    Returns:
+        the values of the fields of a pinax.stripe.models.BitcoinReceiver
     """
-    defaults = dict(
+    return dict(
         customer=customer,
         active=source["active"],
         amount=utils.convert_amount_for_db(source["amount"], source["currency"]),
@@ -98,6 +111,17 @@ def sync_bitcoin(customer, source):
         uncaptured_funds=source["uncaptured_funds"],
         used_for_payment=source["used_for_payment"]
     )
+
+
+def sync_bitcoin(customer, source):
+    """
+    Synchronizes the data for a Bitcoin receiver locally for a given customer
+
+    Args:
+        customer: the customer to create or update a Bitcoin receiver for
+        source: data reprenting the Bitcoin receiver from the Stripe API
+    """
+    defaults = bitcoin_defaults(customer, source)
     receiver, created = models.BitcoinReceiver.objects.get_or_create(
         stripe_id=source["id"],
         defaults=defaults
@@ -120,6 +144,40 @@ def sync_payment_source_from_stripe_data(customer, source):
         return sync_bitcoin(customer, source)
 
 
+def sync_payment_sources_from_stripe_data(customer, sources):
+    """
+    Synchronizes all the payment sources of a customer at once
+
+    The cards and Bitcoin receivers are written with a bulk upsert, and the
+    local cards of the customer that Stripe no longer lists are deleted
+    (unless the list is truncated).
+
+    Args:
+        customer: the customer whose payment sources to synchronize
+        sources: the list of payment sources of the customer from the Stripe
+                 API (the `sources` property of a customer)
+
+    Returns:
+        the synced pinax.stripe.models.Card and BitcoinReceiver objects
+    """
+    data = sources["data"]
+    cards = bulk.upsert(models.Card, (
+        (source["id"], card_defaults(customer, source))
+        for source in data if source["object"] == "card"
+    ))
+    receivers = bulk.upsert(models.BitcoinReceiver, (
+        (source["id"], bitcoin_defaults(customer, source))
+        for source in data if source["object"] == "bitcoin_receiver"
+    ))
+    if not sources.get("has_more"):
+        models.Card.objects.filter(
+            customer=customer
+        ).exclude(
+            stripe_id__in=[card.stripe_id for card in cards.objects]
+        ).delete()
+    return cards.objects + receivers.objects
+
+
 def update_card(customer, source, name=None, exp_month=None, exp_year=None):
     """
     Updates a card for a given customer
@@ -1,26 +1,27 @@
 import stripe
 from django.utils.encoding import smart_str
-from .. import models, utils
+from .. import catalog, models, utils
 from ..models import SubscriptionItem
 
 
-def sync_subscriptionitem_from_stripe_data(subscriptionitem):
+def sync_subscriptionitem_from_stripe_data(subscriptionitem, subscription=None):
     """
     Synchronizes data from the Stripe API for a subscription item
 
     Args:
         subscriptionitem: data from the Stripe API representing a subscription
+        subscription: optionally, the pinax.stripe.models.Subscription the item
+                      belongs to, looked up when not given
 
     Returns:
         the pinax.stripe.models.Subscription object (created or updated)
     """
-    defaults = dict(
-        plan=models.Plan.objects.get(stripe_id=subscriptionitem["plan"]["id"]),
-        subscription=models.Subscription.objects.get(stripe_id=subscriptionitem["subscription"]),
-        metadata=subscriptionitem["metadata"],
-        object=subscriptionitem["object"],
-        quantity=subscriptionitem["quantity"],
-        created_at=utils.convert_tstamp(subscriptionitem["created"]),
+    if subscription is None:
+        subscription = models.Subscription.objects.get(stripe_id=subscriptionitem["subscription"])
+    defaults = subscriptionitem_defaults(
+        subscriptionitem,
+        subscription,
+        catalog.get(models.Plan, subscriptionitem["plan"]["id"], stripe_account=subscription.customer.stripe_account)
     )
     si, created = models.SubscriptionItem.objects.get_or_create(
         stripe_id=subscriptionitem["id"],
@@ -30,12 +31,41 @@ def sync_subscriptionitem_from_stripe_data(subscriptionitem):
     return si
 
 
-def sync_subscription_items(subscription):
+def subscriptionitem_defaults(subscriptionitem, subscription, plan):
+    """
+    Args:
+        subscriptionitem: data from the Stripe API representing a subscription item
+        subscription: the pinax.stripe.models.Subscription the item belongs to
+        plan: the pinax.stripe.models.Plan of the item
+
+    Returns:
+        the values of the fields of a pinax.stripe.models.SubscriptionItem
+    """
+    return dict(
+        plan=plan,
+        subscription=subscription,
+        metadata=subscriptionitem["metadata"],
+        object=subscriptionitem["object"],
+        quantity=subscriptionitem["quantity"],
+        created_at=utils.convert_tstamp(subscriptionitem["created"]),
+    )
+
+
+def sync_subscription_items(subscription, items=None):
+    """
+    Synchronizes the items of a subscription, removing the ones that no longer exist
+
+    Args:
+        subscription: the pinax.stripe.models.Subscription to sync the items of
+        items: optionally, the complete list of items from the Stripe API (e.g.
+               embedded in the subscription), fetched when not given
+    """
     try:
-        resp = stripe.SubscriptionItem.list(subscription=subscription.stripe_id)
+        if items is None:
+            items = stripe.SubscriptionItem.list(subscription=subscription.stripe_id).get('data', [])
         subscriptionitem_ids = []
-        for item in resp.get('data', []):
-            subscriptionitem = sync_subscriptionitem_from_stripe_data(item)
+        for item in items:
+            subscriptionitem = sync_subscriptionitem_from_stripe_data(item, subscription)
             subscriptionitem_ids.append(subscriptionitem.stripe_id)
         subscription.items.exclude(stripe_id__in=subscriptionitem_ids).delete()
         return subscription
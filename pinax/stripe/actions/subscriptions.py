@@ -1,11 +1,14 @@
 import datetime
 
 import stripe
-from django.db.models import Q
+from django.core.cache import caches
+from django.db.models import DateTimeField, Q, Value
+from django.db.models.functions import Coalesce
 from django.utils import timezone
 from django.utils.encoding import smart_str
 
-from .. import hooks, models, utils
+from .. import bulk, catalog, hooks, models, utils
+from ..conf import settings
 
 
 def cancel(subscription, at_period_end=True):
@@ -99,6 +102,57 @@ def has_active_subscription(customer):
     ).exists()
 
 
+def active_subscription_cache_key(user_pk):
+    return "pinax-stripe:active-subscription:{}".format(user_pk)
+
+
+def user_has_active_subscription(user):
+    """
+    Checks if the customer of the given user has an active subscription,
+    keeping the answer in the PINAX_STRIPE_SUBSCRIPTION_CACHE cache for
+    PINAX_STRIPE_SUBSCRIPTION_CACHE_TIMEOUT seconds, or until the subscription
+    ends if sooner
+
+    Args:
+        user: the user to check
+
+    Returns:
+        True, if there is an active subscription, otherwise False
+    """
+    timeout = settings.PINAX_STRIPE_SUBSCRIPTION_CACHE_TIMEOUT
+    cache = caches[settings.PINAX_STRIPE_SUBSCRIPTION_CACHE]
+    key = active_subscription_cache_key(user.pk)
+    if timeout:
+        active = cache.get(key)
+        if active is not None:
+            return active
+
+    now = timezone.now()
+    ended_at = list(models.Subscription.objects.filter(
+        customer__user=user
+    ).filter(
+        Q(ended_at__isnull=True) | Q(ended_at__gt=now)
+    ).values_list("ended_at", flat=True))
+    active = bool(ended_at)
+    if active and None not in ended_at:
+        timeout = min(timeout, int((max(ended_at) - now).total_seconds()))
+    if timeout > 0:
+        cache.set(key, active, timeout=timeout)
+    return active
+
+
+def invalidate_active_subscription(customer):
+    """
+    Forgets whether the user of the given customer has an active subscription,
+    see `user_has_active_subscription`
+
+    Args:
+        customer: the pinax.stripe.models.Customer whose subscriptions changed
+    """
+    if customer is not None and customer.user_id is not None:
+        caches[settings.PINAX_STRIPE_SUBSCRIPTION_CACHE].delete(active_subscription_cache_key(customer.user_id))
+
+
 def is_period_current(subscription):
     """
     Tests if the provided subscription object for the current period
@@ -177,9 +231,30 @@ def sync_subscription_from_stripe_data(customer, subscription):
     from .subscriptionitems import sync_subscription_items
 
     plan = subscription['plan']
-    plan = models.Plan.objects.get(stripe_id=subscription["plan"]["id"]) if plan else None
+    plan = catalog.get(models.Plan, subscription["plan"]["id"], stripe_account=customer.stripe_account) if plan else None
+
+    defaults = subscription_defaults(customer, subscription, plan)
+    sub, created = models.Subscription.objects.get_or_create(
+        stripe_id=subscription["id"],
+        defaults=defaults
+    )
+    sub = utils.update_with_defaults(sub, defaults, created)
+    invalidate_active_subscription(customer)
+    sub = sync_subscription_items(sub, embedded_items(subscription)) or sub
+    return sub
+
 
-    defaults = dict(
+def subscription_defaults(customer, subscription, plan):
+    """
+    Args:
+        customer: the customer the subscription belongs to
+        subscription: data from the Stripe API representing a subscription
+        plan: the pinax.stripe.models.Plan of the subscription, or None
+
+    Returns:
+        the values of the fields of a pinax.stripe.models.Subscription
+    """
+    return dict(
         customer=customer,
         application_fee_percent=subscription["application_fee_percent"],
         cancel_at_period_end=subscription["cancel_at_period_end"],
@@ -195,13 +270,92 @@ def sync_subscription_from_stripe_data(customer, subscription):
         trial_end=utils.convert_tstamp(subscription["trial_end"]) if subscription["trial_end"] else None
     )
 
-    sub, created = models.Subscription.objects.get_or_create(
-        stripe_id=subscription["id"],
-        defaults=defaults
-    )
-    sub = utils.update_with_defaults(sub, defaults, created)
-    sub = sync_subscription_items(sub) or sub
-    return sub
+
+def embedded_items(subscription):
+    """
+    Returns:
+        the items embedded in the data of a subscription, or None if they
+        are missing or truncated and have to be fetched
+    """
+    items = subscription.get("items")
+    return items["data"] if isinstance(items, dict) and not items.get("has_more") else None
+
+
+def sync_subscriptions_from_stripe_data(customer, subscriptions):
+    """
+    Synchronizes all the subscriptions of a customer at once
+
+    The plans are resolved with one query (through the catalog cache), and the
+    subscriptions and their embedded items are written with bulk upserts.
+    Items that are no longer listed are deleted. Local subscriptions that
+    Stripe no longer lists (unless the list is truncated) are marked as
+    canceled rather than deleted, since Stripe does not list canceled
+    subscriptions and deleting them would delete their invoices.
+
+    Args:
+        customer: the customer whose subscriptions to synchronize
+        subscriptions: the list of subscriptions of the customer from the
+                       Stripe API (the `subscriptions` property of a customer)
+
+    Returns:
+        the synced pinax.stripe.models.Subscription objects
+    """
+    from .subscriptionitems import subscriptionitem_defaults, sync_subscription_items
+
+    data = subscriptions["data"]
+    plan_ids = [subscription["plan"]["id"] for subscription in data if subscription["plan"]]
+    for subscription in data:
+        plan_ids.extend(item["plan"]["id"] for item in embedded_items(subscription) or [])
+    plans = catalog.get_many(models.Plan, plan_ids, stripe_account=customer.stripe_account)
+
+    def get_plan(stripe_id):
+        # raises Plan.DoesNotExist for a plan that is not synced
+        return plans[stripe_id] if stripe_id in plans else catalog.get(models.Plan, stripe_id, stripe_account=customer.stripe_account)
+
+    summary = bulk.upsert(models.Subscription, (
+        (subscription["id"], subscription_defaults(
+            customer,
+            subscription,
+            get_plan(subscription["plan"]["id"]) if subscription["plan"] else None
+        ))
+        for subscription in data
+    ))
+    subs = {sub.stripe_id: sub for sub in summary.objects}
+
+    item_rows = []
+    complete = []
+    for subscription in data:
+        sub = subs[subscription["id"]]
+        items = embedded_items(subscription)
+        if items is None:
+            sync_subscription_items(sub)
+            continue
+        complete.append(sub)
+        item_rows.extend(
+            (item["id"], subscriptionitem_defaults(item, sub, get_plan(item["plan"]["id"])))
+            for item in items
+        )
+    items = bulk.upsert(models.SubscriptionItem, item_rows)
+    if complete:
+        models.SubscriptionItem.objects.filter(
+            subscription__in=complete
+        ).exclude(
+            stripe_id__in=[item.stripe_id for item in items.objects]
+        ).delete()
+
+    if not subscriptions.get("has_more"):
+        models.Subscription.objects.filter(
+            customer=customer
+        ).exclude(
+            stripe_id__in=list(subs)
+        ).exclude(
+            status="canceled"
+        ).update(
+            status="canceled",
+            ended_at=Coalesce("ended_at", Value(timezone.now(), output_field=DateTimeField()))
+        )
+    invalidate_active_subscription(customer)
+    return summary.objects
 
 def get_subscription_item_by_plan_id(stripe_subscription, plan_id):
     subscription_item = None
@@ -56,13 +56,11 @@ def sync_transfer(transfer, event=None):
         "transfer_group": transfer.get("transfer_group"),
         "type": transfer.get("type")
     }
-    obj, created = models.Transfer.objects.update_or_create(
+    obj, created = models.Transfer.objects.get_or_create(
         stripe_id=transfer["id"],
         defaults=defaults
     )
-    if not created:
-        obj.status = transfer["status"]
-        obj.save()
+    utils.update_with_defaults(obj, defaults, created)
     return obj
 
 
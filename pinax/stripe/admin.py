@@ -3,6 +3,7 @@ from django.contrib.admin.views.main import ChangeList
 from django.contrib.auth import get_user_model
 from django.db.models import Count
 
+from .actions import events
 from .models import (  # @@@ make all these read-only
     Account,
     BankAccount,
@@ -124,6 +125,32 @@ class AccountListFilter(admin.SimpleListFilter):
         return queryset
 
 
+class EventRetryListFilter(admin.SimpleListFilter):
+    title = "retries"
+    parameter_name = "retries"
+
+    def lookups(self, request, model_admin):
+        return [
+            ["scheduled", "Scheduled"],
+            ["dead", "Dead Letters"]
+        ]
+
+    def queryset(self, request, queryset):
+        if self.value() == "scheduled":
+            return queryset.filter(processed=False, next_attempt_at__isnull=False)
+        elif self.value() == "dead":
+            return queryset.filter(processed=False, dead_lettered_at__isnull=False)
+        return queryset.all()
+
+
+def requeue_events(modeladmin, request, queryset):
+    count = events.requeue_events(queryset)
+    modeladmin.message_user(request, "Requeued {0} event(s)".format(count))
+
+
+requeue_events.short_description = "Requeue selected events"  # noqa
+
+
 class PrefetchingChangeList(ChangeList):
     """A custom changelist to prefetch related fields."""
     def get_queryset(self, request):
@@ -205,6 +232,7 @@ admin.site.register(
         "livemode",
         "valid",
         "processed",
+        "attempts",
         "created_at",
         "stripe_account",
     ],
@@ -213,8 +241,10 @@ admin.site.register(
         "created_at",
         "valid",
         "processed",
+        EventRetryListFilter,
         AccountListFilter,
     ],
+    actions=[requeue_events],
     search_fields=[
         "stripe_id",
         "customer__stripe_id",
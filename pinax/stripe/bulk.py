@@ -0,0 +1,146 @@
+import collections
+import itertools
+
+from .conf import settings
+
+
+class UpsertSummary(object):
+    """
+    What an upsert did
+
+    Attributes:
+        created: the number of rows inserted
+        updated: the number of rows that differed from Stripe and were updated
+        unchanged: the number of rows already matching Stripe
+        objects: the synced model instances, in the order of the rows
+    """
+
+    def __init__(self):
+        self.created = 0
+        self.updated = 0
+        self.unchanged = 0
+        self.objects = []
+
+    def __repr__(self):
+        return "UpsertSummary(created={!r}, updated={!r}, unchanged={!r})".format(
+            self.created,
+            self.updated,
+            self.unchanged,
+        )
+
+
+def chunked(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def upsert(model, rows, chunk_size=None, **lookup):
+    """
+    Create or update many objects with a few queries per chunk of rows,
+    instead of a get_or_create and a save per row
+
+    The existing rows of a chunk are fetched in one query and compared in
+    memory: new ones are inserted with bulk_create and changed ones are
+    updated (with bulk_update on Django >= 2.2, else one UPDATE per changed
+    row). Unchanged rows cost no query.
+
+    Args:
+        model: a model with a `stripe_id` field
+        rows: an iterable of (stripe_id, defaults) tuples, where defaults maps
+              field names to their value from Stripe
+        chunk_size: the number of rows handled at once, defaults to
+                    PINAX_STRIPE_BULK_CHUNK_SIZE
+        lookup: extra field values identifying the rows, e.g.
+                `stripe_account=None`
+
+    Returns:
+        an UpsertSummary
+    """
+    summary = UpsertSummary()
+    for chunk in chunked(rows, chunk_size or settings.PINAX_STRIPE_BULK_CHUNK_SIZE):
+        upsert_chunk(model, chunk, summary, lookup)
+    return summary
+
+
+def upsert_chunk(model, rows, summary, lookup):
+    created, changed, objects = partition_chunk(model, rows, summary, lookup)
+    insert_objects(model, created, summary, lookup)
+    update_objects(model, changed, summary)
+    summary.objects.extend(objects)
+
+
+def partition_chunk(model, rows, summary, lookup):
+    """
+    Compare a chunk of rows with the existing objects, without writing
+
+    Returns:
+        a tuple of the objects to insert, the (object, changed field names)
+        pairs to update, and all the objects in the order of the rows
+    """
+    # the last occurrence of an object wins, as it would with one save per row
+    rows = list(collections.OrderedDict(rows).items())
+    existing = {
+        obj.stripe_id: obj
+        for obj in model.objects.filter(stripe_id__in=[stripe_id for stripe_id, _ in rows], **lookup)
+    }
+    objects = []
+    created = []
+    changed = []
+    for stripe_id, defaults in rows:
+        obj = existing.get(stripe_id)
+        if obj is None:
+            obj = model(stripe_id=stripe_id, **dict(lookup, **defaults))
+            created.append(obj)
+        else:
+            diff = [name for name, value in defaults.items() if differs(obj, name, value)]
+            for name in diff:
+                setattr(obj, name, defaults[name])
+            if diff:
+                changed.append((obj, diff))
+            else:
+                summary.unchanged += 1
+        objects.append(obj)
+    return created, changed, objects
+
+
+def insert_objects(model, created, summary, lookup):
+    if not created:
+        return
+    model.objects.bulk_create(created)
+    if any(obj.pk is None for obj in created):
+        # only some backends return the primary keys of inserted rows
+        pks = dict(
+            model.objects.filter(
+                stripe_id__in=[obj.stripe_id for obj in created],
+                **lookup
+            ).values_list("stripe_id", "pk")
+        )
+        for obj in created:
+            obj.pk = pks[obj.stripe_id]
+    summary.created += len(created)
+
+
+def update_objects(model, changed, summary):
+    if not changed:
+        return
+    if hasattr(model.objects, "bulk_update"):
+        fields = set()
+        for _, diff in changed:
+            fields.update(diff)
+        model.objects.bulk_update([obj for obj, _ in changed], sorted(fields))
+    else:
+        for obj, diff in changed:
+            model.objects.filter(pk=obj.pk).update(**{name: getattr(obj, name) for name in diff})
+    summary.updated += len(changed)
+
+
+def differs(obj, name, value):
+    field = obj._meta.get_field(name)
+    if field.many_to_one:
+        # compare keys so the related object is not fetched
+        return getattr(obj, field.attname) != (value.pk if value is not None else None)
+    return getattr(obj, name) != value
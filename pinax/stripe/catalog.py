@@ -0,0 +1,148 @@
+import collections
+import threading
+import time
+
+from .conf import settings
+
+# the account part of the cache key of objects that do not belong to a
+# connected account
+PLATFORM = "platform"
+
+
+class CatalogCache(object):
+    """
+    Plans, coupons, products and skus by Stripe id, kept in the process for
+    PINAX_STRIPE_CATALOG_CACHE_TTL seconds
+
+    At most PINAX_STRIPE_CATALOG_CACHE_SIZE objects are kept, the least
+    recently used are dropped first. Objects that do not exist are not cached.
+    Objects are cached under the account they belong to (or PLATFORM), so the
+    objects of the platform and of connected accounts never share an entry.
+    The cached instances are shared between callers and threads, they must not
+    be modified.
+    """
+
+    def __init__(self):
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def label(model):
+        # Options.label_lower only exists from Django 1.9 on
+        return "{}.{}".format(model._meta.app_label, model._meta.model_name)
+
+    @classmethod
+    def key(cls, model, stripe_id, stripe_account=None):
+        return (cls.label(model), getattr(stripe_account, "stripe_id", stripe_account) or PLATFORM, stripe_id)
+
+    def get_many(self, model, stripe_ids, stripe_account=None):
+        """
+        Args:
+            model: pinax.stripe.models.Plan, Coupon, Product or Sku
+            stripe_ids: the Stripe ids of the objects
+            stripe_account: optionally, the Account (or its Stripe id) the
+                            objects belong to; when not given the object of
+                            the platform is preferred, else one of any
+                            account matches, as with a lookup by `stripe_id`
+
+        Returns:
+            a dict of the objects found by Stripe id, with one query for the
+            ones that are not cached
+        """
+        ttl = settings.PINAX_STRIPE_CATALOG_CACHE_TTL
+        found = {}
+        missing = []
+        now = time.time()
+        with self._lock:
+            for stripe_id in set(stripe_ids):
+                key = self.key(model, stripe_id, stripe_account)
+                entry = self._entries.get(key)
+                if entry is not None and ttl and entry[0] > now:
+                    # most recently used last
+                    self._entries[key] = self._entries.pop(key)
+                    found[stripe_id] = entry[1]
+                    self.hits += 1
+                else:
+                    missing.append(stripe_id)
+                    self.misses += 1
+        if not missing:
+            return found
+
+        fetched = self.fetch(model, missing, stripe_account)
+        found.update((stripe_id, obj) for stripe_id, (_, obj) in fetched.items())
+        if ttl:
+            with self._lock:
+                for stripe_id, (account, obj) in fetched.items():
+                    self._entries[self.key(model, stripe_id, account)] = (now + ttl, obj)
+                while len(self._entries) > settings.PINAX_STRIPE_CATALOG_CACHE_SIZE:
+                    self._entries.popitem(last=False)
+        return found
+
+    @staticmethod
+    def fetch(model, stripe_ids, stripe_account=None):
+        """
+        Returns:
+            a dict of (Stripe id of the account or None, object) tuples by
+            Stripe id, the account being the one the object is cached under
+        """
+        if not hasattr(model, "stripe_account"):
+            return {obj.stripe_id: (None, obj) for obj in model.objects.filter(stripe_id__in=stripe_ids)}
+        qs = model.objects.filter(stripe_id__in=stripe_ids).select_related("stripe_account")
+        if stripe_account is not None:
+            qs = qs.filter(stripe_account__stripe_id=getattr(stripe_account, "stripe_id", stripe_account))
+        fetched = {}
+        for obj in qs:
+            if obj.stripe_account_id is None or obj.stripe_id not in fetched:
+                fetched[obj.stripe_id] = (obj.stripe_account_stripe_id, obj)
+        return fetched
+
+    def get(self, model, stripe_id, stripe_account=None):
+        """
+        Returns:
+            the object with the given Stripe id, see `get_many`
+
+        Raises:
+            model.DoesNotExist if there is none
+        """
+        obj = self.get_many(model, [stripe_id], stripe_account=stripe_account).get(stripe_id)
+        if obj is None:
+            raise model.DoesNotExist("{} matching stripe_id={!r} does not exist.".format(model._meta.object_name, stripe_id))
+        return obj
+
+    def invalidate(self, model=None, stripe_id=None):
+        """
+        Drop cached objects: all of them, those of a model, or the object of
+        a model with the given Stripe id whichever account it belongs to
+        """
+        label = self.label(model) if model is not None else None
+        with self._lock:
+            for key in list(self._entries):
+                if label is not None and key[0] != label:
+                    continue
+                if stripe_id is not None and key[2] != stripe_id:
+                    continue
+                del self._entries[key]
+
+    def stats(self):
+        """
+        Returns:
+            a dict with the number of lookups answered from the cache (`hits`)
+            and from the database (`misses`) since the process started or
+            `reset_stats` was called, and the number of cached objects (`size`)
+        """
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "size": len(self._entries)}
+
+    def reset_stats(self):
+        with self._lock:
+            self.hits = self.misses = 0
+
+
+cache = CatalogCache()
+get = cache.get
+get_many = cache.get_many
+invalidate = cache.invalidate
+stats = cache.stats
+reset_stats = cache.reset_stats
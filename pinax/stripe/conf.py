@@ -36,8 +36,39 @@ class PinaxStripeAppConf(AppConf):
     SEND_EMAIL_RECEIPTS = True
     SUBSCRIPTION_REQUIRED_EXCEPTION_URLS = []
     SUBSCRIPTION_REQUIRED_REDIRECT = None
+    SUBSCRIPTION_CACHE = "default"
+    SUBSCRIPTION_CACHE_TIMEOUT = 300
     SUBSCRIPTION_TAX_PERCENT = None
     DOCUMENT_MAX_SIZE_KB = 20 * 1024 * 1024
+    ENQUEUE_WEBHOOKS = False
+    WEBHOOK_VALIDATION = "retrieve"
+    WEBHOOK_SIGNING_SECRETS = []
+    WEBHOOK_SIGNATURE_TOLERANCE = 300
+    WEBHOOK_PAYLOAD_FIRST = False
+    HTTP_POOL_SIZE = 10
+    HTTP_CONNECT_TIMEOUT = 30
+    HTTP_READ_TIMEOUT = 80
+    HTTP_MAX_RETRIES = 0
+    RATE_LIMIT_ENABLED = False
+    RATE_LIMITS = {"live": 90, "test": 20}
+    RATE_LIMIT_BATCH_SHARE = 0.5
+    RATE_LIMIT_CACHE = "default"
+    RATE_LIMIT_RETRIES = 3
+    RATE_LIMIT_BACKOFF = 1
+    RATE_LIMIT_MAX_BACKOFF = 30
+    METRICS_BACKEND = "pinax.stripe.metrics.DefaultMetricsBackend"
+    BULK_CHUNK_SIZE = 500
+    EVENT_CLAIM_TIMEOUT = 300
+    EVENT_COALESCE_WINDOW = 0
+    EVENT_MAX_ATTEMPTS = 8
+    EVENT_RETRY_DELAY = 60
+    EVENT_RETRY_MAX_DELAY = 3600
+    EVENT_COMPRESSION = False
+    EVENT_RETENTION_DAYS = 90
+    EVENT_ARCHIVE_DIR = None
+    PRUNE_TRANSFER_EVENTS = False
+    CATALOG_CACHE_TTL = 300
+    CATALOG_CACHE_SIZE = 1000
 
     class Meta:
         prefix = "pinax_stripe"
@@ -53,3 +84,16 @@ class PinaxStripeAppConf(AppConf):
 
     def configure_hookset(self, value):
         return load_path_attr(value)()
+
+    def configure_metrics_backend(self, value):
+        return load_path_attr(value)()
+
+    def configure(self):
+        from .http_client import install
+        install(
+            pool_size=self.configured_data["HTTP_POOL_SIZE"],
+            connect_timeout=self.configured_data["HTTP_CONNECT_TIMEOUT"],
+            read_timeout=self.configured_data["HTTP_READ_TIMEOUT"],
+            max_retries=self.configured_data["HTTP_MAX_RETRIES"]
+        )
+        return self.configured_data
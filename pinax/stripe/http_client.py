@@ -0,0 +1,214 @@
+import contextlib
+import logging
+import threading
+import time
+
+import requests
+import stripe
+from requests.adapters import HTTPAdapter
+from stripe.http_client import RequestsClient
+
+from . import metrics, ratelimit
+from .conf import settings
+
+logger = logging.getLogger(__name__)
+
+_local = threading.local()
+
+
+class RequestCounter(object):
+
+    def __init__(self):
+        self.count = 0
+        self.duration = 0
+
+
+def _counters():
+    if not hasattr(_local, "counters"):
+        _local.counters = []
+    return _local.counters
+
+
+@contextlib.contextmanager
+def count_requests():
+    """
+    Count the requests sent to the Stripe API by the current thread
+
+    Scopes can be nested, a request is counted by every open scope.
+
+    Yields:
+        a RequestCounter whose `count` is the number of requests sent so far
+        and `duration` the seconds they took
+    """
+    counter = RequestCounter()
+    counters = _counters()
+    counters.append(counter)
+    try:
+        yield counter
+    finally:
+        counters.remove(counter)
+
+
+@contextlib.contextmanager
+def cache_requests():
+    """
+    Fetch each Stripe API object at most once within a unit of work
+
+    Successful GET requests (retrieve and list calls) sent by the current
+    thread are memoized by URL, which includes the resource, id and expand
+    parameters, and by Connect account and API key. Any other request empties
+    the cache, since it may change what a GET would return. Nested scopes
+    share the outermost cache.
+    """
+    if getattr(_local, "responses", None) is not None:
+        yield
+        return
+    _local.responses = {}
+    try:
+        yield
+    finally:
+        _local.responses = None
+
+
+class ThreadLocalSession(object):
+    """
+    A `requests.Session` per thread, each keeping a pool of connections alive
+    """
+
+    def __init__(self, pool_size=10, max_retries=0):
+        self.pool_size = pool_size
+        self.max_retries = max_retries
+        self._local = threading.local()
+
+    @property
+    def session(self):
+        if getattr(self._local, "session", None) is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(
+                pool_connections=self.pool_size,
+                pool_maxsize=self.pool_size,
+                max_retries=self.max_retries
+            )
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            self._local.session = session
+        return self._local.session
+
+    def request(self, *args, **kwargs):
+        return self.session.request(*args, **kwargs)
+
+    def close(self):
+        session = getattr(self._local, "session", None)
+        if session is not None:
+            session.close()
+            self._local.session = None
+
+
+class PooledRequestsClient(RequestsClient):
+    """
+    The stripe library's requests client, reusing connections through a
+    pooled session per thread
+
+    Args:
+        pool_size: the number of connections kept alive per thread
+        connect_timeout: seconds to wait for a connection to be established
+        read_timeout: seconds to wait for the response
+        max_retries: how many times to retry failed connections (requests
+                     that reached Stripe are not retried)
+    """
+
+    def __init__(self, pool_size=10, connect_timeout=30, read_timeout=80, max_retries=0, **kwargs):
+        super(PooledRequestsClient, self).__init__(
+            timeout=(connect_timeout, read_timeout),
+            session=ThreadLocalSession(pool_size=pool_size, max_retries=max_retries),
+            **kwargs
+        )
+
+
+class HTTPClient(object):
+    """
+    Wraps the HTTP client used by the stripe library, so that requests can be
+    counted (see `count_requests`) and cached (see `cache_requests`)
+    """
+
+    def __init__(self, client):
+        self.client = client
+
+    @property
+    def name(self):
+        return self.client.name
+
+    def request(self, method, url, headers, post_data=None):
+        responses = getattr(_local, "responses", None)
+        key = None
+        if responses is not None:
+            if method.lower() == "get":
+                key = (url, headers.get("Stripe-Account"), headers.get("Authorization"))
+                if key in responses:
+                    return responses[key]
+            else:
+                responses.clear()
+
+        response = self.send(method, url, headers, post_data)
+
+        if key is not None and 200 <= response[1] < 300:
+            responses[key] = response
+        return response
+
+    def send(self, method, url, headers, post_data=None):
+        """
+        Send a request within the rate limits when they are enabled, retrying
+        it after a backoff when Stripe answers with a 429
+        """
+        limited = settings.PINAX_STRIPE_RATE_LIMIT_ENABLED
+        retries = 0
+        status = None
+        started = time.time()
+        try:
+            while True:
+                if limited:
+                    ratelimit.acquire(headers)
+                for counter in _counters():
+                    counter.count += 1
+                response = self.client.request(method, url, headers, post_data)
+                status = response[1]
+                if status != 429 or not limited:
+                    return response
+                delay = ratelimit.backoff(headers)
+                if retries >= settings.PINAX_STRIPE_RATE_LIMIT_RETRIES:
+                    return response
+                retries += 1
+                logger.info("Rate limited by Stripe, retrying %s %s in %ss", method.upper(), url, delay)
+        finally:
+            duration = time.time() - started
+            for counter in _counters():
+                counter.duration += duration
+            settings.PINAX_STRIPE_METRICS_BACKEND.api_call(
+                resource=metrics.get_resource(url),
+                method=method.lower(),
+                duration=duration,
+                status=status,
+                retries=retries,
+                action=metrics.get_action()
+            )
+
+    def close(self):
+        self.client.close()
+
+
+def install(**kwargs):
+    """
+    Route the requests of the stripe library through HTTPClient, wrapping the
+    client that was configured, or else a PooledRequestsClient
+
+    Args:
+        kwargs: the arguments of the PooledRequestsClient
+    """
+    if not isinstance(stripe.default_http_client, HTTPClient):
+        client = stripe.default_http_client or PooledRequestsClient(
+            verify_ssl_certs=stripe.verify_ssl_certs,
+            proxy=getattr(stripe, "proxy", None),
+            **kwargs
+        )
+        stripe.default_http_client = HTTPClient(client)
+    return stripe.default_http_client
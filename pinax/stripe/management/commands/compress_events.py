@@ -0,0 +1,72 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from ...conf import settings
+from ...models import Event
+
+
+class Command(BaseCommand):
+
+    help = "Convert the messages of existing events to compressed storage, or back"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size", type=int, default=500,
+            help="Number of events converted per transaction (default: 500)"
+        )
+        parser.add_argument(
+            "--decompress", action="store_true", default=False,
+            help="Store the messages in their own columns again"
+        )
+
+    def handle(self, *args, **options):
+        decompress = options["decompress"]
+        if bool(settings.PINAX_STRIPE_EVENT_COMPRESSION) == decompress:
+            self.stderr.write("Warning: PINAX_STRIPE_EVENT_COMPRESSION is {0}, events saved from now on will be {1} again\n".format(
+                settings.PINAX_STRIPE_EVENT_COMPRESSION,
+                "compressed" if decompress else "decompressed"
+            ))
+
+        qs = Event.objects.filter(compressed_messages__isnull=not decompress).order_by("pk")
+        count = 0
+        before = after = 0
+        last_pk = 0
+        while True:
+            batch = list(qs.filter(pk__gt=last_pk)[:options["batch_size"]])
+            if not batch:
+                break
+            with transaction.atomic():
+                for event in batch:
+                    size = self.size(event)
+                    if decompress:
+                        event.expand_messages()
+                    else:
+                        event.compress_messages()
+                    # the messages are written as they are, whatever the setting
+                    Event.objects.filter(pk=event.pk).update(
+                        webhook_message=None if event.compressed_messages is not None else event.webhook_message,
+                        validated_message=None if event.compressed_messages is not None else event.validated_message,
+                        compressed_messages=event.compressed_messages
+                    )
+                    before += size
+                    after += self.size(event)
+            count += len(batch)
+            last_pk = batch[-1].pk
+            self.stdout.write("{0} {1} event(s)\n".format("Decompressed" if decompress else "Compressed", count))
+
+        self.stdout.write("{0} {1} event(s) from {2} to {3} bytes\n".format(
+            "Decompressed" if decompress else "Compressed",
+            count,
+            before,
+            after
+        ))
+
+    def size(self, event):
+        if event.compressed_messages is not None:
+            return len(event.compressed_messages)
+        field = Event._meta.get_field("webhook_message")
+        return sum(
+            len(field.get_db_prep_value(message, None))
+            for message in [event.webhook_message, event.validated_message]
+            if message is not None
+        )
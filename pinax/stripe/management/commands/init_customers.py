@@ -1,6 +1,7 @@
 from django.contrib.auth import get_user_model
 from django.core.management.base import BaseCommand
 
+from ... import ratelimit
 from ...actions import customers
 
 
@@ -11,5 +12,6 @@ class Command(BaseCommand):
     def handle(self, *args, **options):
         User = get_user_model()
         for user in User.objects.filter(customer__isnull=True):
-            customers.create(user=user)
+            with ratelimit.priority(ratelimit.BATCH):
+                customers.create(user=user)
             self.stdout.write("Created customer for {0}\n".format(user.email))
@@ -0,0 +1,144 @@
+import threading
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from six.moves import queue
+
+from ...actions import events
+
+
+class Command(BaseCommand):
+
+    help = "Process events that were recorded by the webhook view but not processed yet"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--workers", type=int, default=1,
+            help="Number of worker threads processing events (default: 1)"
+        )
+        parser.add_argument(
+            "--batch-size", type=int, default=100,
+            help="Number of events claimed per query (default: 100)"
+        )
+        parser.add_argument(
+            "--loop", action="store_true", default=False,
+            help="Keep polling for new events instead of exiting once drained"
+        )
+        parser.add_argument(
+            "--poll-interval", type=float, default=5,
+            help="Seconds to wait between polls when --loop is given (default: 5)"
+        )
+
+    def handle(self, *args, **options):
+        self.workers = max(options["workers"], 1)
+        self.lock = threading.Lock()
+        self.stats = {}
+        self.coalesced = 0
+        self.worker = events.worker_name()
+        batch_size = options["batch_size"]
+        poll_interval = options["poll_interval"]
+        processed = 0
+        while True:
+            waiting = False
+            # the partition keys that failed in this pass, and their events
+            # left unprocessed
+            self.failed = set()
+            self.held = []
+            while True:
+                claimed = events.claim_events(self.worker, batch_size)
+                if not claimed:
+                    break
+                groups, deferred = events.group_claimed_events(claimed, self.worker)
+                if deferred:
+                    # an earlier event of the same customer is being processed elsewhere
+                    events.defer_events(deferred, poll_interval)
+                    waiting = True
+                processed += self.process_groups(groups)
+                if not groups:
+                    break
+            if self.held:
+                # claimed again in the next pass, once any retry is due
+                events.defer_events(self.held, 0)
+            if not (options["loop"] or waiting):
+                break
+            time.sleep(poll_interval)
+        self.stdout.write("Processed {0} event(s)\n".format(processed))
+        if self.coalesced:
+            self.stdout.write("Coalesced {0} event(s) with a newer event about the same object\n".format(self.coalesced))
+        for name, (count, elapsed) in sorted(self.stats.items()):
+            self.stdout.write("Worker {0}: {1} event(s) in {2:.1f}s ({3:.1f}/s)\n".format(
+                name,
+                count,
+                elapsed,
+                count / max(elapsed, 0.001)
+            ))
+
+    def process_groups(self, groups):
+        if self.workers == 1:
+            return self.process_worker(self.worker, groups)
+
+        work = queue.Queue()
+        for group in groups:
+            work.put(group)
+        results = []
+
+        def worker(name):
+            try:
+                results.append(self.process_worker(name, iter(lambda: self.next_group(work), None)))
+            finally:
+                connection.close()
+
+        threads = [
+            threading.Thread(target=worker, args=("{}#{}".format(self.worker, i + 1),))
+            for i in range(min(self.workers, len(groups)))
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return sum(results)
+
+    def next_group(self, work):
+        try:
+            return work.get_nowait()
+        except queue.Empty:
+            return None
+
+    def process_worker(self, name, groups):
+        started = time.time()
+        count = sum(self.process_group(group) for group in groups)
+        with self.lock:
+            total, elapsed = self.stats.get(name, (0, 0))
+            self.stats[name] = (total + count, elapsed + time.time() - started)
+        return count
+
+    def process_group(self, group):
+        # after a failure the rest of the group, and the later groups of the
+        # same partition key, are left for the next pass
+        key = group[0].partition_key
+        done = set()
+        for coalesced in events.coalesce_events(group):
+            if key and key in self.failed:
+                break
+            if not self.process_one(coalesced):
+                with self.lock:
+                    self.failed.add(key)
+                break
+            done.update(event.pk for event in coalesced)
+        if len(done) < len(group):
+            with self.lock:
+                self.held.extend(event for event in group if event.pk not in done)
+        return len(done)
+
+    def process_one(self, coalesced):
+        try:
+            events.process_coalesced(coalesced)
+        except Exception as e:
+            self.stderr.write("Error processing {0}: {1}\n".format(coalesced[-1].stripe_id, e))
+            return 0
+        if len(coalesced) > 1:
+            with self.lock:
+                self.coalesced += len(coalesced) - 1
+        return 1
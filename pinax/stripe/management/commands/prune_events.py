@@ -0,0 +1,173 @@
+import collections
+import datetime
+import gzip
+import json
+import os
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+from django.db.models import Count, Q
+from django.utils import timezone
+
+from ...conf import settings
+from ...models import Event, EventProcessingException, Transfer
+
+
+class Command(BaseCommand):
+
+    help = "Archive and delete processed events older than the retention period"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--days", type=int,
+            help="Prune events received more than this many days ago (default: PINAX_STRIPE_EVENT_RETENTION_DAYS)"
+        )
+        parser.add_argument(
+            "--archive-dir",
+            help="Directory the archive is written to (default: PINAX_STRIPE_EVENT_ARCHIVE_DIR)"
+        )
+        parser.add_argument(
+            "--no-archive", action="store_true", default=False,
+            help="Delete the events without archiving them"
+        )
+        parser.add_argument(
+            "--batch-size", type=int, default=500,
+            help="Number of events archived and deleted per transaction (default: 500)"
+        )
+        parser.add_argument(
+            "--sleep", type=float, default=0,
+            help="Seconds to wait between batches, to let other queries and replicas catch up (default: 0)"
+        )
+        parser.add_argument(
+            "--dry-run", action="store_true", default=False,
+            help="Only report what would be pruned"
+        )
+
+    def handle(self, *args, **options):
+        days = options["days"] if options["days"] is not None else settings.PINAX_STRIPE_EVENT_RETENTION_DAYS
+        cutoff = timezone.now() - datetime.timedelta(days=days)
+        archive_dir = options["archive_dir"] or settings.PINAX_STRIPE_EVENT_ARCHIVE_DIR
+        if not (archive_dir or options["no_archive"] or options["dry_run"]):
+            raise CommandError("Give an --archive-dir (or set PINAX_STRIPE_EVENT_ARCHIVE_DIR), or --no-archive")
+
+        # processed events, and events that failed validation and never will be
+        events = Event.objects.filter(Q(processed=True) | Q(valid=False), created_at__lt=cutoff)
+        transfer_events = Transfer.objects.filter(event__isnull=False).values("event")
+        referenced = events.filter(pk__in=transfer_events)
+        if not settings.PINAX_STRIPE_PRUNE_TRANSFER_EVENTS:
+            events = events.exclude(pk__in=transfer_events)
+        exceptions = EventProcessingException.objects.filter(event__isnull=True, created_at__lt=cutoff)
+
+        if options["dry_run"]:
+            self.report(events, referenced, exceptions, cutoff)
+            return
+
+        archive = None
+        if not options["no_archive"]:
+            path = os.path.join(archive_dir, "events-{0:%Y%m%dT%H%M%S}.ndjson.gz".format(timezone.now()))
+            archive = gzip.open(path, "wb")
+        try:
+            count = self.prune_events(events, archive, options["batch_size"], options["sleep"])
+            exception_count = self.prune_exceptions(exceptions, archive, options["batch_size"], options["sleep"])
+        finally:
+            if archive is not None:
+                archive.close()
+
+        self.stdout.write("Pruned {0} event(s) and {1} unlinked processing exception(s) received before {2:%Y-%m-%d %H:%M}\n".format(
+            count,
+            exception_count,
+            cutoff
+        ))
+        if archive is not None:
+            self.stdout.write("Archived to {0}\n".format(path))
+
+    def report(self, events, referenced, exceptions, cutoff):
+        self.stdout.write("Would prune {0} event(s) and {1} unlinked processing exception(s) received before {2:%Y-%m-%d %H:%M}\n".format(
+            events.count(),
+            exceptions.count(),
+            cutoff
+        ))
+        kinds = events.order_by().values("kind").annotate(count=Count("pk")).order_by("-count", "kind")
+        for row in kinds:
+            self.stdout.write("  {0}: {1}\n".format(row["kind"], row["count"]))
+        if settings.PINAX_STRIPE_PRUNE_TRANSFER_EVENTS:
+            self.stdout.write("Would unlink {0} event(s) from their transfers\n".format(referenced.count()))
+        else:
+            self.stdout.write("Keeping {0} event(s) referenced by transfers\n".format(referenced.count()))
+
+    def prune_events(self, events, archive, batch_size, sleep):
+        count = 0
+        last_pk = 0
+        while True:
+            batch = list(events.filter(pk__gt=last_pk).select_related("customer", "stripe_account").order_by("pk")[:batch_size])
+            if not batch:
+                return count
+            pks = [event.pk for event in batch]
+            if archive is not None:
+                by_event = collections.defaultdict(list)
+                for exception in EventProcessingException.objects.filter(event__in=pks).order_by("pk"):
+                    by_event[exception.event_id].append(self.exception_record(exception))
+                for event in batch:
+                    self.write(archive, self.event_record(event, by_event[event.pk]))
+                # the batch is on disk before it is deleted
+                archive.flush()
+            with transaction.atomic():
+                if settings.PINAX_STRIPE_PRUNE_TRANSFER_EVENTS:
+                    Transfer.objects.filter(event__in=pks).update(event=None)
+                EventProcessingException.objects.filter(event__in=pks).delete()
+                # filtered again, in case a transfer referenced an event since
+                events.filter(pk__in=pks).delete()
+            count += len(batch)
+            last_pk = pks[-1]
+            self.stdout.write("Pruned {0} event(s)\n".format(count))
+            if sleep:
+                time.sleep(sleep)
+
+    def prune_exceptions(self, exceptions, archive, batch_size, sleep):
+        count = 0
+        while True:
+            batch = list(exceptions.order_by("pk")[:batch_size])
+            if not batch:
+                return count
+            if archive is not None:
+                for exception in batch:
+                    self.write(archive, dict(self.exception_record(exception), object="event_processing_exception"))
+                archive.flush()
+            EventProcessingException.objects.filter(pk__in=[exception.pk for exception in batch]).delete()
+            count += len(batch)
+            if sleep:
+                time.sleep(sleep)
+
+    def event_record(self, event, exceptions):
+        return {
+            "object": "event",
+            "id": event.pk,
+            "stripe_id": event.stripe_id,
+            "created_at": event.created_at,
+            "kind": event.kind,
+            "livemode": event.livemode,
+            "customer": event.customer.stripe_id if event.customer else None,
+            "stripe_account": event.stripe_account_stripe_id,
+            "webhook_message": event.webhook_message,
+            "validated_message": event.validated_message,
+            "valid": event.valid,
+            "processed": event.processed,
+            "request": event.request,
+            "pending_webhooks": event.pending_webhooks,
+            "api_version": event.api_version,
+            "exceptions": exceptions,
+        }
+
+    def exception_record(self, exception):
+        return {
+            "id": exception.pk,
+            "created_at": exception.created_at,
+            "message": exception.message,
+            "data": exception.data,
+            "traceback": exception.traceback,
+        }
+
+    def write(self, archive, record):
+        archive.write((json.dumps(record, sort_keys=True, cls=DjangoJSONEncoder) + "\n").encode("utf-8"))
@@ -1,5 +1,6 @@
 from django.core.management.base import BaseCommand
 
+from ... import ratelimit
 from ...actions import coupons
 
 
@@ -8,4 +9,10 @@ class Command(BaseCommand):
     help = "Make sure your Stripe account has the coupons"
 
     def handle(self, *args, **options):
-        coupons.sync_coupons()
+        with ratelimit.priority(ratelimit.BATCH):
+            summary = coupons.sync_coupons()
+        self.stdout.write("{0} coupon(s) created, {1} updated, {2} unchanged\n".format(
+            summary.created,
+            summary.updated,
+            summary.unchanged
+        ))
@@ -1,37 +1,166 @@
-from django.contrib.auth import get_user_model
-from django.core.management.base import BaseCommand
+import datetime
+import threading
+import time
 
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.utils import timezone
+from django.utils.dateparse import parse_date
+
+from six.moves import queue
 from stripe.error import InvalidRequestError
 
+from ... import ratelimit
 from ...actions import customers, charges, invoices, orders
+from ...conf import settings
+from ...http_client import cache_requests
+from ...models import Customer, SyncCheckpoint
 
 
 class Command(BaseCommand):
 
     help = "Sync customer data"
 
+    checkpoint_name = "sync_customers"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--workers", type=int, default=1,
+            help="Number of worker threads syncing customers (default: 1)"
+        )
+        parser.add_argument(
+            "--chunk-size", type=int, default=500,
+            help="Number of customers read per query, the checkpoint is saved after each chunk (default: 500)"
+        )
+        parser.add_argument(
+            "--resume", action="store_true", default=False,
+            help="Continue an interrupted run after the last checkpoint instead of starting over"
+        )
+        parser.add_argument(
+            "--since",
+            help="Only sync customers created on or after this date (YYYY-MM-DD)"
+        )
+
     def handle(self, *args, **options):
-        User = get_user_model()
-        qs = User.objects.exclude(customer__isnull=True)
-        count = 0
-        total = qs.count()
-        for user in qs:
-            count += 1
-            perc = int(round(100 * (float(count) / float(total))))
-            username = getattr(user, user.USERNAME_FIELD)
-            self.stdout.write(u"[{0}/{1} {2}%] Syncing {3} [{4}]\n".format(
-                count, total, perc, username, user.pk
+        self.workers = max(options["workers"], 1)
+        self.lock = threading.Lock()
+
+        qs = Customer.objects.filter(user__isnull=False)
+        if options["since"]:
+            since = parse_date(options["since"])
+            if since is None:
+                raise CommandError("--since must be a date formatted as YYYY-MM-DD")
+            since = datetime.datetime.combine(since, datetime.time())
+            if settings.USE_TZ:
+                since = timezone.make_aware(since, timezone.utc)
+            qs = qs.filter(created_at__gte=since)
+
+        checkpoint = self.get_checkpoint(options["resume"])
+        last_pk = int(checkpoint.cursor or 0)
+
+        self.total = qs.count()
+        self.count = qs.filter(pk__lte=last_pk).count() if last_pk else 0
+        self.synced = 0
+        self.started = time.time()
+        if last_pk:
+            self.stdout.write("Resuming after customer {0} ({1} already synced)\n".format(last_pk, self.count))
+
+        while True:
+            chunk = list(qs.filter(pk__gt=last_pk).select_related("user").order_by("pk")[:options["chunk_size"]])
+            if not chunk:
+                break
+            self.sync_chunk(chunk)
+            last_pk = chunk[-1].pk
+            checkpoint.cursor = str(last_pk)
+            checkpoint.updated_at = timezone.now()
+            checkpoint.save()
+
+        checkpoint.completed_at = timezone.now()
+        checkpoint.save()
+
+    def get_checkpoint(self, resume):
+        checkpoint, created = SyncCheckpoint.objects.get_or_create(name=self.checkpoint_name)
+        if created or (resume and checkpoint.completed_at is None):
+            return checkpoint
+        checkpoint.cursor = ""
+        checkpoint.started_at = checkpoint.updated_at = timezone.now()
+        checkpoint.completed_at = None
+        checkpoint.save()
+        return checkpoint
+
+    def sync_chunk(self, chunk):
+        if self.workers == 1:
+            for customer in chunk:
+                self.sync_one(customer)
+            return
+
+        work = queue.Queue()
+        for customer in chunk:
+            work.put(customer)
+        errors = []
+        threads = [
+            threading.Thread(target=self.sync_worker, args=(work, errors))
+            for _ in range(min(self.workers, len(chunk)))
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if errors:
+            # the checkpoint is not moved past this chunk
+            raise errors[0]
+
+    def sync_worker(self, work, errors):
+        """
+        Sync customers from the queue until it is empty or a worker failed
+        """
+        try:
+            while not errors:
+                try:
+                    customer = work.get_nowait()
+                except queue.Empty:
+                    return
+                try:
+                    self.sync_one(customer)
+                except Exception as e:
+                    errors.append(e)
+        finally:
+            connection.close()
+
+    def sync_one(self, customer):
+        # purging a customer unlinks its user
+        user = customer.user
+        with cache_requests(), ratelimit.priority(ratelimit.BATCH):
+            self.sync(customer)
+        self.report(user)
+
+    def sync(self, customer):
+        try:
+            customers.sync_customer(customer)
+        except InvalidRequestError as exc:
+            if exc.http_status == 404:  # pragma: no branch
+                # This user doesn't exist (might be in test mode)
+                return
+            raise exc
+
+        if customer.date_purged is None:
+            invoices.sync_invoices_for_customer(customer)
+            charges.sync_charges_for_customer(customer)
+            orders.sync_orders_from_customer(customer)
+
+    def report(self, user):
+        with self.lock:
+            self.count += 1
+            self.synced += 1
+            count = self.count
+            rate = self.synced / max(time.time() - self.started, 0.001)
+            eta = datetime.timedelta(seconds=int((self.total - count) / rate))
+            self.stdout.write(u"[{0}/{1} {2}%] Synced {3} [{4}] {5:.1f}/s, ETA {6}\n".format(
+                count,
+                self.total,
+                int(round(100 * (float(count) / float(max(self.total, 1))))),
+                getattr(user, user.USERNAME_FIELD),
+                user.pk,
+                rate,
+                eta
             ))
-            customer = customers.get_customer_for_user(user)
-            try:
-                customers.sync_customer(customer)
-            except InvalidRequestError as exc:
-                if exc.http_status == 404:  # pragma: no branch
-                    # This user doesn't exist (might be in test mode)
-                    continue
-                raise exc
-
-            if customer.date_purged is None:
-                invoices.sync_invoices_for_customer(customer)
-                charges.sync_charges_for_customer(customer)
-                orders.sync_orders_from_customer(customer)
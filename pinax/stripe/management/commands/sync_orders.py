@@ -1,5 +1,6 @@
 from django.core.management.base import BaseCommand
 
+from ... import ratelimit
 from ...actions import orders
 
 
@@ -8,4 +9,5 @@ class Command(BaseCommand):
     help = "Sync up your local orders with stripe"
 
     def handle(self, *args, **options):
-        orders.sync_orders()
+        with ratelimit.priority(ratelimit.BATCH):
+            orders.sync_orders()
@@ -1,5 +1,6 @@
 from django.core.management.base import BaseCommand
 
+from ... import ratelimit
 from ...actions import plans
 
 
@@ -8,4 +9,10 @@ class Command(BaseCommand):
     help = "Make sure your Stripe account has the plans"
 
     def handle(self, *args, **options):
-        plans.sync_plans()
+        with ratelimit.priority(ratelimit.BATCH):
+            summary = plans.sync_plans()
+        self.stdout.write("{0} plan(s) created, {1} updated, {2} unchanged\n".format(
+            summary.created,
+            summary.updated,
+            summary.unchanged
+        ))
@@ -1,5 +1,6 @@
 from django.core.management.base import BaseCommand
 
+from ... import ratelimit
 from ...actions import products, skus
 
 
@@ -8,4 +9,10 @@ class Command(BaseCommand):
     help = "Make sure your Stripe account has products"
 
     def handle(self, *args, **options):
-        products.sync_products()
+        with ratelimit.priority(ratelimit.BATCH):
+            summary = products.sync_products()
+        self.stdout.write("{0} product(s) created, {1} updated, {2} unchanged\n".format(
+            summary.created,
+            summary.updated,
+            summary.unchanged
+        ))
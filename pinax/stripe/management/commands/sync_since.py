@@ -0,0 +1,35 @@
+import calendar
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.dateparse import parse_date
+
+from ... import ratelimit
+from ...actions import events
+
+
+class Command(BaseCommand):
+
+    help = "Add and process the events that were missed by the webhook view since the previous run"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--since",
+            help="List the events created on or after this date (YYYY-MM-DD) instead of since the previous run"
+        )
+        parser.add_argument(
+            "--account", action="append", default=[],
+            help="Stripe id of a connected account whose events to sync, can be repeated"
+        )
+
+    def handle(self, *args, **options):
+        created = None
+        if options["since"]:
+            since = parse_date(options["since"])
+            if since is None:
+                raise CommandError("--since must be a date formatted as YYYY-MM-DD")
+            created = calendar.timegm(since.timetuple())
+        added = 0
+        with ratelimit.priority(ratelimit.BATCH):
+            for stripe_account in [None] + options["account"]:
+                added += events.sync_since(created=created, stripe_account=stripe_account)
+        self.stdout.write("Added {0} event(s)\n".format(added))
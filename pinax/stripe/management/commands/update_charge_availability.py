@@ -1,5 +1,6 @@
 from django.core.management.base import BaseCommand
 
+from ... import ratelimit
 from ...actions import charges
 
 
@@ -7,5 +8,14 @@ class Command(BaseCommand):
 
     help = "Check for newly available Charges."
 
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--balance-transactions", action="store_true", default=False,
+            help="List the available balance transactions of each account instead of retrieving every pending charge"
+        )
+
     def handle(self, *args, **options):
-        charges.update_charge_availability()
+        with ratelimit.priority(ratelimit.BATCH):
+            charges.update_charge_availability(
+                from_balance_transactions=options["balance_transactions"]
+            )
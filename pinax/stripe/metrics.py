@@ -0,0 +1,128 @@
+import contextlib
+import logging
+import sys
+import time
+
+from django.db import connection
+
+from six.moves.urllib.parse import urlparse
+
+logger = logging.getLogger(__name__)
+
+
+class DefaultMetricsBackend(object):
+    """
+    Receives measurements of Stripe API requests and webhook processing
+
+    Set PINAX_STRIPE_METRICS_BACKEND to a subclass implementing the methods
+    you care about to send them to your metrics system.
+    """
+
+    def api_call(self, resource, method, duration, status, retries, action):
+        """
+        Called after each request sent to the Stripe API
+
+        Args:
+            resource: the path of the resource without ids, e.g. "charges" or
+                      "customers/sources"
+            method: the HTTP method, e.g. "get"
+            duration: seconds spent sending the request, including retries and
+                      rate limiting
+            status: the HTTP status of the response
+            retries: the number of times the request was retried
+            action: the pinax.stripe function that made the request, e.g.
+                    "charges.create", or None
+        """
+
+    def webhook(self, name, duration, validate_time, db_time, api_time, api_calls):
+        """
+        Called after each event processed by a webhook
+
+        Args:
+            name: the name of the webhook, e.g. "invoice.payment_succeeded"
+            duration: seconds spent processing the event
+            validate_time: seconds spent validating the event
+            db_time: seconds spent in database queries (with Django < 2.0, the
+                     time not spent in Stripe API requests)
+            api_time: seconds spent in Stripe API requests
+            api_calls: the number of Stripe API requests
+        """
+
+
+class LoggingMetricsBackend(DefaultMetricsBackend):
+
+    def api_call(self, resource, method, duration, status, retries, action):
+        logger.info(
+            "stripe api %s %s status=%s duration=%.3f retries=%s action=%s",
+            method.upper(), resource, status, duration, retries, action
+        )
+
+    def webhook(self, name, duration, validate_time, db_time, api_time, api_calls):
+        logger.info(
+            "stripe webhook %s duration=%.3f validate=%.3f db=%.3f api=%.3f api_calls=%s",
+            name, duration, validate_time, db_time, api_time, api_calls
+        )
+
+
+def get_resource(url):
+    """
+    Stripe paths alternate between resources and ids, e.g.
+    /v1/customers/cus_XXX/sources/card_XXX is "customers/sources"
+    """
+    segments = urlparse(url).path.strip("/").split("/")[1:]
+    return "/".join(segments[::2])
+
+
+def get_action(frame=None):
+    """
+    Returns:
+        the outermost pinax.stripe.actions function on the stack, e.g.
+        "charges.create", or else the innermost other pinax.stripe function
+    """
+    frame = frame or sys._getframe(1)
+    action = caller = None
+    while frame is not None:
+        module = frame.f_globals.get("__name__", "")
+        if module.startswith("pinax.stripe.actions."):
+            action = "{}.{}".format(module[len("pinax.stripe.actions."):], frame.f_code.co_name)
+        elif caller is None and module.startswith("pinax.stripe.") and module not in INSTRUMENTATION_MODULES:
+            caller = "{}.{}".format(module[len("pinax.stripe."):], frame.f_code.co_name)
+        frame = frame.f_back
+    return action or caller
+
+
+INSTRUMENTATION_MODULES = [
+    "pinax.stripe.http_client",
+    "pinax.stripe.metrics",
+    "pinax.stripe.ratelimit",
+]
+
+
+class QueryTimer(object):
+
+    def __init__(self):
+        self.duration = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.time()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.duration += time.time() - started
+
+
+@contextlib.contextmanager
+def time_queries():
+    """
+    Time the database queries run on the default connection
+
+    Yields:
+        a QueryTimer whose `duration` is the time spent in queries so far, or
+        None if the Django version cannot time queries
+    """
+    if not hasattr(connection, "execute_wrapper"):
+        yield None
+        return
+    timer = QueryTimer()
+    with connection.execute_wrapper(timer):
+        yield timer
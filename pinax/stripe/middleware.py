@@ -1,7 +1,7 @@
 import django
 from django.shortcuts import redirect
 
-from .actions import customers, subscriptions
+from .actions import subscriptions
 from .conf import settings
 
 try:
@@ -16,6 +16,20 @@ except ImportError:
 
 
 class ActiveSubscriptionMiddleware(MixinorObject):
+    """
+    Redirects the requests of users without an active subscription to
+    PINAX_STRIPE_SUBSCRIPTION_REQUIRED_REDIRECT, except for the URL names in
+    PINAX_STRIPE_SUBSCRIPTION_REQUIRED_EXCEPTION_URLS (read once, when the
+    middleware is loaded)
+
+    Whether a user has an active subscription is cached, see
+    `pinax.stripe.actions.subscriptions.user_has_active_subscription`; the URL
+    is only resolved for users without one.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(ActiveSubscriptionMiddleware, self).__init__(*args, **kwargs)
+        self.exception_urls = frozenset(settings.PINAX_STRIPE_SUBSCRIPTION_REQUIRED_EXCEPTION_URLS)
 
     def process_request(self, request):
         is_authenticated = request.user.is_authenticated
@@ -23,10 +37,10 @@ class ActiveSubscriptionMiddleware(MixinorObject):
             is_authenticated = is_authenticated()
 
         if is_authenticated and not request.user.is_staff:
+            if subscriptions.user_has_active_subscription(request.user):
+                return
             url_name = resolve(request.path).url_name
-            if url_name not in settings.PINAX_STRIPE_SUBSCRIPTION_REQUIRED_EXCEPTION_URLS:
-                customer = customers.get_customer_for_user(request.user)
-                if not subscriptions.has_active_subscription(customer):
-                    return redirect(
-                        settings.PINAX_STRIPE_SUBSCRIPTION_REQUIRED_REDIRECT
-                    )
+            if url_name not in self.exception_urls:
+                return redirect(
+                    settings.PINAX_STRIPE_SUBSCRIPTION_REQUIRED_REDIRECT
+                )
@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-16 20:38
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import pinax.stripe.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pinax_stripe', '0021_event_retries'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='event',
+            name='compressed_messages',
+            field=models.BinaryField(blank=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name='event',
+            name='validated_message',
+            field=pinax.stripe.models.EventMessageField(blank=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name='event',
+            name='webhook_message',
+            field=pinax.stripe.models.EventMessageField(),
+        ),
+    ]
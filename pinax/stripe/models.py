@@ -1,6 +1,8 @@
 from __future__ import unicode_literals
 
 import decimal
+import json
+import zlib
 
 from django.core.exceptions import ValidationError
 from django.db import models
@@ -142,24 +144,118 @@ class EventProcessingException(models.Model):
         return "<{}, pk={}, Event={}>".format(self.message, self.pk, self.event)
 
 
+class EventMessageField(JSONField):
+    """
+    A message of an Event, which is not stored in its own column while the
+    Event keeps its messages in `compressed_messages`
+    """
+
+    def pre_save(self, model_instance, add):
+        if model_instance.compressed_messages is not None:
+            return None
+        return super(EventMessageField, self).pre_save(model_instance, add)
+
+
+class CompressedEventMessage(object):
+    """
+    Gives access to a message of an Event, decompressing the messages the
+    first time one of them is read
+    """
+
+    def __init__(self, field):
+        self.field = field
+
+    def __get__(self, obj, type=None):
+        if obj is None:
+            raise AttributeError("Can only be accessed via an instance.")
+        if self.field.name not in obj.__dict__:
+            # deferred
+            obj.refresh_from_db(fields=[self.field.name])
+        if obj.compressed_messages is not None and not obj.__dict__.get("_messages_loaded"):
+            obj.load_compressed_messages()
+        return obj.__dict__[self.field.name]
+
+    def __set__(self, obj, value):
+        if not obj._state.adding:
+            # set after being loaded, not to be overwritten by the compressed message
+            obj.__dict__.setdefault("_messages_set", set()).add(self.field.name)
+        obj.__dict__[self.field.name] = self.field.pre_init(value, obj)
+
+
 @python_2_unicode_compatible
 class Event(AccountRelatedStripeObject):
 
     kind = models.CharField(max_length=250)
     livemode = models.BooleanField(default=False)
     customer = models.ForeignKey("Customer", null=True, blank=True, on_delete=models.CASCADE)
-    webhook_message = JSONField()
-    validated_message = JSONField(null=True, blank=True)
+    webhook_message = EventMessageField()
+    validated_message = EventMessageField(null=True, blank=True)
+    # zlib compressed JSON of the messages, kept instead of the message
+    # columns while PINAX_STRIPE_EVENT_COMPRESSION is enabled
+    compressed_messages = models.BinaryField(null=True, blank=True, editable=False)
     valid = models.NullBooleanField(null=True, blank=True)
     processed = models.BooleanField(default=False)
     request = models.CharField(max_length=100, blank=True)
     pending_webhooks = models.PositiveIntegerField(default=0)
     api_version = models.CharField(max_length=100, blank=True)
+    # the customer (or else the object) the event is about; the events
+    # sharing it are processed in order by the process_events command
+    partition_key = models.CharField(max_length=191, blank=True, db_index=True)
+    # the process_events worker processing the event, and since when
+    claimed_by = models.CharField(max_length=100, blank=True)
+    claimed_at = models.DateTimeField(null=True, blank=True)
+    # failed processing attempts, retried by process_events from
+    # next_attempt_at on until PINAX_STRIPE_EVENT_MAX_ATTEMPTS is reached
+    attempts = models.PositiveIntegerField(default=0)
+    next_attempt_at = models.DateTimeField(null=True, blank=True, db_index=True)
+    last_error = models.TextField(blank=True)
+    dead_lettered_at = models.DateTimeField(null=True, blank=True)
 
     @property
     def message(self):
         return self.validated_message
 
+    def compress_messages(self):
+        """
+        Keep the messages in `compressed_messages`; the validated message is
+        only included when it differs from the webhook message
+        """
+        messages = {"webhook_message": self.webhook_message}
+        if self.validated_message != self.webhook_message:
+            messages["validated_message"] = self.validated_message
+        self.compressed_messages = zlib.compress(json.dumps(messages, separators=(",", ":")).encode("utf-8"))
+        self.__dict__["_messages_loaded"] = True
+
+    def expand_messages(self):
+        """
+        Keep the messages in their own columns again
+        """
+        if self.compressed_messages is not None and not self.__dict__.get("_messages_loaded"):
+            self.load_compressed_messages()
+        self.compressed_messages = None
+
+    def load_compressed_messages(self):
+        messages = json.loads(zlib.decompress(bytes(self.compressed_messages)).decode("utf-8"))
+        messages.setdefault("validated_message", messages["webhook_message"])
+        overridden = self.__dict__.get("_messages_set", ())
+        for name, value in messages.items():
+            if name not in overridden:
+                self.__dict__[name] = value
+        self.__dict__["_messages_loaded"] = True
+
+    def save(self, *args, **kwargs):
+        update_fields = kwargs.get("update_fields")
+        saves_messages = update_fields is None or {"webhook_message", "validated_message"} & set(update_fields)
+        if saves_messages and (settings.PINAX_STRIPE_EVENT_COMPRESSION or self.compressed_messages is not None):
+            if settings.PINAX_STRIPE_EVENT_COMPRESSION:
+                self.compress_messages()
+            else:
+                self.expand_messages()
+            if update_fields is not None:
+                # the messages move between their columns and compressed_messages
+                kwargs["update_fields"] = set(update_fields) | {"webhook_message", "validated_message", "compressed_messages"}
+        return super(Event, self).save(*args, **kwargs)
+
     def __str__(self):
         return "{} - {}".format(self.kind, self.stripe_id)
 
@@ -174,6 +270,13 @@ class Event(AccountRelatedStripeObject):
         )
 
 
+# replaces the descriptors installed by JSONField, which know nothing of
+# compressed_messages
+for _field in [Event._meta.get_field("webhook_message"), Event._meta.get_field("validated_message")]:
+    setattr(Event, _field.name, CompressedEventMessage(_field))
+del _field
+
+
 class Transfer(AccountRelatedStripeObject):
 
     amount = models.DecimalField(decimal_places=2, max_digits=9)
@@ -750,3 +853,20 @@ class Discount(models.Model):
     customer = models.OneToOneField(Customer)
     coupon = models.ForeignKey(Coupon, on_delete=models.CASCADE)
     subscription = models.ForeignKey(Subscription, null=True, blank=True)
+
+
+@python_2_unicode_compatible
+class SyncCheckpoint(models.Model):
+    """
+    How far a resumable sync got, e.g. the last customer synced by the
+    sync_customers command
+    """
+
+    name = models.CharField(max_length=191, unique=True)
+    cursor = models.CharField(max_length=191, blank=True)
+    started_at = models.DateTimeField(default=timezone.now)
+    updated_at = models.DateTimeField(default=timezone.now)
+    completed_at = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return "{} at {}".format(self.name, self.cursor or "start")
@@ -0,0 +1,110 @@
+import contextlib
+import threading
+import time
+
+from django.core.cache import caches
+
+from .conf import settings
+
+INTERACTIVE = "interactive"
+BATCH = "batch"
+
+KEY_PREFIX = "pinax-stripe-ratelimit"
+
+_local = threading.local()
+
+
+@contextlib.contextmanager
+def priority(value):
+    """
+    Set the priority of the Stripe API requests sent by the current thread
+
+    Requests with the BATCH priority only get a share of the budget (see
+    PINAX_STRIPE_RATE_LIMIT_BATCH_SHARE), leaving the rest to INTERACTIVE
+    requests such as webhooks and checkouts.
+    """
+    previous = current_priority()
+    _local.priority = value
+    try:
+        yield
+    finally:
+        _local.priority = previous
+
+
+def current_priority():
+    return getattr(_local, "priority", INTERACTIVE)
+
+
+def get_cache():
+    return caches[settings.PINAX_STRIPE_RATE_LIMIT_CACHE]
+
+
+def get_bucket(headers):
+    """
+    Stripe limits requests per mode and per (connected) account
+
+    Returns:
+        a (mode, account) tuple identifying the budget a request counts against
+    """
+    mode = "live" if "_live_" in headers.get("Authorization", "") else "test"
+    return mode, headers.get("Stripe-Account") or "platform"
+
+
+def get_budget(mode):
+    budget = settings.PINAX_STRIPE_RATE_LIMITS[mode]
+    if current_priority() == BATCH:
+        budget = max(1, int(budget * settings.PINAX_STRIPE_RATE_LIMIT_BATCH_SHARE))
+    return budget
+
+
+def acquire(headers):
+    """
+    Wait until a request fits in the budget of its bucket for the current second
+
+    Args:
+        headers: the headers of the request about to be sent
+    """
+    cache = get_cache()
+    mode, account = get_bucket(headers)
+    budget = get_budget(mode)
+    while True:
+        now = time.time()
+        backoff_until = cache.get("{}:{}:{}:backoff".format(KEY_PREFIX, mode, account))
+        if backoff_until and backoff_until > now:
+            time.sleep(backoff_until - now)
+            continue
+        window = int(now)
+        key = "{}:{}:{}:{}".format(KEY_PREFIX, mode, account, window)
+        cache.add(key, 0, timeout=2)
+        try:
+            count = cache.incr(key)
+        except ValueError:
+            # expired between add and incr
+            continue
+        if count <= budget:
+            return
+        time.sleep(window + 1 - now)
+
+
+def backoff(headers):
+    """
+    Hold back every request of the bucket after a 429 response, doubling the
+    delay while 429s keep coming
+
+    Args:
+        headers: the headers of the request that was rate limited
+
+    Returns:
+        the delay in seconds
+    """
+    cache = get_cache()
+    mode, account = get_bucket(headers)
+    level_key = "{}:{}:{}:level".format(KEY_PREFIX, mode, account)
+    level = (cache.get(level_key) or 0) + 1
+    delay = min(
+        settings.PINAX_STRIPE_RATE_LIMIT_BACKOFF * 2 ** (level - 1),
+        settings.PINAX_STRIPE_RATE_LIMIT_MAX_BACKOFF
+    )
+    cache.set(level_key, level, timeout=int(delay) * 2 + 1)
+    cache.set("{}:{}:{}:backoff".format(KEY_PREFIX, mode, account), time.time() + delay, timeout=int(delay) + 1)
+    return delay
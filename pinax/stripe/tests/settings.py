@@ -56,3 +56,5 @@ TEMPLATES = [{
     },
 }]
 SECRET_KEY = "pinax-stripe-secret-key"
+# cached catalog objects would outlive the test that created them
+PINAX_STRIPE_CATALOG_CACHE_TTL = 0
@@ -0,0 +1,89 @@
+import json
+import threading
+import time
+
+from six.moves import BaseHTTPServer, socketserver
+
+
+class StripeRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Answers every request with the object registered for its path, or with
+    a Stripe style 404
+    """
+
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self.respond()
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        self.respond()
+
+    def do_DELETE(self):
+        self.respond()
+
+    def respond(self):
+        server = self.server
+        path = self.path.split("?")[0]
+        server.requests.append((self.command, self.path, self.client_address))
+        if server.delay:
+            time.sleep(server.delay)
+        status, data = server.responses.get(path, (404, {
+            "error": {"type": "invalid_request_error", "message": "No such object: {}".format(path)}
+        }))
+        body = json.dumps(data).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class StripeServer(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+    A local stand-in for the Stripe API, to be used as `stripe.api_base`
+
+        with StripeServer() as server:
+            server.add("/v1/charges/ch_XXX", {"id": "ch_XXX", "object": "charge"})
+            with patch("stripe.api_base", server.url):
+                ...
+    """
+
+    daemon_threads = True
+
+    def __init__(self):
+        BaseHTTPServer.HTTPServer.__init__(self, ("127.0.0.1", 0), StripeRequestHandler)
+        self.responses = {}
+        self.requests = []
+        self.delay = 0
+        self.thread = None
+
+    @property
+    def url(self):
+        return "http://{}:{}".format(*self.server_address)
+
+    def handle_error(self, request, client_address):
+        # e.g. clients that timed out and went away
+        pass
+
+    def add(self, path, data, status=200):
+        self.responses[path] = (status, data)
+
+    @property
+    def connections(self):
+        return set(address for _, _, address in self.requests)
+
+    def __enter__(self):
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+        self.server_close()
+        self.thread.join()
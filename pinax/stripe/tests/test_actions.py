@@ -6,12 +6,15 @@ from unittest import skipIf
 
 import django
 from django.contrib.auth import get_user_model
+from django.db import connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext, override_settings
 from django.utils import timezone
 
 import stripe
 from mock import Mock, patch
 
+from .. import catalog
 from ..actions import (
     accounts,
     charges,
@@ -22,6 +25,7 @@ from ..actions import (
     plans,
     refunds,
     sources,
+    subscriptionitems,
     subscriptions,
     transfers,
     orders,
@@ -40,6 +44,8 @@ from ..models import (
     Invoice,
     Plan,
     Subscription,
+    SubscriptionItem,
+    SyncCheckpoint,
     Transfer,
     UserAccount,
     Order,
@@ -47,6 +53,16 @@ from ..models import (
     Sku,
     Coupon,
 )
+from ..webhooks import registry
+
+
+def statements(queries, *kinds):
+    """
+    The SQL of the captured queries starting with one of `kinds`; on Django
+    1.8 the SQL captured on SQLite reads "QUERY = '...' - PARAMS = (...)"
+    """
+    sqls = [q["sql"][len("QUERY = '"):] if q["sql"].startswith("QUERY = '") else q["sql"] for q in queries]
+    return [sql for sql in sqls if sql.startswith(kinds)]
 
 
 class ChargesTests(TestCase):
@@ -300,6 +316,41 @@ class ChargesTests(TestCase):
         charges.update_charge_availability()
         self.assertTrue(SyncMock.called)
 
+    @patch("pinax.stripe.actions.charges.sync_charge")
+    @patch("stripe.BalanceTransaction.auto_paging_iter", create=True)
+    def test_update_availability_from_balance_transactions(self, AutoPagerMock, SyncMock):
+        created = datetime.datetime(2018, 1, 1, tzinfo=timezone.utc)
+        account = Account.objects.create(stripe_id="acct_X")
+        connected = Customer.objects.create(stripe_id="cus_connected", stripe_account=account)
+        Charge.objects.create(stripe_id="ch_1", customer=self.customer, amount=decimal.Decimal("100"), currency="usd", paid=True, captured=True, charge_created=created)
+        Charge.objects.create(stripe_id="ch_2", customer=connected, amount=decimal.Decimal("100"), currency="usd", paid=True, captured=True, charge_created=created)
+        Charge.objects.create(stripe_id="ch_3", customer=self.customer, amount=decimal.Decimal("100"), currency="usd", paid=True, captured=True, refunded=True)
+
+        def balance_transactions(stripe_account, **kwargs):
+            return iter([
+                {"source": "ch_1" if stripe_account is None else "ch_2", "status": "available", "available_on": 1515000000, "fee": 59, "currency": "usd"},
+                {"source": "ch_3", "status": "available", "available_on": 1515000000, "fee": 59, "currency": "usd"},
+                {"source": "ch_unknown", "status": "available", "available_on": 1515000000, "fee": 59, "currency": "usd"},
+            ])
+        AutoPagerMock.side_effect = balance_transactions
+
+        charges.update_charge_availability(from_balance_transactions=True)
+
+        self.assertFalse(SyncMock.called)
+        self.assertEquals(AutoPagerMock.call_count, 2)
+        self.assertEquals(set(kwargs["stripe_account"] for _, kwargs in AutoPagerMock.call_args_list), {None, "acct_X"})
+        _, kwargs = AutoPagerMock.call_args
+        self.assertEquals(kwargs["type"], "charge")
+        self.assertEquals(kwargs["created"], {"gte": 1514764800})
+        for stripe_id in ["ch_1", "ch_2"]:
+            charge = Charge.objects.get(stripe_id=stripe_id)
+            self.assertTrue(charge.available)
+            self.assertEquals(charge.available_on, datetime.datetime(2018, 1, 3, 17, 20, tzinfo=timezone.utc))
+            self.assertEquals(charge.fee, decimal.Decimal("0.59"))
+            self.assertEquals(charge.fee_currency, "usd")
+        self.assertFalse(Charge.objects.get(stripe_id="ch_3").available)
+        self.assertFalse(Charge.objects.filter(stripe_id="ch_unknown").exists())
+
 
 class CustomersTests(TestCase):
 
@@ -550,6 +601,14 @@ class CustomersTests(TestCase):
         customers.link_customer(event)
         self.assertEquals(event.customer.stripe_id, "cu_123")
 
+    def test_link_customer_without_saving(self):
+        Customer.objects.create(stripe_id="cu_123")
+        message = dict(data=dict(object=dict(id="cu_123")))
+        event = Event.objects.create(validated_message=message, kind="customer.created")
+        customers.link_customer(event, save=False)
+        self.assertEquals(event.customer.stripe_id, "cu_123")
+        self.assertIsNone(Event.objects.get(pk=event.pk).customer)
+
     def test_link_customer_non_customer_event(self):
         Customer.objects.create(stripe_id="cu_123")
         message = dict(data=dict(object=dict(customer="cu_123")))
@@ -718,6 +777,384 @@ class EventsTests(TestCase):
         self.assertEquals(event.processed, False)
         self.assertIsNone(event.validated_message)
 
+    @patch("pinax.stripe.webhooks.AccountUpdatedWebhook.process")
+    def test_add_event_without_processing(self, ProcessMock):
+        event = events.add_event(stripe_id="evt_001", kind="account.updated", livemode=True, message={}, process=False)
+        self.assertEquals(event, Event.objects.get(stripe_id="evt_001"))
+        self.assertFalse(ProcessMock.called)
+        self.assertEquals(list(events.pending_events()), [event])
+
+    @patch("pinax.stripe.webhooks.AccountUpdatedWebhook.process")
+    def test_add_event_duplicate(self, ProcessMock):
+        Event.objects.create(stripe_id="evt_001", kind="account.updated", webhook_message={})
+        count = events.duplicate_event_count()
+        event = events.add_event(stripe_id="evt_001", kind="account.updated", livemode=True, message={})
+        self.assertIsNone(event)
+        self.assertFalse(ProcessMock.called)
+        self.assertEquals(Event.objects.filter(stripe_id="evt_001").count(), 1)
+        self.assertEquals(events.duplicate_event_count(), count + 1)
+
+    def test_add_event_validated(self):
+        message = {"id": "evt_001"}
+        event = events.add_event(stripe_id="evt_001", kind="account.updated", livemode=True, message=message, process=False, validated=True)
+        self.assertEquals(event.validated_message, message)
+
+    @patch("pinax.stripe.webhooks.AccountUpdatedWebhook.process")
+    def test_process_event(self, ProcessMock):
+        event = Event.objects.create(stripe_id="evt_001", kind="account.updated", webhook_message={})
+        events.process_event(event)
+        self.assertTrue(ProcessMock.called)
+
+    def test_process_event_new_webhook_kind(self):
+        event = Event.objects.create(stripe_id="evt_002", kind="patrick.got.coffee", webhook_message={})
+        events.process_event(event)
+        self.assertFalse(event.processed)
+
+    def test_pending_events(self):
+        pending = Event.objects.create(stripe_id="evt_001", kind="account.updated", webhook_message={})
+        Event.objects.create(stripe_id="evt_002", kind="account.updated", webhook_message={}, processed=True, valid=True)
+        Event.objects.create(stripe_id="evt_003", kind="account.updated", webhook_message={}, valid=False)
+        Event.objects.create(stripe_id="evt_004", kind="patrick.got.coffee", webhook_message={})
+        self.assertEquals(list(events.pending_events()), [pending])
+
+    def test_pending_events_retries(self):
+        now = timezone.now()
+        due = Event.objects.create(stripe_id="evt_001", kind="account.updated", webhook_message={}, valid=True, attempts=1, next_attempt_at=now)
+        Event.objects.create(
+            stripe_id="evt_002", kind="account.updated", webhook_message={}, valid=True, attempts=1,
+            next_attempt_at=now + datetime.timedelta(minutes=1)
+        )
+        Event.objects.create(stripe_id="evt_003", kind="account.updated", webhook_message={}, valid=True, attempts=8, dead_lettered_at=now)
+        Event.objects.create(stripe_id="evt_004", kind="account.updated", webhook_message={}, valid=True)
+        self.assertEquals(list(events.pending_events()), [due])
+
+    def test_requeue_events(self):
+        dead = Event.objects.create(
+            stripe_id="evt_001", kind="account.updated", webhook_message={}, valid=True, attempts=8,
+            dead_lettered_at=timezone.now()
+        )
+        Event.objects.create(stripe_id="evt_002", kind="account.updated", webhook_message={}, valid=True, processed=True)
+        self.assertEquals(events.requeue_events(Event.objects.all()), 1)
+        self.assertEquals(list(events.pending_events()), [dead])
+        dead.refresh_from_db()
+        self.assertEquals(dead.attempts, 0)
+        self.assertIsNone(dead.valid)
+
+    def test_partition_key(self):
+        self.assertEquals(events.partition_key({"data": {"object": {"id": "cus_1", "object": "customer"}}}), "cus_1")
+        self.assertEquals(events.partition_key({"data": {"object": {"id": "in_1", "customer": "cus_1"}}}), "cus_1")
+        self.assertEquals(events.partition_key({"data": {"object": {"id": "ch_1", "customer": {"id": "cus_1"}}}}), "cus_1")
+        self.assertEquals(events.partition_key({"data": {"object": {"id": "plan_1", "object": "plan"}}}), "plan_1")
+        self.assertEquals(events.partition_key({"account": "acct_1", "data": {"object": {"id": "in_1", "customer": "cus_1"}}}), "acct_1/cus_1")
+        self.assertEquals(events.partition_key({}), "")
+
+    @patch("pinax.stripe.webhooks.AccountUpdatedWebhook.process")
+    def test_add_event_partition_key(self, ProcessMock):
+        message = {"data": {"object": {"id": "in_1", "customer": "cus_1"}}}
+        event = events.add_event(stripe_id="evt_001", kind="invoice.created", livemode=True, message=message, process=False)
+        self.assertEquals(event.partition_key, "cus_1")
+
+    @patch("pinax.stripe.actions.events.process_event")
+    def test_add_event_claimed_while_processed(self, ProcessMock):
+        def process(event):
+            self.assertEquals(events.claim_events("worker", 10), [])
+        ProcessMock.side_effect = process
+        message = {"data": {"object": {"id": "cus_1", "object": "customer"}}}
+        event = events.add_event(stripe_id="evt_001", kind="customer.updated", livemode=True, message=message)
+        self.assertTrue(ProcessMock.called)
+        self.assertTrue(event.claimed_by)
+        self.assertIsNotNone(event.claimed_at)
+
+        event = events.add_event(stripe_id="evt_002", kind="customer.updated", livemode=True, message=message, process=False)
+        self.assertEquals(event.claimed_by, "")
+        self.assertEquals(events.claim_events("worker", 10), [event])
+
+    def test_claim_events(self):
+        message = {"data": {"object": {"id": "cus_1", "object": "customer"}}}
+        first = Event.objects.create(stripe_id="evt_001", kind="customer.updated", webhook_message=message)
+        claimed = Event.objects.create(stripe_id="evt_002", kind="customer.updated", webhook_message={}, claimed_by="other", claimed_at=timezone.now())
+        expired = Event.objects.create(
+            stripe_id="evt_003", kind="customer.updated", webhook_message={}, claimed_by="other",
+            claimed_at=timezone.now() - datetime.timedelta(seconds=301)
+        )
+        self.assertEquals(events.claim_events("worker", 10), [first, expired])
+        first = Event.objects.get(pk=first.pk)
+        self.assertEquals(first.claimed_by, "worker")
+        self.assertEquals(first.partition_key, "cus_1")
+        self.assertEquals(Event.objects.get(pk=claimed.pk).claimed_by, "other")
+        self.assertEquals(events.claim_events("another", 10), [])
+
+    def test_claim_events_behind_retry(self):
+        def create(stripe_id, customer, **kwargs):
+            return Event.objects.create(stripe_id=stripe_id, kind="invoice.updated", webhook_message={}, partition_key=customer, **kwargs)
+        create("evt_001", "cus_1", valid=True, attempts=1, next_attempt_at=timezone.now() + datetime.timedelta(seconds=3600))
+        create("evt_002", "cus_1")
+        other = create("evt_003", "cus_2")
+        create("evt_004", "cus_1")
+        dead = create("evt_005", "cus_3", valid=True, attempts=8, dead_lettered_at=timezone.now())
+        after_dead = create("evt_006", "cus_3")
+        self.assertEquals(dead.next_attempt_at, None)
+        self.assertEquals(events.claim_events("worker", 10), [other, after_dead])
+
+    def test_claim_events_behind_many_retries(self):
+        next_attempt_at = timezone.now() + datetime.timedelta(seconds=3600)
+        Event.objects.bulk_create([
+            Event(
+                stripe_id="evt_r{}".format(i), kind="invoice.updated", webhook_message={}, partition_key="cus_{}".format(i),
+                valid=True, attempts=1, next_attempt_at=next_attempt_at
+            ) for i in range(1500)
+        ])
+        Event.objects.create(stripe_id="evt_001", kind="invoice.updated", webhook_message={}, partition_key="cus_7")
+        other = Event.objects.create(stripe_id="evt_002", kind="invoice.updated", webhook_message={}, partition_key="cus_other")
+        self.assertEquals(events.claim_events("worker", 10), [other])
+
+    def test_group_claimed_events(self):
+        def create(stripe_id, customer, claimed_by):
+            return Event.objects.create(
+                stripe_id=stripe_id, kind="invoice.created", webhook_message={}, partition_key=customer,
+                claimed_by=claimed_by, claimed_at=timezone.now()
+            )
+        create("evt_001", "cus_1", "other")
+        a1 = create("evt_002", "cus_2", "worker")
+        b1 = create("evt_003", "cus_1", "worker")
+        a2 = create("evt_004", "cus_2", "worker")
+        groups, deferred = events.group_claimed_events([a1, b1, a2], "worker")
+        self.assertEquals(groups, [[a1, a2]])
+        self.assertEquals(deferred, [b1])
+        events.defer_events(deferred, 10)
+        self.assertEquals(events.claim_events("worker", 10), [])
+
+    def object_event(self, stripe_id, kind, obj, seconds=0):
+        message = {"id": stripe_id, "type": kind, "data": {"object": obj}}
+        return Event.objects.create(
+            stripe_id=stripe_id, kind=kind, webhook_message=message, validated_message=message,
+            created_at=datetime.datetime(2018, 1, 1, tzinfo=timezone.utc) + datetime.timedelta(seconds=seconds)
+        )
+
+    def test_coalesce_events(self):
+        invoice = {"id": "in_1", "object": "invoice", "customer": "cus_1"}
+        created = self.object_event("evt_001", "invoice.created", invoice)
+        charge = self.object_event("evt_002", "charge.succeeded", {"id": "ch_1", "object": "charge"}, seconds=1)
+        paid = self.object_event("evt_003", "invoice.payment_succeeded", invoice, seconds=2)
+        deleted = self.object_event("evt_004", "customer.deleted", {"id": "cus_1", "object": "customer"}, seconds=3)
+        late = self.object_event("evt_005", "invoice.updated", invoice, seconds=20)
+        all_events = [created, charge, paid, deleted, late]
+        self.assertEquals(events.coalesce_events(all_events, window=10), [[charge], [created, paid], [deleted], [late]])
+        self.assertEquals(events.coalesce_events(all_events, window=60), [[charge], [deleted], [created, paid, late]])
+        self.assertEquals(events.coalesce_events(all_events, window=0), [[event] for event in all_events])
+
+    @patch("pinax.stripe.webhooks.InvoiceWebhook.process_webhook")
+    def test_process_coalesced(self, ProcessWebhookMock):
+        invoice = {"id": "in_1", "object": "invoice"}
+        coalesced = [
+            self.object_event("evt_001", "invoice.created", invoice),
+            self.object_event("evt_002", "invoice.updated", invoice),
+            self.object_event("evt_003", "invoice.payment_succeeded", invoice),
+        ]
+        signaled = []
+
+        def handler(sender, event, **kwargs):
+            signaled.append(event.stripe_id)
+        for kind in ["invoice.created", "invoice.updated", "invoice.payment_succeeded"]:
+            registry.get_signal(kind).connect(handler)
+            self.addCleanup(registry.get_signal(kind).disconnect, handler)
+
+        events.process_coalesced(coalesced)
+        self.assertEquals(ProcessWebhookMock.call_count, 1)
+        self.assertEquals(signaled, ["evt_001", "evt_002", "evt_003"])
+        self.assertEquals(Event.objects.filter(processed=True).count(), 3)
+
+    @patch("pinax.stripe.webhooks.InvoiceWebhook.process_webhook")
+    def test_process_coalesced_newest_signal_error(self, ProcessWebhookMock):
+        invoice = {"id": "in_1", "object": "invoice"}
+        older = self.object_event("evt_001", "invoice.created", invoice)
+        newest = self.object_event("evt_002", "invoice.updated", invoice)
+
+        def handler(sender, event, **kwargs):
+            raise Exception("boom")
+        registry.get_signal("invoice.updated").connect(handler)
+        self.addCleanup(registry.get_signal("invoice.updated").disconnect, handler)
+
+        with self.assertRaises(Exception):
+            events.process_coalesced([older, newest])
+        self.assertEquals(ProcessWebhookMock.call_count, 1)
+        self.assertTrue(Event.objects.get(pk=older.pk).processed)
+        newest = Event.objects.get(pk=newest.pk)
+        self.assertFalse(newest.processed)
+        self.assertEquals(newest.attempts, 1)
+        self.assertIsNotNone(newest.next_attempt_at)
+
+    @patch("pinax.stripe.webhooks.InvoiceWebhook.process_webhook")
+    def test_process_coalesced_older_error(self, ProcessWebhookMock):
+        invoice = {"id": "in_1", "object": "invoice"}
+        older = self.object_event("evt_001", "invoice.created", invoice)
+        newest = self.object_event("evt_002", "invoice.updated", invoice)
+        signaled = []
+
+        def handler(sender, event, **kwargs):
+            raise Exception("boom")
+
+        def newest_handler(sender, event, **kwargs):
+            signaled.append(event.stripe_id)
+        registry.get_signal("invoice.created").connect(handler)
+        self.addCleanup(registry.get_signal("invoice.created").disconnect, handler)
+        registry.get_signal("invoice.updated").connect(newest_handler)
+        self.addCleanup(registry.get_signal("invoice.updated").disconnect, newest_handler)
+
+        with self.assertRaises(Exception):
+            events.process_coalesced([older, newest])
+        self.assertEquals(signaled, [])
+        for event in Event.objects.filter(pk__in=[older.pk, newest.pk]):
+            self.assertFalse(event.processed)
+            self.assertEquals(event.attempts, 1)
+            self.assertIsNotNone(event.next_attempt_at)
+
+        Event.objects.update(next_attempt_at=timezone.now())
+        registry.get_signal("invoice.created").disconnect(handler)
+        for event in events.pending_events():
+            events.process_event(event)
+        self.assertEquals(signaled, ["evt_002"])
+        self.assertEquals(Event.objects.filter(processed=True).count(), 2)
+
+    @patch("pinax.stripe.webhooks.InvoiceWebhook.process_webhook")
+    def test_process_coalesced_worker_died(self, ProcessWebhookMock):
+        invoice = {"id": "in_1", "object": "invoice"}
+        older = self.object_event("evt_001", "invoice.created", invoice)
+        newest = self.object_event("evt_002", "invoice.updated", invoice)
+        Event.objects.update(partition_key="in_1")
+        self.assertEquals(events.claim_events("worker", 10), [older, newest])
+        signaled = []
+
+        def handler(sender, event, **kwargs):
+            signaled.append(event.stripe_id)
+        registry.get_signal("invoice.updated").connect(handler)
+        self.addCleanup(registry.get_signal("invoice.updated").disconnect, handler)
+
+        # the worker dies after holding back the signal of the newest event
+        registry.get("invoice.updated")(Event.objects.get(pk=newest.pk)).process(hold_signal=True)
+        Event.objects.filter(pk=older.pk).update(processed=True)
+        newest = Event.objects.get(pk=newest.pk)
+        self.assertTrue(newest.valid)
+        self.assertFalse(newest.processed)
+        self.assertEquals(list(events.pending_events()), [])
+        self.assertEquals(events.claim_events("another", 10), [])
+
+        Event.objects.update(claimed_at=timezone.now() - datetime.timedelta(seconds=301))
+        self.assertEquals(list(events.pending_events()), [newest])
+        claimed = events.claim_events("another", 10)
+        self.assertEquals(claimed, [newest])
+        events.process_event(claimed[0])
+        self.assertEquals(signaled, ["evt_002"])
+        self.assertTrue(Event.objects.get(pk=newest.pk).processed)
+
+    @patch("pinax.stripe.webhooks.InvoiceWebhook.process_webhook")
+    def test_process_coalesced_newest_invalid(self, ProcessWebhookMock):
+        invoice = {"id": "in_1", "object": "invoice"}
+        older = self.object_event("evt_001", "invoice.created", invoice)
+        newest = self.object_event("evt_002", "invoice.updated", invoice)
+        newest.validated_message = {"data": {"object": dict(invoice, amount_due=0)}}
+        events.process_coalesced([older, newest])
+        self.assertEquals(ProcessWebhookMock.call_count, 1)
+        self.assertTrue(Event.objects.get(pk=older.pk).processed)
+        self.assertFalse(Event.objects.get(pk=newest.pk).valid)
+
+    def event_message(self, stripe_id, created, kind="account.updated"):
+        return {
+            "id": stripe_id,
+            "object": "event",
+            "api_version": "2015-10-16",
+            "created": created,
+            "data": {"object": {"id": "acct_1", "object": "account"}},
+            "livemode": False,
+            "pending_webhooks": 0,
+            "request": {"id": "req_1", "idempotency_key": None},
+            "type": kind
+        }
+
+    @patch("pinax.stripe.actions.events.process_event")
+    @patch("stripe.Event.auto_paging_iter", create=True)
+    def test_sync_since(self, AutoPagingIterMock, ProcessMock):
+        Event.objects.create(stripe_id="evt_2", kind="account.updated", webhook_message={})
+        AutoPagingIterMock.return_value = [
+            self.event_message("evt_3", 300),
+            self.event_message("evt_2", 200),
+            self.event_message("evt_1", 100),
+        ]
+        self.assertEquals(events.sync_since(), 2)
+        AutoPagingIterMock.assert_called_once_with(stripe_account=None)
+        self.assertEquals([call[0][0].stripe_id for call in ProcessMock.call_args_list], ["evt_1", "evt_3"])
+        event = Event.objects.get(stripe_id="evt_3")
+        self.assertEquals(event.validated_message, event.webhook_message)
+        self.assertEquals(event.request, "req_1")
+        self.assertEquals(SyncCheckpoint.objects.get(name="sync_since").cursor, "300")
+
+        AutoPagingIterMock.reset_mock()
+        AutoPagingIterMock.return_value = [self.event_message("evt_3", 300)]
+        self.assertEquals(events.sync_since(), 0)
+        AutoPagingIterMock.assert_called_once_with(stripe_account=None, created={"gte": 300})
+
+    @patch("pinax.stripe.actions.events.process_event")
+    @patch("stripe.Event.list")
+    @patch("stripe.Event.auto_paging_iter", create=True, side_effect=AttributeError)
+    def test_sync_since_deprecated(self, AutoPagingIterMock, ListMock, ProcessMock):
+        ListMock.return_value.data = [self.event_message("evt_1", 100)]
+        self.assertEquals(events.sync_since(created=50), 1)
+        ListMock.assert_called_once_with(stripe_account=None, created={"gte": 50})
+
+    @patch("pinax.stripe.actions.events.process_event")
+    @patch("stripe.Event.auto_paging_iter", create=True)
+    def test_sync_since_connect(self, AutoPagingIterMock, ProcessMock):
+        AutoPagingIterMock.return_value = [self.event_message("evt_1", 100)]
+        self.assertEquals(events.sync_since(stripe_account=self.account.stripe_id), 1)
+        AutoPagingIterMock.assert_called_once_with(stripe_account=self.account.stripe_id)
+        self.assertEquals(Event.objects.get(stripe_id="evt_1").stripe_account, self.account)
+        self.assertEquals(SyncCheckpoint.objects.get(name="sync_since:acc_001").cursor, "100")
+
+    @patch("pinax.stripe.actions.events.process_event")
+    @patch("stripe.Event.auto_paging_iter", create=True)
+    def test_sync_since_claims(self, AutoPagingIterMock, ProcessMock):
+        def process(event):
+            self.assertEquals(events.claim_events("worker", 10), [])
+        ProcessMock.side_effect = process
+        AutoPagingIterMock.return_value = [self.event_message("evt_1", 100)]
+        self.assertEquals(events.sync_since(), 1)
+        self.assertTrue(ProcessMock.called)
+        self.assertTrue(Event.objects.get(stripe_id="evt_1").claimed_by)
+
+    @patch("pinax.stripe.actions.events.process_event")
+    @patch("stripe.Event.auto_paging_iter", create=True)
+    def test_sync_since_error(self, AutoPagingIterMock, ProcessMock):
+        AutoPagingIterMock.return_value = [self.event_message("evt_2", 200), self.event_message("evt_1", 100)]
+        ProcessMock.side_effect = [Exception("boom"), None]
+        self.assertEquals(events.sync_since(), 2)
+        self.assertEquals(ProcessMock.call_count, 2)
+        self.assertEquals(SyncCheckpoint.objects.get(name="sync_since").cursor, "200")
+
+    @patch("pinax.stripe.actions.events.process_event")
+    @patch("pinax.stripe.actions.events.add_event")
+    @patch("stripe.Event.auto_paging_iter", create=True)
+    def test_sync_since_add_error(self, AutoPagingIterMock, AddMock, ProcessMock):
+        AutoPagingIterMock.return_value = [self.event_message("evt_2", 200), self.event_message("evt_1", 100)]
+        event = Event(stripe_id="evt_2", kind="account.updated")
+        AddMock.side_effect = [Exception("boom"), event]
+        self.assertEquals(events.sync_since(), 1)
+        ProcessMock.assert_called_once_with(event)
+        checkpoint = SyncCheckpoint.objects.get(name="sync_since")
+        self.assertEquals(checkpoint.cursor, "100")
+        self.assertIsNone(checkpoint.completed_at)
+
+        AutoPagingIterMock.reset_mock()
+        AddMock.side_effect = [Event(stripe_id="evt_1", kind="account.updated"), None]
+        self.assertEquals(events.sync_since(), 1)
+        AutoPagingIterMock.assert_called_once_with(stripe_account=None, created={"gte": 100})
+        self.assertEquals(SyncCheckpoint.objects.get(name="sync_since").cursor, "200")
+
+    @patch("stripe.Event.auto_paging_iter", create=True)
+    def test_sync_since_nothing_listed(self, AutoPagingIterMock):
+        AutoPagingIterMock.return_value = []
+        self.assertEquals(events.sync_since(), 0)
+        self.assertEquals(SyncCheckpoint.objects.get(name="sync_since").cursor, "")
+
 
 class InvoicesTests(TestCase):
 
@@ -1708,6 +2145,44 @@ class SyncsTests(TestCase):
         self.assertEquals(Subscription.objects.get(stripe_id=subscription["id"]), sub)
         self.assertEquals(sub.status, "trialing")
 
+    @patch("stripe.SubscriptionItem.list")
+    def test_sync_subscription_from_stripe_data_with_items(self, ListMock):
+        plan = Plan.objects.create(stripe_id="pro2", interval="month", interval_count=1, amount=decimal.Decimal("19.99"))
+        plan_data = {"id": "pro2", "object": "plan", "amount": 1999, "currency": "usd", "interval": "month", "interval_count": 1}
+        subscription = {
+            "id": "sub_7Q4BX0HMfqTpN8",
+            "object": "subscription",
+            "application_fee_percent": None,
+            "cancel_at_period_end": False,
+            "canceled_at": None,
+            "current_period_end": 1448758544,
+            "current_period_start": 1448499344,
+            "customer": self.customer.stripe_id,
+            "ended_at": None,
+            "items": {
+                "object": "list",
+                "data": [{
+                    "id": "si_XXX",
+                    "object": "subscription_item",
+                    "created": 1448499344,
+                    "metadata": {},
+                    "plan": plan_data,
+                    "quantity": 1,
+                    "subscription": "sub_7Q4BX0HMfqTpN8"
+                }],
+                "has_more": False
+            },
+            "plan": plan_data,
+            "quantity": 1,
+            "start": 1448499344,
+            "status": "active",
+            "trial_end": None,
+            "trial_start": None
+        }
+        sub = subscriptions.sync_subscription_from_stripe_data(self.customer, subscription)
+        self.assertFalse(ListMock.called)
+        self.assertEquals([(si.stripe_id, si.plan) for si in sub.items.all()], [("si_XXX", plan)])
+
     def test_sync_subscription_from_stripe_data_updated(self):
         Plan.objects.create(stripe_id="pro2", interval="month", interval_count=1, amount=decimal.Decimal("19.99"))
         subscription = {
@@ -1751,8 +2226,8 @@ class SyncsTests(TestCase):
         subscriptions.sync_subscription_from_stripe_data(self.customer, subscription)
         self.assertEquals(Subscription.objects.get(stripe_id=subscription["id"]).status, "active")
 
-    @patch("pinax.stripe.actions.subscriptions.sync_subscription_from_stripe_data")
-    @patch("pinax.stripe.actions.sources.sync_payment_source_from_stripe_data")
+    @patch("pinax.stripe.actions.subscriptions.sync_subscriptions_from_stripe_data")
+    @patch("pinax.stripe.actions.sources.sync_payment_sources_from_stripe_data")
     @patch("stripe.Customer.retrieve")
     def test_sync_customer(self, RetreiveMock, SyncPaymentSourceMock, SyncSubscriptionMock):
         RetreiveMock.return_value = dict(
@@ -1772,8 +2247,8 @@ class SyncsTests(TestCase):
         self.assertTrue(SyncPaymentSourceMock.called)
         self.assertTrue(SyncSubscriptionMock.called)
 
-    @patch("pinax.stripe.actions.subscriptions.sync_subscription_from_stripe_data")
-    @patch("pinax.stripe.actions.sources.sync_payment_source_from_stripe_data")
+    @patch("pinax.stripe.actions.subscriptions.sync_subscriptions_from_stripe_data")
+    @patch("pinax.stripe.actions.sources.sync_payment_sources_from_stripe_data")
     def test_sync_customer_no_cu_provided(self, SyncPaymentSourceMock, SyncSubscriptionMock):
         cu = dict(
             account_balance=1999,
@@ -1793,8 +2268,8 @@ class SyncsTests(TestCase):
         self.assertTrue(SyncSubscriptionMock.called)
 
     @patch("pinax.stripe.actions.customers.purge_local")
-    @patch("pinax.stripe.actions.subscriptions.sync_subscription_from_stripe_data")
-    @patch("pinax.stripe.actions.sources.sync_payment_source_from_stripe_data")
+    @patch("pinax.stripe.actions.subscriptions.sync_subscriptions_from_stripe_data")
+    @patch("pinax.stripe.actions.sources.sync_payment_sources_from_stripe_data")
     @patch("stripe.Customer.retrieve")
     def test_sync_customer_purged_locally(self, RetrieveMock, SyncPaymentSourceMock, SyncSubscriptionMock, PurgeLocalMock):
         self.customer.date_purged = timezone.now()
@@ -1805,8 +2280,8 @@ class SyncsTests(TestCase):
         self.assertFalse(PurgeLocalMock.called)
 
     @patch("pinax.stripe.actions.customers.purge_local")
-    @patch("pinax.stripe.actions.subscriptions.sync_subscription_from_stripe_data")
-    @patch("pinax.stripe.actions.sources.sync_payment_source_from_stripe_data")
+    @patch("pinax.stripe.actions.subscriptions.sync_subscriptions_from_stripe_data")
+    @patch("pinax.stripe.actions.sources.sync_payment_sources_from_stripe_data")
     @patch("stripe.Customer.retrieve")
     def test_sync_customer_purged_remotely_not_locally(self, RetrieveMock, SyncPaymentSourceMock, SyncSubscriptionMock, PurgeLocalMock):
         RetrieveMock.return_value = dict(
@@ -1817,19 +2292,270 @@ class SyncsTests(TestCase):
         self.assertFalse(SyncSubscriptionMock.called)
         self.assertTrue(PurgeLocalMock.called)
 
+    def card_data(self, stripe_id, **kwargs):
+        data = {
+            "id": stripe_id,
+            "object": "card",
+            "address_city": None,
+            "address_country": None,
+            "address_line1": None,
+            "address_line1_check": None,
+            "address_line2": None,
+            "address_state": None,
+            "address_zip": None,
+            "address_zip_check": None,
+            "brand": "Visa",
+            "country": "US",
+            "customer": self.customer.stripe_id,
+            "cvc_check": "pass",
+            "dynamic_last4": None,
+            "exp_month": 12,
+            "exp_year": 2030,
+            "fingerprint": "xyz",
+            "funding": "credit",
+            "last4": "4242",
+            "name": None
+        }
+        data.update(kwargs)
+        return data
+
+    def test_sync_payment_sources_from_stripe_data(self):
+        Card.objects.create(stripe_id="card_gone", customer=self.customer, exp_month=1, exp_year=2020)
+        sources.sync_payment_sources_from_stripe_data(self.customer, {
+            "data": [self.card_data("card_1"), self.card_data("card_2", name="Patrick")],
+            "has_more": False
+        })
+        self.assertEquals(sorted(self.customer.card_set.values_list("stripe_id", flat=True)), ["card_1", "card_2"])
+        self.assertEquals(Card.objects.get(stripe_id="card_2").name, "Patrick")
+
+        with CaptureQueriesContext(connection) as queries:
+            sources.sync_payment_sources_from_stripe_data(self.customer, {
+                "data": [self.card_data("card_1")],
+                "has_more": True
+            })
+        # the lookup of the upsert, and no deletion of the truncated list
+        self.assertEquals(len(queries), 1)
+        self.assertEquals(self.customer.card_set.count(), 2)
+
+    def subscription_data(self, stripe_id, plan, items):
+        return {
+            "id": stripe_id,
+            "object": "subscription",
+            "application_fee_percent": None,
+            "cancel_at_period_end": False,
+            "canceled_at": None,
+            "current_period_end": 1448758544,
+            "current_period_start": 1448499344,
+            "customer": self.customer.stripe_id,
+            "ended_at": None,
+            "items": {
+                "object": "list",
+                "data": [{
+                    "id": item_id,
+                    "object": "subscription_item",
+                    "created": 1448499344,
+                    "metadata": {},
+                    "plan": {"id": item_plan},
+                    "quantity": 1,
+                    "subscription": stripe_id
+                } for item_id, item_plan in items],
+                "has_more": False
+            },
+            "plan": {"id": plan},
+            "quantity": 1,
+            "start": 1448499344,
+            "status": "active",
+            "trial_end": None,
+            "trial_start": None
+        }
+
+    @patch("stripe.SubscriptionItem.list")
+    def test_sync_subscriptions_from_stripe_data(self, ListMock):
+        pro = Plan.objects.create(stripe_id="pro", interval="month", interval_count=1, amount=decimal.Decimal("19.99"))
+        extra = Plan.objects.create(stripe_id="extra", interval="month", interval_count=1, amount=decimal.Decimal("1.99"))
+        now = timezone.now()
+        gone = Subscription.objects.create(stripe_id="sub_gone", customer=self.customer, plan=pro, quantity=1, start=now, status="active")
+        canceled = Subscription.objects.create(stripe_id="sub_canceled", customer=self.customer, plan=pro, quantity=1, start=now, status="canceled", ended_at=now)
+        data = {
+            "data": [
+                self.subscription_data("sub_1", "pro", [("si_1", "pro"), ("si_2", "extra")]),
+                self.subscription_data("sub_2", "extra", [("si_3", "extra")]),
+            ],
+            "has_more": False
+        }
+        synced = subscriptions.sync_subscriptions_from_stripe_data(self.customer, data)
+        self.assertFalse(ListMock.called)
+        self.assertEquals([sub.stripe_id for sub in synced], ["sub_1", "sub_2"])
+        self.assertEquals(Subscription.objects.get(stripe_id="sub_2").plan, extra)
+        self.assertEquals(
+            sorted(SubscriptionItem.objects.values_list("stripe_id", "plan__stripe_id")),
+            [("si_1", "pro"), ("si_2", "extra"), ("si_3", "extra")]
+        )
+        gone.refresh_from_db()
+        self.assertEquals(gone.status, "canceled")
+        self.assertIsNotNone(gone.ended_at)
+        canceled.refresh_from_db()
+        self.assertEquals(canceled.ended_at, now)
+
+        data["data"][0]["items"]["data"].pop()
+        with CaptureQueriesContext(connection) as queries:
+            subscriptions.sync_subscriptions_from_stripe_data(self.customer, data)
+        self.assertFalse(SubscriptionItem.objects.filter(stripe_id="si_2").exists())
+        # plans, subscriptions, items, deleted items and canceled subscriptions
+        self.assertEquals(len(queries), 5)
+
+    def connect_plan(self):
+        """
+        Make the customer one of a connected account, with a plan of the
+        same id on the platform and on the account; returns the latter
+        """
+        account = Account.objects.create(stripe_id="acct_connect")
+        self.customer.stripe_account = account
+        self.customer.save()
+        Plan.objects.create(stripe_id="pro2", interval="month", interval_count=1, amount=decimal.Decimal("19.99"))
+        return Plan.objects.create(
+            stripe_id="pro2", stripe_account=account, interval="month", interval_count=1, amount=decimal.Decimal("9.99")
+        )
+
+    def cache_catalog(self):
+        catalog.invalidate()
+        catalog.reset_stats()
+        self.addCleanup(catalog.invalidate)
+
+    @override_settings(PINAX_STRIPE_CATALOG_CACHE_TTL=300)
+    def test_sync_subscription_from_stripe_data_connect(self):
+        self.cache_catalog()
+        plan = self.connect_plan()
+        data = self.subscription_data("sub_1", "pro2", [])
+        self.assertEquals(subscriptions.sync_subscription_from_stripe_data(self.customer, data).plan, plan)
+        self.assertEquals(subscriptions.sync_subscription_from_stripe_data(self.customer, data).plan, plan)
+        self.assertEquals(catalog.stats()["hits"], 1)
+        self.assertEquals(catalog.stats()["misses"], 1)
+
+    @override_settings(PINAX_STRIPE_CATALOG_CACHE_TTL=300)
+    def test_sync_subscriptions_from_stripe_data_connect(self):
+        self.cache_catalog()
+        plan = self.connect_plan()
+        data = {"data": [self.subscription_data("sub_1", "pro2", [("si_1", "pro2")])], "has_more": False}
+        subscriptions.sync_subscriptions_from_stripe_data(self.customer, data)
+        subscriptions.sync_subscriptions_from_stripe_data(self.customer, data)
+        self.assertEquals(Subscription.objects.get(stripe_id="sub_1").plan, plan)
+        self.assertEquals(SubscriptionItem.objects.get(stripe_id="si_1").plan, plan)
+        self.assertEquals(catalog.stats()["hits"], 1)
+        self.assertEquals(catalog.stats()["misses"], 1)
+
+    def test_sync_subscriptionitem_from_stripe_data_connect(self):
+        plan = self.connect_plan()
+        subscription = Subscription.objects.create(
+            stripe_id="sub_1", customer=self.customer, plan=plan, quantity=1, status="active", start=timezone.now()
+        )
+        item = self.subscription_data("sub_1", "pro2", [("si_1", "pro2")])["items"]["data"][0]
+        self.assertEquals(subscriptionitems.sync_subscriptionitem_from_stripe_data(item, subscription).plan, plan)
+        self.assertEquals(subscriptionitems.sync_subscriptionitem_from_stripe_data(item).plan, plan)
+
+    def test_sync_subscriptions_from_stripe_data_unknown_plan(self):
+        with self.assertRaises(Plan.DoesNotExist):
+            subscriptions.sync_subscriptions_from_stripe_data(self.customer, {
+                "data": [self.subscription_data("sub_1", "pro", [])],
+                "has_more": False
+            })
+
+    @patch("pinax.stripe.actions.invoices.retrieve_invoice_objects")
     @patch("pinax.stripe.actions.invoices.sync_invoice_from_stripe_data")
-    @patch("stripe.Customer.retrieve")
-    def test_sync_invoices_for_customer(self, RetreiveMock, SyncMock):
-        RetreiveMock().invoices().data = [Mock()]
+    @patch("stripe.Invoice.auto_paging_iter", create=True)
+    def test_sync_invoices_for_customer(self, AutoPagingIterMock, SyncMock, RetrieveMock):
+        AutoPagingIterMock.return_value = [Mock(), Mock()]
+        invoices.sync_invoices_for_customer(self.customer)
+        AutoPagingIterMock.assert_called_once_with(customer=self.customer.stripe_id, stripe_account=None, limit=100)
+        self.assertEquals(SyncMock.call_count, 2)
+
+    @patch("pinax.stripe.actions.invoices.transaction.atomic")
+    @patch("pinax.stripe.actions.invoices.sync_invoice_from_stripe_data")
+    @patch("pinax.stripe.actions.invoices.retrieve_invoice_objects")
+    @patch("stripe.Invoice.auto_paging_iter", create=True)
+    def test_sync_invoices_for_customer_retrieves_before_transaction(self, AutoPagingIterMock, RetrieveMock, SyncMock, AtomicMock):
+        calls = Mock()
+        calls.attach_mock(RetrieveMock, "retrieve")
+        calls.attach_mock(AtomicMock, "atomic")
+        calls.attach_mock(SyncMock, "sync")
+        AutoPagingIterMock.return_value = [Mock(), Mock()]
+        RetrieveMock.side_effect = ["objects_1", "objects_2"]
+        invoices.sync_invoices_for_customer(self.customer)
+        self.assertEquals(
+            [name for name, _, _ in calls.mock_calls if name in ["retrieve", "atomic", "sync"]],
+            ["retrieve", "retrieve", "atomic", "sync", "sync"]
+        )
+        self.assertEquals([kwargs["retrieved"] for _, kwargs in SyncMock.call_args_list], ["objects_1", "objects_2"])
+
+    @patch("pinax.stripe.actions.invoices.sync_invoice_from_stripe_data")
+    @patch("stripe.Invoice.auto_paging_iter", create=True)
+    def test_sync_invoices_for_customer_since_newest(self, AutoPagingIterMock, SyncMock):
+        AutoPagingIterMock.return_value = []
+        date = datetime.datetime(2018, 1, 1, tzinfo=timezone.utc)
+        Invoice.objects.create(stripe_id="in_1", customer=self.customer, amount_due=1, subtotal=1, total=1, period_start=date, period_end=date, date=date)
+        invoices.sync_invoices_for_customer(self.customer)
+        AutoPagingIterMock.assert_called_once_with(customer=self.customer.stripe_id, stripe_account=None, limit=100, date={"gte": 1514764800})
+
+    @patch("pinax.stripe.actions.invoices.retrieve_invoice_objects")
+    @patch("pinax.stripe.actions.invoices.sync_invoice_from_stripe_data")
+    @patch("stripe.Invoice.list")
+    @patch("stripe.Invoice.auto_paging_iter", create=True, side_effect=AttributeError)
+    def test_sync_invoices_for_customer_deprecated(self, AutoPagingIterMock, ListMock, SyncMock, RetrieveMock):
+        ListMock.return_value.data = [Mock()]
         invoices.sync_invoices_for_customer(self.customer)
         self.assertTrue(SyncMock.called)
 
-    @patch("pinax.stripe.actions.charges.sync_charge_from_stripe_data")
-    @patch("stripe.Customer.retrieve")
-    def test_sync_charges_for_customer(self, RetreiveMock, SyncMock):
-        RetreiveMock().charges().data = [Mock()]
+    def charge_data(self, stripe_id, created, **kwargs):
+        data = {
+            "id": stripe_id,
+            "object": "charge",
+            "amount": 200,
+            "amount_refunded": 0,
+            "balance_transaction": "txn_1",
+            "captured": True,
+            "created": created,
+            "currency": "usd",
+            "customer": self.customer.stripe_id,
+            "description": None,
+            "dispute": None,
+            "invoice": None,
+            "outcome": None,
+            "paid": True,
+            "refunded": False,
+            "source": {"id": "card_1", "object": "card"},
+            "transfer_group": None
+        }
+        data.update(kwargs)
+        return data
+
+    @patch("stripe.Charge.auto_paging_iter", create=True)
+    def test_sync_charges_for_customer(self, AutoPagingIterMock):
+        date = datetime.datetime(2018, 1, 1, tzinfo=timezone.utc)
+        invoice = Invoice.objects.create(stripe_id="in_1", customer=self.customer, amount_due=1, subtotal=1, total=1, period_start=date, period_end=date, date=date)
+        AutoPagingIterMock.return_value = [
+            self.charge_data("ch_2", 1514764900, invoice="in_1"),
+            self.charge_data("ch_1", 1514764800, description="First"),
+        ]
         charges.sync_charges_for_customer(self.customer)
-        self.assertTrue(SyncMock.called)
+        AutoPagingIterMock.assert_called_once_with(customer=self.customer.stripe_id, stripe_account=None, limit=100)
+        self.assertEquals(Charge.objects.get(stripe_id="ch_2").invoice, invoice)
+        self.assertEquals(Charge.objects.get(stripe_id="ch_1").description, "First")
+        self.assertEquals(Charge.objects.get(stripe_id="ch_1").customer, self.customer)
+        self.assertEquals(Charge.objects.get(stripe_id="ch_1").amount, decimal.Decimal("2"))
+
+        AutoPagingIterMock.reset_mock()
+        AutoPagingIterMock.return_value = [self.charge_data("ch_2", 1514764900, refunded=True)]
+        charges.sync_charges_for_customer(self.customer)
+        AutoPagingIterMock.assert_called_once_with(customer=self.customer.stripe_id, stripe_account=None, limit=100, created={"gte": 1514764900})
+        self.assertEquals(Charge.objects.get(stripe_id="ch_2").amount_refunded, decimal.Decimal("2"))
+        self.assertEquals(Charge.objects.count(), 2)
+
+    @patch("stripe.Charge.list")
+    @patch("stripe.Charge.auto_paging_iter", create=True, side_effect=AttributeError)
+    def test_sync_charges_for_customer_deprecated(self, AutoPagingIterMock, ListMock):
+        ListMock.return_value.data = [self.charge_data("ch_1", 1514764800)]
+        charges.sync_charges_for_customer(self.customer)
+        self.assertTrue(Charge.objects.filter(stripe_id="ch_1").exists())
 
     def test_sync_charge_from_stripe_data(self):
         data = {
@@ -1899,6 +2625,16 @@ class SyncsTests(TestCase):
         charges.sync_charge_from_stripe_data(data)
         charge = Charge.objects.get(customer=self.customer, stripe_id=data["id"])
         self.assertEquals(charge.amount, decimal.Decimal("2"))
+        with CaptureQueriesContext(connection) as queries:
+            charges.sync_charge_from_stripe_data(data)
+        self.assertFalse(statements(queries, "UPDATE"))
+        data["captured"] = False
+        with CaptureQueriesContext(connection) as queries:
+            charges.sync_charge_from_stripe_data(data)
+        updates = statements(queries, "UPDATE")
+        self.assertEquals(len(updates), 1)
+        self.assertNotIn('"amount"', updates[0])
+        self.assertFalse(Charge.objects.get(stripe_id=data["id"]).captured)
 
     def test_sync_charge_from_stripe_data_balance_transaction(self):
         data = {
@@ -2651,6 +3387,80 @@ class SyncsTests(TestCase):
         self.assertEquals(invoice.items.count(), 2)
         self.assertEquals(invoice.items.get(stripe_id="sub_7Q4BX0HMfqTpN9").description, "This is your second subscription")
 
+    def test_sync_invoice_items_removes_stale_and_skips_unchanged(self):
+        Plan.objects.create(stripe_id="pro2", interval="month", interval_count=1, amount=decimal.Decimal("19.99"))
+        invoice = Invoice.objects.create(
+            stripe_id="inv_001",
+            customer=self.customer,
+            amount_due=100,
+            period_end=timezone.now(),
+            period_start=timezone.now(),
+            subtotal=100,
+            total=100,
+            date=timezone.now()
+        )
+        items = [{
+            "id": "ii_{}".format(i),
+            "object": "line_item",
+            "amount": 2000,
+            "currency": "usd",
+            "description": "Item {}".format(i),
+            "period": {
+                "start": 1448499344,
+                "end": 1448758544
+            },
+            "plan": {"id": "pro2"},
+            "proration": False,
+            "quantity": 1,
+            "type": "invoiceitem"
+        } for i in range(3)]
+        invoices.sync_invoice_items(invoice, items)
+        self.assertEquals(invoice.items.count(), 3)
+        self.assertEquals(set(item.plan.stripe_id for item in invoice.items.all()), {"pro2"})
+
+        with CaptureQueriesContext(connection) as queries:
+            summary = invoices.sync_invoice_items(invoice, items[:2])
+        self.assertEquals(summary.unchanged, 2)
+        self.assertEquals(sorted(invoice.items.values_list("stripe_id", flat=True)), ["ii_0", "ii_1"])
+        self.assertFalse(statements(queries, "INSERT", "UPDATE"))
+        # existing items, plans, the upsert lookup and the delete
+        self.assertEquals(len(statements(queries, "SELECT")), 3)
+
+    @override_settings(PINAX_STRIPE_CATALOG_CACHE_TTL=300)
+    def test_sync_invoice_items_connect(self):
+        self.cache_catalog()
+        plan = self.connect_plan()
+        invoice = Invoice.objects.create(
+            stripe_id="inv_001",
+            customer=self.customer,
+            amount_due=100,
+            period_end=timezone.now(),
+            period_start=timezone.now(),
+            subtotal=100,
+            total=100,
+            date=timezone.now()
+        )
+        items = [{
+            "id": "ii_1",
+            "object": "line_item",
+            "amount": 2000,
+            "currency": "usd",
+            "description": "Item",
+            "period": {
+                "start": 1448499344,
+                "end": 1448758544
+            },
+            "plan": {"id": "pro2"},
+            "proration": False,
+            "quantity": 1,
+            "type": "invoiceitem"
+        }]
+        invoices.sync_invoice_items(invoice, items)
+        invoices.sync_invoice_items(invoice, items)
+        self.assertEquals(invoice.items.get().plan, plan)
+        self.assertEquals(catalog.stats()["hits"], 1)
+        self.assertEquals(catalog.stats()["misses"], 1)
+
     def test_sync_order_from_stripe_data(self):
 
         order_source = {
@@ -6,7 +6,7 @@ from django.test import Client, SimpleTestCase, TestCase
 from django.test.utils import CaptureQueriesContext
 from django.utils import timezone
 
-from ..models import Account, Customer, Invoice, Plan, Subscription, Sku, Order, Product
+from ..models import Account, Customer, Event, Invoice, Plan, Subscription, Sku, Order, Product
 
 try:
     from django.urls import reverse
@@ -210,6 +210,25 @@ class AdminTestCase(TestCase):
         response = self.client.get(url)
         self.assertEqual(response.status_code, 200)
 
+    def test_event_admin(self):
+        url = reverse("admin:pinax_stripe_event_changelist")
+        for retries in ["scheduled", "dead"]:
+            response = self.client.get(url, {"retries": retries})
+            self.assertEqual(response.status_code, 200)
+
+    def test_event_admin_requeue(self):
+        event = Event.objects.create(
+            stripe_id="evt_001", kind="account.updated", webhook_message={}, valid=True, attempts=8,
+            dead_lettered_at=timezone.now()
+        )
+        url = reverse("admin:pinax_stripe_event_changelist")
+        response = self.client.post(url, {"action": "requeue_events", "_selected_action": [event.pk]})
+        self.assertEqual(response.status_code, 302)
+        event.refresh_from_db()
+        self.assertIsNone(event.dead_lettered_at)
+        self.assertEqual(event.attempts, 0)
+
+
 class AdminSimpleTestCase(SimpleTestCase):
 
     def test_customer_user_without_user(self):
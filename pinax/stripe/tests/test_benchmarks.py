@@ -0,0 +1,421 @@
+"""
+Query count and Stripe API call count of the sync functions and webhooks,
+checked against the baseline stored in benchmarks.json
+
+Everything runs offline against the local Stripe stand-in. After a change
+that is expected to alter the costs, refresh the baseline with:
+
+    PINAX_STRIPE_BENCHMARKS_UPDATE=1 python runtests.py pinax.stripe.tests.test_benchmarks
+"""
+import copy
+import hashlib
+import hmac
+import json
+import os
+import time
+
+from django.contrib.auth import get_user_model
+from django.contrib.sites.models import Site
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+
+from mock import patch
+
+from ..actions import accounts, charges, customers, invoices, subscriptions
+from ..http_client import HTTPClient, PooledRequestsClient, count_requests
+from ..models import Customer, Event, Plan
+from ..webhooks import registry
+from . import TRANSFER_CREATED_TEST_DATA
+from .stripe_server import StripeServer
+
+BASELINE_PATH = os.path.join(os.path.dirname(__file__), "benchmarks.json")
+UPDATE = bool(os.environ.get("PINAX_STRIPE_BENCHMARKS_UPDATE"))
+
+SIGNING_SECRET = "whsec_XXX"
+
+PLAN = {
+    "id": "pro",
+    "object": "plan",
+    "amount": 1999,
+    "created": 1448121054,
+    "currency": "usd",
+    "interval": "month",
+    "interval_count": 1,
+    "livemode": False,
+    "metadata": {},
+    "name": "The Pro Plan",
+    "statement_descriptor": None,
+    "trial_period_days": None
+}
+
+CARD = {
+    "id": "card_XXX",
+    "object": "card",
+    "address_city": None,
+    "address_country": None,
+    "address_line1": None,
+    "address_line1_check": None,
+    "address_line2": None,
+    "address_state": None,
+    "address_zip": "10001",
+    "address_zip_check": "pass",
+    "brand": "Visa",
+    "country": "US",
+    "customer": "cus_XXX",
+    "cvc_check": "pass",
+    "dynamic_last4": None,
+    "exp_month": 12,
+    "exp_year": 2030,
+    "fingerprint": "Xt5EWLLDS7FJjR1c",
+    "funding": "credit",
+    "last4": "4242",
+    "metadata": {},
+    "name": None
+}
+
+SUBSCRIPTION = {
+    "id": "sub_XXX",
+    "object": "subscription",
+    "application_fee_percent": None,
+    "cancel_at_period_end": False,
+    "canceled_at": None,
+    "created": 1448499344,
+    "current_period_end": 1451177744,
+    "current_period_start": 1448499344,
+    "customer": "cus_XXX",
+    "discount": None,
+    "ended_at": None,
+    "items": {
+        "object": "list",
+        "data": [{
+            "id": "si_XXX",
+            "object": "subscription_item",
+            "created": 1448499344,
+            "metadata": {},
+            "plan": PLAN,
+            "quantity": 1,
+            "subscription": "sub_XXX"
+        }],
+        "has_more": False,
+        "total_count": 1
+    },
+    "metadata": {},
+    "plan": PLAN,
+    "quantity": 1,
+    "start": 1448499344,
+    "status": "active",
+    "tax_percent": None,
+    "trial_end": None,
+    "trial_start": None
+}
+
+CUSTOMER = {
+    "id": "cus_XXX",
+    "object": "customer",
+    "account_balance": 0,
+    "created": 1448499344,
+    "currency": "usd",
+    "default_source": "card_XXX",
+    "delinquent": False,
+    "description": None,
+    "discount": None,
+    "email": "patrick@example.com",
+    "livemode": False,
+    "metadata": {},
+    "sources": {"object": "list", "data": [CARD], "has_more": False, "total_count": 1},
+    "subscriptions": {"object": "list", "data": [SUBSCRIPTION], "has_more": False, "total_count": 1}
+}
+
+BALANCE_TRANSACTION = {
+    "id": "txn_XXX",
+    "object": "balance_transaction",
+    "amount": 1999,
+    "available_on": 1449100800,
+    "currency": "usd",
+    "fee": 88,
+    "net": 1911,
+    "status": "pending",
+    "type": "charge"
+}
+
+CHARGE = {
+    "id": "ch_XXX",
+    "object": "charge",
+    "amount": 1999,
+    "amount_refunded": 0,
+    "balance_transaction": BALANCE_TRANSACTION,
+    "captured": True,
+    "created": 1448499345,
+    "currency": "usd",
+    "customer": "cus_XXX",
+    "description": None,
+    "dispute": None,
+    "invoice": "in_XXX",
+    "outcome": {"network_status": "approved_by_network", "type": "authorized"},
+    "paid": True,
+    "refunded": False,
+    "source": CARD,
+    "transfer_group": None
+}
+
+DISPUTE = {
+    "id": "dp_XXX",
+    "object": "dispute",
+    "amount": 1999,
+    "charge": "ch_XXX",
+    "currency": "usd",
+    "status": "needs_response"
+}
+
+INVOICE = {
+    "id": "in_XXX",
+    "object": "invoice",
+    "amount_due": 1999,
+    "attempt_count": 1,
+    "attempted": True,
+    "charge": "ch_XXX",
+    "closed": True,
+    "currency": "usd",
+    "customer": "cus_XXX",
+    "date": 1448499344,
+    "lines": {
+        "object": "list",
+        "data": [{
+            "id": "sub_XXX",
+            "object": "line_item",
+            "amount": 1999,
+            "currency": "usd",
+            "description": None,
+            "period": {"start": 1448499344, "end": 1451177744},
+            "plan": PLAN,
+            "proration": False,
+            "quantity": 1,
+            "type": "subscription"
+        }],
+        "has_more": False,
+        "total_count": 1
+    },
+    "metadata": {},
+    "paid": True,
+    "period_end": 1448499344,
+    "period_start": 1448499344,
+    "receipt_number": None,
+    "subscription": "sub_XXX",
+    "subtotal": 1999,
+    "tax": None,
+    "tax_percent": None,
+    "total": 1999
+}
+
+ACCOUNT = {
+    "id": "acct_XXX",
+    "object": "account",
+    "business_name": "Pinax",
+    "business_url": None,
+    "charges_enabled": True,
+    "country": "US",
+    "debit_negative_balances": False,
+    "decline_charge_on": {"avs_failure": False, "cvc_failure": False},
+    "default_currency": "usd",
+    "details_submitted": True,
+    "display_name": "Pinax",
+    "email": "pinax@example.com",
+    "external_accounts": {
+        "object": "list",
+        "data": [{
+            "id": "ba_XXX",
+            "object": "bank_account",
+            "account": "acct_XXX",
+            "account_holder_name": "Pinax",
+            "account_holder_type": "company",
+            "bank_name": "STRIPE TEST BANK",
+            "country": "US",
+            "currency": "usd",
+            "default_for_currency": True,
+            "fingerprint": "XXX",
+            "last4": "6789",
+            "metadata": {},
+            "routing_number": "110000000",
+            "status": "new"
+        }],
+        "has_more": False,
+        "total_count": 1
+    },
+    "legal_entity": {
+        "address": {"city": None, "country": "US", "line1": None, "line2": None, "postal_code": None, "state": None},
+        "dob": {"day": 1, "month": 1, "year": 1980},
+        "first_name": "Patrick",
+        "last_name": "Altman",
+        "personal_id_number_provided": False,
+        "type": "individual",
+        "verification": {"details": None, "details_code": None, "document": None, "status": "unverified"}
+    },
+    "metadata": {},
+    "payout_schedule": {"delay_days": 2, "interval": "daily"},
+    "payout_statement_descriptor": None,
+    "payouts_enabled": True,
+    "product_description": None,
+    "statement_descriptor": "PINAX",
+    "support_email": None,
+    "support_phone": None,
+    "timezone": "Etc/UTC",
+    "tos_acceptance": {"date": 1448499344, "ip": "127.0.0.1", "user_agent": None},
+    "type": "custom",
+    "verification": {"disabled_reason": None, "due_by": None, "fields_needed": []}
+}
+
+TRANSFER = TRANSFER_CREATED_TEST_DATA["data"]["object"]
+
+
+def webhook_object(kind):
+    """
+    The object a realistic event of the given kind carries
+    """
+    if kind == "account.updated":
+        return ACCOUNT
+    if kind.startswith("charge.dispute."):
+        return DISPUTE
+    if kind.startswith("charge."):
+        return dict(CHARGE, balance_transaction=BALANCE_TRANSACTION["id"])
+    if kind in ["customer.created", "customer.updated", "customer.deleted"]:
+        return CUSTOMER
+    if kind.startswith("customer.source."):
+        return CARD
+    if kind.startswith("customer.subscription."):
+        return SUBSCRIPTION
+    if kind.startswith("invoice."):
+        return INVOICE
+    if kind.startswith("plan."):
+        return PLAN
+    if kind.startswith("transfer."):
+        return TRANSFER
+    return {"id": "obj_XXX", "object": kind.split(".")[0]}
+
+
+class BenchmarkTests(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super(BenchmarkTests, cls).setUpClass()
+        with open(BASELINE_PATH) as f:
+            cls.baseline = json.load(f)
+        cls.results = {}
+        cls.server = StripeServer().__enter__()
+        cls.client = PooledRequestsClient()
+        cls.patchers = [
+            patch("stripe.api_base", cls.server.url),
+            patch("stripe.default_http_client", HTTPClient(cls.client)),
+        ]
+        for patcher in cls.patchers:
+            patcher.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        for patcher in cls.patchers:
+            patcher.stop()
+        cls.client.close()
+        cls.server.__exit__()
+        if UPDATE:
+            with open(BASELINE_PATH, "w") as f:
+                json.dump(dict(cls.baseline, **cls.results), f, indent=2, sort_keys=True)
+                f.write("\n")
+        super(BenchmarkTests, cls).tearDownClass()
+
+    def setUp(self):
+        self.server.responses.clear()
+        self.server.add("/v1/customers/cus_XXX", CUSTOMER)
+        self.server.add("/v1/charges/ch_XXX", CHARGE)
+        self.server.add("/v1/subscriptions/sub_XXX", SUBSCRIPTION)
+        self.server.add("/v1/subscription_items", {"object": "list", "data": SUBSCRIPTION["items"]["data"], "has_more": False})
+        self.server.add("/v1/accounts/acct_XXX", ACCOUNT)
+        self.server.add("/v1/transfers/{}".format(TRANSFER["id"]), TRANSFER)
+        user = get_user_model().objects.create_user(username="patrick", email="patrick@example.com")
+        self.customer = Customer.objects.create(stripe_id="cus_XXX", user=user)
+        Plan.objects.create(stripe_id="pro", name="The Pro Plan", amount=19.99, interval="month", interval_count=1)
+        # the receipts look the current site up, which Django caches for the
+        # whole process; warm it so that the counts do not depend on test order
+        Site.objects.clear_cache()
+        Site.objects.get_current()
+
+    def measure(self, name, func, *args, **kwargs):
+        with CaptureQueriesContext(connection) as queries, count_requests() as requests:
+            func(*args, **kwargs)
+        result = {"queries": len(queries), "api_calls": requests.count}
+        self.results[name] = result
+        if UPDATE:
+            return result
+        baseline = self.baseline.get(name)
+        if baseline is None:
+            self.fail("No baseline for {}, see the docstring of this module".format(name))
+        self.assertLessEqual(result["queries"], baseline["queries"], "{}: {} queries, baseline is {}".format(name, result["queries"], baseline["queries"]))
+        self.assertLessEqual(result["api_calls"], baseline["api_calls"], "{}: {} API calls, baseline is {}".format(name, result["api_calls"], baseline["api_calls"]))
+        return result
+
+    def test_sync_customer(self):
+        self.measure("customers.sync_customer", customers.sync_customer, self.customer, copy.deepcopy(CUSTOMER))
+
+    def test_sync_customer_without_data(self):
+        self.measure("customers.sync_customer (fetched)", customers.sync_customer, self.customer)
+
+    def test_sync_invoice_from_stripe_data(self):
+        self.measure("invoices.sync_invoice_from_stripe_data", invoices.sync_invoice_from_stripe_data, copy.deepcopy(INVOICE))
+
+    def test_sync_charge_from_stripe_data(self):
+        self.measure("charges.sync_charge_from_stripe_data", charges.sync_charge_from_stripe_data, copy.deepcopy(CHARGE))
+
+    def test_sync_subscription_from_stripe_data(self):
+        self.measure("subscriptions.sync_subscription_from_stripe_data", subscriptions.sync_subscription_from_stripe_data, self.customer, copy.deepcopy(SUBSCRIPTION))
+
+    def test_sync_account_from_stripe_data(self):
+        self.measure("accounts.sync_account_from_stripe_data", accounts.sync_account_from_stripe_data, copy.deepcopy(ACCOUNT))
+
+    def process_webhook(self, kind, payload_first=False, signature=False):
+        message = {
+            "id": "evt_XXX",
+            "object": "event",
+            "api_version": "2015-10-16",
+            "created": 1448499345,
+            "data": {"object": copy.deepcopy(webhook_object(kind))},
+            "livemode": False,
+            "pending_webhooks": 1,
+            "type": kind
+        }
+        self.server.add("/v1/events/evt_XXX", message)
+        event = Event.objects.create(stripe_id="evt_XXX", kind=kind, webhook_message=message)
+        webhook_class = registry.get(kind)
+        payload = json.dumps(message)
+        timestamp = int(time.time())
+        header = "t={},v1={}".format(timestamp, hmac.new(
+            SIGNING_SECRET.encode("utf-8"),
+            "{}.{}".format(timestamp, payload).encode("utf-8"),
+            hashlib.sha256
+        ).hexdigest())
+
+        def receive():
+            # as the webhook view does, a verified payload is not fetched again
+            if signature and webhook_class.check_signature(payload, header):
+                event.validated_message = message
+            webhook_class(event).process()
+
+        name = "webhook {}{}".format(kind, " (payload first)" if payload_first else " (signature)" if signature else "")
+        with self.settings(
+            PINAX_STRIPE_WEBHOOK_PAYLOAD_FIRST=payload_first,
+            PINAX_STRIPE_WEBHOOK_VALIDATION="signature" if signature else "retrieve",
+            PINAX_STRIPE_WEBHOOK_SIGNING_SECRETS=[SIGNING_SECRET]
+        ):
+            self.measure(name, receive)
+        event.refresh_from_db()
+        self.assertTrue(event.processed, "{} was not processed".format(kind))
+
+
+def webhook_test(kind, payload_first, signature):
+    def test(self):
+        self.process_webhook(kind, payload_first, signature)
+    return test
+
+
+for kind in registry.keys():
+    for suffix, payload_first, signature in [("", False, False), ("_payload_first", True, False), ("_signature", False, True)]:
+        name = "test_webhook_{}{}".format(kind.replace(".", "_"), suffix)
+        setattr(BenchmarkTests, name, webhook_test(kind, payload_first, signature))
@@ -0,0 +1,105 @@
+import datetime
+import decimal
+
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from ..bulk import chunked, upsert
+from ..models import Account, Coupon, Customer, Invoice, InvoiceItem, Plan
+
+
+def plan(stripe_id, amount=decimal.Decimal("9.99"), name="Pro"):
+    return stripe_id, {
+        "amount": amount,
+        "currency": "usd",
+        "interval": "month",
+        "interval_count": 1,
+        "name": name,
+        "statement_descriptor": "",
+        "trial_period_days": None,
+        "metadata": {"tier": "pro"}
+    }
+
+
+class ChunkedTests(TestCase):
+
+    def test_chunked(self):
+        self.assertEquals(list(chunked(range(5), 2)), [[0, 1], [2, 3], [4]])
+
+    def test_chunked_empty(self):
+        self.assertEquals(list(chunked([], 2)), [])
+
+
+class UpsertTests(TestCase):
+
+    def test_create(self):
+        summary = upsert(Plan, [plan("pro1"), plan("pro2")], stripe_account=None)
+        self.assertEquals((summary.created, summary.updated, summary.unchanged), (2, 0, 0))
+        self.assertEquals(Plan.objects.count(), 2)
+        self.assertEquals(Plan.objects.get(stripe_id="pro1").metadata, {"tier": "pro"})
+        self.assertEquals([obj.stripe_id for obj in summary.objects], ["pro1", "pro2"])
+        self.assertTrue(all(obj.pk for obj in summary.objects))
+
+    def test_update_only_changed(self):
+        upsert(Plan, [plan("pro1"), plan("pro2")])
+        summary = upsert(Plan, [plan("pro1", name="Pro One"), plan("pro2"), plan("pro3")])
+        self.assertEquals((summary.created, summary.updated, summary.unchanged), (1, 1, 1))
+        self.assertEquals(Plan.objects.get(stripe_id="pro1").name, "Pro One")
+        self.assertEquals(Plan.objects.count(), 3)
+
+    def test_unchanged_costs_one_query_per_chunk(self):
+        rows = [plan("pro{}".format(i)) for i in range(10)]
+        upsert(Plan, rows)
+        with CaptureQueriesContext(connection) as queries:
+            summary = upsert(Plan, rows, chunk_size=4)
+        self.assertEquals(summary.unchanged, 10)
+        self.assertEquals(len(queries), 3)
+
+    def test_decimal_precision_is_not_a_change(self):
+        upsert(Plan, [plan("pro1", amount=decimal.Decimal("10"))])
+        summary = upsert(Plan, [plan("pro1", amount=decimal.Decimal("10.00"))])
+        self.assertEquals(summary.unchanged, 1)
+
+    def test_last_duplicate_wins(self):
+        summary = upsert(Plan, [plan("pro1", name="First"), plan("pro1", name="Last")])
+        self.assertEquals(summary.created, 1)
+        self.assertEquals(Plan.objects.get().name, "Last")
+
+    def test_lookup(self):
+        account = Account.objects.create(stripe_id="acct_X")
+        upsert(Plan, [plan("pro1")], stripe_account=account)
+        summary = upsert(Plan, [plan("pro1")], stripe_account=None)
+        self.assertEquals(summary.created, 1)
+        self.assertEquals(Plan.objects.filter(stripe_id="pro1").count(), 2)
+        self.assertEquals(Plan.objects.get(stripe_id="pro1", stripe_account=account).stripe_account, account)
+
+    def test_other_model(self):
+        summary = upsert(Coupon, [("c1", {"percent_off": 25, "valid": True})])
+        self.assertEquals(summary.created, 1)
+        self.assertEquals(Coupon.objects.get(stripe_id="c1").percent_off, 25)
+
+    def test_foreign_keys_compared_without_fetching(self):
+        customer = Customer.objects.create(stripe_id="cus_1")
+        now = datetime.datetime(2018, 1, 1, tzinfo=timezone.utc)
+        invoice = Invoice.objects.create(
+            stripe_id="in_1", customer=customer, amount_due=0, period_end=now,
+            period_start=now, subtotal=0, total=0, date=now
+        )
+        plan = Plan.objects.create(stripe_id="pro1", amount=1, interval="month", interval_count=1)
+        rows = [("ii_1", {
+            "amount": decimal.Decimal("1"),
+            "plan": plan,
+            "period_start": now,
+            "period_end": now,
+            "line_type": "invoiceitem"
+        })]
+        upsert(InvoiceItem, rows, invoice=invoice)
+        with CaptureQueriesContext(connection) as queries:
+            summary = upsert(InvoiceItem, rows, invoice=invoice)
+        self.assertEquals(summary.unchanged, 1)
+        self.assertEquals(len(queries), 1)
+        summary = upsert(InvoiceItem, [("ii_1", dict(rows[0][1], plan=None))], invoice=invoice)
+        self.assertEquals(summary.updated, 1)
+        self.assertIsNone(InvoiceItem.objects.get().plan)
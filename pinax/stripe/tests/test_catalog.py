@@ -0,0 +1,147 @@
+import decimal
+
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext, override_settings
+
+from mock import patch
+
+from .. import catalog
+from ..actions import plans
+from ..models import Account, Event, Plan
+from ..webhooks import registry
+
+
+def create_plan(stripe_id, stripe_account=None):
+    return Plan.objects.create(
+        stripe_id=stripe_id,
+        stripe_account=stripe_account,
+        amount=decimal.Decimal("9.99"),
+        interval="month",
+        interval_count=1,
+        name="Pro"
+    )
+
+
+@override_settings(PINAX_STRIPE_CATALOG_CACHE_TTL=300, PINAX_STRIPE_CATALOG_CACHE_SIZE=3)
+class CatalogCacheTests(TestCase):
+
+    def setUp(self):
+        catalog.invalidate()
+        catalog.reset_stats()
+        self.addCleanup(catalog.invalidate)
+
+    def test_get_is_cached(self):
+        plan = create_plan("pro1")
+        self.assertEquals(catalog.get(Plan, "pro1"), plan)
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEquals(catalog.get(Plan, "pro1"), plan)
+        self.assertEquals(len(queries), 0)
+        self.assertEquals(catalog.stats(), {"hits": 1, "misses": 1, "size": 1})
+
+    def test_get_many_queries_missing_once(self):
+        create_plan("pro1")
+        create_plan("pro2")
+        catalog.get(Plan, "pro1")
+        with CaptureQueriesContext(connection) as queries:
+            found = catalog.get_many(Plan, ["pro1", "pro2", "pro3", "pro2"])
+        self.assertEquals(len(queries), 1)
+        self.assertEquals(sorted(found), ["pro1", "pro2"])
+
+    def test_does_not_exist_is_not_cached(self):
+        with self.assertRaises(Plan.DoesNotExist):
+            catalog.get(Plan, "pro1")
+        create_plan("pro1")
+        self.assertEquals(catalog.get(Plan, "pro1").stripe_id, "pro1")
+
+    @patch("pinax.stripe.catalog.time.time")
+    def test_expires(self, TimeMock):
+        TimeMock.return_value = 1000
+        create_plan("pro1")
+        catalog.get(Plan, "pro1")
+        TimeMock.return_value = 1301
+        Plan.objects.filter(stripe_id="pro1").update(name="Pro One")
+        self.assertEquals(catalog.get(Plan, "pro1").name, "Pro One")
+        self.assertEquals(catalog.stats()["misses"], 2)
+
+    def test_least_recently_used_dropped(self):
+        for i in range(4):
+            create_plan("pro{}".format(i))
+        for i in range(3):
+            catalog.get(Plan, "pro{}".format(i))
+        catalog.get(Plan, "pro0")
+        catalog.get(Plan, "pro3")
+        self.assertEquals(catalog.stats()["size"], 3)
+        with CaptureQueriesContext(connection) as queries:
+            catalog.get(Plan, "pro0")
+        self.assertEquals(len(queries), 0)
+        with CaptureQueriesContext(connection) as queries:
+            catalog.get(Plan, "pro1")
+        self.assertEquals(len(queries), 1)
+
+    def test_stripe_account(self):
+        account = Account.objects.create(stripe_id="acct_X")
+        create_plan("pro1")
+        connected = create_plan("pro1", stripe_account=account)
+        self.assertEquals(catalog.get(Plan, "pro1", stripe_account=account), connected)
+        self.assertEquals(catalog.get(Plan, "pro1", stripe_account="acct_X"), connected)
+        with self.assertRaises(Plan.DoesNotExist):
+            catalog.get(Plan, "pro1", stripe_account="acct_Y")
+
+    def test_stripe_account_and_platform_not_shared(self):
+        account = Account.objects.create(stripe_id="acct_X")
+        platform = create_plan("pro1")
+        connected = create_plan("pro1", stripe_account=account)
+        self.assertEquals(catalog.get(Plan, "pro1"), platform)
+        self.assertEquals(catalog.get(Plan, "pro1", stripe_account=account), connected)
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEquals(catalog.get(Plan, "pro1"), platform)
+            self.assertEquals(catalog.get(Plan, "pro1", stripe_account="acct_X"), connected)
+        self.assertEquals(len(queries), 0)
+        self.assertEquals(
+            sorted(catalog.cache._entries),
+            [("pinax_stripe.plan", "acct_X", "pro1"), ("pinax_stripe.plan", catalog.PLATFORM, "pro1")]
+        )
+
+    def test_without_account_falls_back_to_connected(self):
+        account = Account.objects.create(stripe_id="acct_X")
+        connected = create_plan("pro1", stripe_account=account)
+        self.assertEquals(catalog.get(Plan, "pro1"), connected)
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEquals(catalog.get(Plan, "pro1", stripe_account=account), connected)
+        self.assertEquals(len(queries), 0)
+
+    @override_settings(PINAX_STRIPE_CATALOG_CACHE_TTL=0)
+    def test_disabled(self):
+        create_plan("pro1")
+        catalog.get(Plan, "pro1")
+        with CaptureQueriesContext(connection) as queries:
+            catalog.get(Plan, "pro1")
+        self.assertEquals(len(queries), 1)
+        self.assertEquals(catalog.stats()["size"], 0)
+
+    def test_invalidate(self):
+        create_plan("pro1")
+        create_plan("pro2")
+        catalog.get_many(Plan, ["pro1", "pro2"])
+        catalog.invalidate(Plan, "pro1")
+        self.assertEquals(catalog.stats()["size"], 1)
+        catalog.invalidate(Plan)
+        self.assertEquals(catalog.stats()["size"], 0)
+
+    def test_invalidated_by_webhook(self):
+        create_plan("pro1")
+        catalog.get(Plan, "pro1")
+        message = {"id": "evt_001", "type": "plan.deleted", "data": {"object": {"id": "pro1", "object": "plan"}}}
+        event = Event.objects.create(stripe_id="evt_001", kind="plan.deleted", webhook_message=message, validated_message=message)
+        registry.get(event.kind)(event).process()
+        self.assertTrue(Event.objects.get(pk=event.pk).processed)
+        self.assertEquals(catalog.stats()["size"], 0)
+
+    @patch("stripe.Plan.auto_paging_iter", create=True)
+    def test_invalidated_by_sync(self, AutoPagerMock):
+        AutoPagerMock.return_value = iter([])
+        create_plan("pro1")
+        catalog.get(Plan, "pro1")
+        plans.sync_plans()
+        self.assertEquals(catalog.stats()["size"], 0)
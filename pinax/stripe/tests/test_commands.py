@@ -1,13 +1,32 @@
+import datetime
 import decimal
+import gzip
+import json
+import os
+import shutil
+import tempfile
 
 from django.contrib.auth import get_user_model
 from django.core import management
+from django.core.management.base import CommandError
 from django.test import TestCase
+from django.test.utils import override_settings
+from django.utils import timezone
 
+import six
 from mock import patch
 from stripe.error import InvalidRequestError
 
-from ..models import Coupon, Customer, Plan
+from .. import bulk, ratelimit
+from ..models import (
+    Coupon,
+    Customer,
+    Event,
+    EventProcessingException,
+    Plan,
+    SyncCheckpoint,
+    Transfer
+)
 
 
 class CommandTests(TestCase):
@@ -69,6 +88,26 @@ class CommandTests(TestCase):
         self.assertEquals(Plan.objects.all()[0].stripe_id, "entry-monthly")
         self.assertEquals(Plan.objects.all()[0].amount, decimal.Decimal("9.54"))
 
+    @patch("stripe.Plan.auto_paging_iter", create=True)
+    def test_plans_summary(self, PlanAutoPagerMock):
+        PlanAutoPagerMock.return_value = [{
+            "id": "entry-monthly",
+            "amount": 954,
+            "interval": "monthly",
+            "interval_count": 1,
+            "currency": None,
+            "statement_descriptor": None,
+            "trial_period_days": None,
+            "name": "Pro",
+            "metadata": {}
+        }]
+        out = six.StringIO()
+        management.call_command("sync_plans", stdout=out)
+        self.assertEquals(out.getvalue(), "1 plan(s) created, 0 updated, 0 unchanged\n")
+        out = six.StringIO()
+        management.call_command("sync_plans", stdout=out)
+        self.assertEquals(out.getvalue(), "0 plan(s) created, 0 updated, 1 unchanged\n")
+
     @patch("stripe.Coupon.auto_paging_iter", create=True)
     def test_coupons_create(self, CouponAutoPagerMock):
         CouponAutoPagerMock.return_value = [{
@@ -206,10 +245,114 @@ class CommandTests(TestCase):
         self.assertEqual(SyncInvoicesMock.call_count, 0)
         self.assertEqual(SyncOrdersMock.call_count, 0)
 
+    @patch("pinax.stripe.actions.customers.sync_customer")
+    @patch("pinax.stripe.actions.orders.sync_orders_from_customer")
+    @patch("pinax.stripe.actions.invoices.sync_invoices_for_customer")
+    @patch("pinax.stripe.actions.charges.sync_charges_for_customer")
+    def test_sync_customers_with_workers(self, SyncChargesMock, SyncInvoicesMock, SyncOrdersMock, SyncMock):
+        for i in range(5):
+            user = get_user_model().objects.create_user(username="user{}".format(i))
+            Customer.objects.create(stripe_id="cus_{}".format(i), user=user)
+        out = six.StringIO()
+        management.call_command("sync_customers", workers=3, chunk_size=2, stdout=out)
+        self.assertEqual(SyncMock.call_count, 5)
+        self.assertEqual(SyncChargesMock.call_count, 5)
+        self.assertIn("[5/5 100%] Synced", out.getvalue())
+        self.assertIn("ETA 0:00:00", out.getvalue())
+        checkpoint = SyncCheckpoint.objects.get(name="sync_customers")
+        self.assertEqual(checkpoint.cursor, str(Customer.objects.order_by("pk").last().pk))
+        self.assertIsNotNone(checkpoint.completed_at)
+
+    @patch("pinax.stripe.actions.customers.sync_customer")
+    @patch("pinax.stripe.actions.orders.sync_orders_from_customer")
+    @patch("pinax.stripe.actions.invoices.sync_invoices_for_customer")
+    @patch("pinax.stripe.actions.charges.sync_charges_for_customer")
+    def test_sync_customers_resume(self, SyncChargesMock, SyncInvoicesMock, SyncOrdersMock, SyncMock):
+        synced = []
+        for i in range(5):
+            user = get_user_model().objects.create_user(username="user{}".format(i))
+            Customer.objects.create(stripe_id="cus_{}".format(i), user=user)
+
+        def sync_customer(customer):
+            if customer.stripe_id == "cus_3" and len(synced) == 3:
+                raise InvalidRequestError("Server error", None, http_status=500)
+            synced.append(customer.stripe_id)
+        SyncMock.side_effect = sync_customer
+
+        with self.assertRaises(InvalidRequestError):
+            management.call_command("sync_customers", chunk_size=2, stdout=six.StringIO())
+        checkpoint = SyncCheckpoint.objects.get(name="sync_customers")
+        self.assertEqual(checkpoint.cursor, str(Customer.objects.get(stripe_id="cus_1").pk))
+        self.assertIsNone(checkpoint.completed_at)
+
+        out = six.StringIO()
+        management.call_command("sync_customers", resume=True, chunk_size=2, stdout=out)
+        self.assertEqual(synced, ["cus_0", "cus_1", "cus_2", "cus_2", "cus_3", "cus_4"])
+        self.assertIn("Resuming after customer", out.getvalue())
+        self.assertIn("[5/5 100%]", out.getvalue())
+
+        # a completed run is not resumed
+        management.call_command("sync_customers", resume=True, stdout=six.StringIO())
+        self.assertEqual(len(synced), 11)
+
+    @patch("pinax.stripe.actions.customers.sync_customer")
+    @patch("pinax.stripe.actions.orders.sync_orders_from_customer")
+    @patch("pinax.stripe.actions.invoices.sync_invoices_for_customer")
+    @patch("pinax.stripe.actions.charges.sync_charges_for_customer")
+    def test_sync_customers_since(self, SyncChargesMock, SyncInvoicesMock, SyncOrdersMock, SyncMock):
+        user = get_user_model().objects.create_user(username="old")
+        Customer.objects.create(stripe_id="cus_old", user=user, created_at=timezone.now() - datetime.timedelta(days=10))
+        Customer.objects.create(stripe_id="cus_new", user=self.user)
+        since = (timezone.now() - datetime.timedelta(days=1)).date().isoformat()
+        management.call_command("sync_customers", since=since, stdout=six.StringIO())
+        self.assertEqual(SyncMock.call_count, 1)
+        self.assertEqual(SyncMock.call_args[0][0].stripe_id, "cus_new")
+
+    def test_sync_customers_since_invalid(self):
+        with self.assertRaises(management.CommandError):
+            management.call_command("sync_customers", since="yesterday")
+
+    @patch("pinax.stripe.actions.events.sync_since")
+    def test_sync_since(self, SyncSinceMock):
+        SyncSinceMock.return_value = 2
+        out = six.StringIO()
+        management.call_command("sync_since", since="2018-01-01", account=["acct_1"], stdout=out)
+        self.assertEqual(SyncSinceMock.call_args_list, [
+            [(), {"created": 1514764800, "stripe_account": None}],
+            [(), {"created": 1514764800, "stripe_account": "acct_1"}],
+        ])
+        self.assertEqual(out.getvalue(), "Added 4 event(s)\n")
+
+    @patch("pinax.stripe.actions.events.sync_since")
+    def test_sync_since_checkpoint(self, SyncSinceMock):
+        SyncSinceMock.return_value = 0
+        management.call_command("sync_since", stdout=six.StringIO())
+        SyncSinceMock.assert_called_once_with(created=None, stripe_account=None)
+
+    def test_sync_since_invalid(self):
+        with self.assertRaises(management.CommandError):
+            management.call_command("sync_since", since="yesterday")
+
     @patch("pinax.stripe.actions.charges.update_charge_availability")
     def test_update_charge_availability(self, UpdateChargeMock):
         management.call_command("update_charge_availability")
         self.assertEqual(UpdateChargeMock.call_count, 1)
+        UpdateChargeMock.assert_called_once_with(from_balance_transactions=False)
+
+    @patch("pinax.stripe.actions.charges.update_charge_availability")
+    def test_update_charge_availability_balance_transactions(self, UpdateChargeMock):
+        management.call_command("update_charge_availability", balance_transactions=True)
+        UpdateChargeMock.assert_called_once_with(from_balance_transactions=True)
+
+    @patch("pinax.stripe.actions.plans.sync_plans")
+    def test_sync_plans_batch_priority(self, SyncPlansMock):
+        def sync_plans():
+            self.assertEqual(ratelimit.current_priority(), ratelimit.BATCH)
+            return bulk.UpsertSummary()
+        SyncPlansMock.side_effect = sync_plans
+        management.call_command("sync_plans")
+        self.assertEqual(SyncPlansMock.call_count, 1)
+        self.assertEqual(ratelimit.current_priority(), ratelimit.INTERACTIVE)
 
     @patch("pinax.stripe.actions.orders.sync_orders")
     def test_sync_orders(self, SyncOrdersMock):
@@ -219,4 +362,183 @@ class CommandTests(TestCase):
     @patch("pinax.stripe.actions.products.sync_products")
     def test_sync_products(self, SyncProductsMock):
         management.call_command("sync_products")
-        self.assertEqual(SyncProductsMock.call_count, 1)
\ No newline at end of file
+        self.assertEqual(SyncProductsMock.call_count, 1)
+
+    @patch("pinax.stripe.webhooks.AccountUpdatedWebhook.process")
+    def test_process_events(self, ProcessMock):
+        Event.objects.create(stripe_id="evt_001", kind="account.updated", webhook_message={})
+        Event.objects.create(stripe_id="evt_002", kind="account.updated", webhook_message={})
+        Event.objects.create(stripe_id="evt_003", kind="account.updated", webhook_message={}, processed=True, valid=True)
+        management.call_command("process_events", batch_size=1, stdout=six.StringIO())
+        self.assertEqual(ProcessMock.call_count, 2)
+
+    @patch("pinax.stripe.actions.events.process_event")
+    def test_process_events_with_workers(self, ProcessMock):
+        for i in range(5):
+            Event.objects.create(stripe_id="evt_00{}".format(i), kind="account.updated", webhook_message={})
+        out = six.StringIO()
+        management.call_command("process_events", workers=3, stdout=out)
+        self.assertEqual(ProcessMock.call_count, 5)
+        self.assertIn("Processed 5 event(s)", out.getvalue())
+
+    @patch("pinax.stripe.actions.events.process_event")
+    def test_process_events_error(self, ProcessMock):
+        Event.objects.create(stripe_id="evt_001", kind="account.updated", webhook_message={})
+        ProcessMock.side_effect = Exception("boom")
+        out, err = six.StringIO(), six.StringIO()
+        management.call_command("process_events", stdout=out, stderr=err)
+        self.assertIn("Error processing evt_001: boom", err.getvalue())
+        self.assertIn("Processed 0 event(s)", out.getvalue())
+
+    @patch("pinax.stripe.actions.events.process_event")
+    def test_process_events_in_order_per_customer(self, ProcessMock):
+        for i in range(6):
+            Event.objects.create(
+                stripe_id="evt_00{}".format(i), kind="invoice.updated", webhook_message={},
+                partition_key="cus_{}".format(i % 2)
+            )
+        out = six.StringIO()
+        management.call_command("process_events", workers=2, stdout=out)
+        processed = [call[0][0].stripe_id for call in ProcessMock.call_args_list]
+        self.assertEqual([stripe_id for stripe_id in processed if int(stripe_id[-1]) % 2], ["evt_001", "evt_003", "evt_005"])
+        self.assertEqual([stripe_id for stripe_id in processed if not int(stripe_id[-1]) % 2], ["evt_000", "evt_002", "evt_004"])
+        self.assertIn("Processed 6 event(s)", out.getvalue())
+        self.assertIn("event(s) in", out.getvalue())
+
+    @patch("pinax.stripe.actions.events.process_event")
+    def test_process_events_stops_group_on_error(self, ProcessMock):
+        for i in range(3):
+            Event.objects.create(stripe_id="evt_00{}".format(i), kind="invoice.updated", webhook_message={}, partition_key="cus_1")
+        ProcessMock.side_effect = [Exception("boom")]
+        out, err = six.StringIO(), six.StringIO()
+        management.call_command("process_events", batch_size=1, stdout=out, stderr=err)
+        self.assertEqual(ProcessMock.call_count, 1)
+        self.assertIn("Processed 0 event(s)", out.getvalue())
+
+    @patch("pinax.stripe.webhooks.retry_delay")
+    @patch("pinax.stripe.webhooks.InvoiceWebhook.process_webhook")
+    def test_process_events_in_order_after_retry(self, ProcessWebhookMock, RetryDelayMock):
+        RetryDelayMock.return_value = 3600
+        ProcessWebhookMock.side_effect = [Exception("boom")]
+        for i in range(3):
+            message = {"data": {"object": {"id": "in_{}".format(i), "object": "invoice", "customer": "cus_1"}}}
+            Event.objects.create(
+                stripe_id="evt_00{}".format(i), kind="invoice.updated", webhook_message=message, validated_message=message,
+                partition_key="cus_1"
+            )
+        management.call_command("process_events", batch_size=1, stdout=six.StringIO(), stderr=six.StringIO())
+        # as if the claims left by the first run had expired
+        Event.objects.update(claimed_by="", claimed_at=None)
+        management.call_command("process_events", batch_size=1, stdout=six.StringIO(), stderr=six.StringIO())
+        self.assertEqual(ProcessWebhookMock.call_count, 1)
+        first = Event.objects.get(stripe_id="evt_000")
+        self.assertEqual(first.attempts, 1)
+        self.assertIsNotNone(first.next_attempt_at)
+        self.assertFalse(Event.objects.filter(processed=True).exists())
+
+    @patch("pinax.stripe.management.commands.process_events.time.sleep")
+    @patch("pinax.stripe.webhooks.retry_delay")
+    @patch("pinax.stripe.webhooks.InvoiceWebhook.process_webhook")
+    def test_process_events_loop_retries(self, ProcessWebhookMock, RetryDelayMock, SleepMock):
+        RetryDelayMock.return_value = 0
+        ProcessWebhookMock.side_effect = [Exception("boom"), None, None, None]
+        SleepMock.side_effect = [None, KeyboardInterrupt]
+        for i in range(3):
+            message = {"data": {"object": {"id": "in_{}".format(i), "object": "invoice", "customer": "cus_1"}}}
+            Event.objects.create(
+                stripe_id="evt_00{}".format(i), kind="invoice.updated", webhook_message=message, validated_message=message,
+                partition_key="cus_1"
+            )
+        with self.assertRaises(KeyboardInterrupt):
+            management.call_command("process_events", loop=True, stdout=six.StringIO(), stderr=six.StringIO())
+        self.assertEqual(ProcessWebhookMock.call_count, 4)
+        self.assertEqual(Event.objects.filter(processed=True).count(), 3)
+        self.assertEqual(Event.objects.get(stripe_id="evt_000").attempts, 1)
+
+    @override_settings(PINAX_STRIPE_EVENT_COALESCE_WINDOW=60)
+    @patch("pinax.stripe.webhooks.InvoiceWebhook.process_webhook")
+    def test_process_events_coalesced(self, ProcessWebhookMock):
+        message = {"data": {"object": {"id": "in_1", "object": "invoice", "customer": "cus_1"}}}
+        for i, kind in enumerate(["invoice.created", "invoice.updated", "invoice.payment_succeeded"]):
+            Event.objects.create(
+                stripe_id="evt_00{}".format(i), kind=kind, webhook_message=message, validated_message=message,
+                partition_key="cus_1"
+            )
+        out = six.StringIO()
+        management.call_command("process_events", stdout=out)
+        self.assertEqual(ProcessWebhookMock.call_count, 1)
+        self.assertEqual(Event.objects.filter(processed=True).count(), 3)
+        self.assertIn("Processed 3 event(s)", out.getvalue())
+        self.assertIn("Coalesced 2 event(s)", out.getvalue())
+
+    def test_compress_events(self):
+        message = {"id": "evt_001", "data": {"object": {"id": "cus_1", "object": "customer"}}}
+        for i in range(3):
+            Event.objects.create(stripe_id="evt_00{}".format(i), kind="customer.updated", webhook_message=message, validated_message=message)
+        out, err = six.StringIO(), six.StringIO()
+        with override_settings(PINAX_STRIPE_EVENT_COMPRESSION=True):
+            management.call_command("compress_events", batch_size=2, stdout=out, stderr=err)
+        self.assertIn("Compressed 3 event(s) from", out.getvalue())
+        self.assertEquals(err.getvalue(), "")
+        self.assertFalse(Event.objects.filter(compressed_messages__isnull=True).exists())
+        self.assertEquals(Event.objects.get(stripe_id="evt_001").validated_message, message)
+
+        management.call_command("compress_events", decompress=True, stdout=out, stderr=err)
+        self.assertIn("Decompressed 3 event(s)", out.getvalue())
+        self.assertFalse(Event.objects.filter(compressed_messages__isnull=False).exists())
+        row = Event.objects.filter(stripe_id="evt_001").values_list("validated_message", flat=True).get()
+        self.assertEquals(json.loads(row), message)
+
+    def create_prunable_events(self):
+        old = timezone.now() - datetime.timedelta(days=100)
+        processed = Event.objects.create(stripe_id="evt_001", kind="customer.updated", webhook_message={"id": "evt_001"}, processed=True, created_at=old)
+        EventProcessingException.objects.create(event=processed, data="", message="boom", traceback="", created_at=old)
+        invalid = Event.objects.create(stripe_id="evt_002", kind="customer.updated", webhook_message={}, valid=False, created_at=old)
+        Event.objects.create(stripe_id="evt_003", kind="customer.updated", webhook_message={}, valid=True, created_at=old)
+        Event.objects.create(stripe_id="evt_004", kind="customer.updated", webhook_message={}, processed=True)
+        transfer_event = Event.objects.create(stripe_id="evt_005", kind="transfer.created", webhook_message={}, processed=True, created_at=old)
+        Transfer.objects.create(stripe_id="tr_001", event=transfer_event, amount=decimal.Decimal("100"), status="pending", date=old)
+        EventProcessingException.objects.create(data="", message="unlinked", traceback="", created_at=old)
+        return processed, invalid
+
+    def archive_dir(self):
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        return path
+
+    def test_prune_events(self):
+        processed, invalid = self.create_prunable_events()
+        archive_dir = self.archive_dir()
+        out = six.StringIO()
+        management.call_command("prune_events", archive_dir=archive_dir, batch_size=1, stdout=out)
+        self.assertEqual(sorted(Event.objects.values_list("stripe_id", flat=True)), ["evt_003", "evt_004", "evt_005"])
+        self.assertFalse(EventProcessingException.objects.exists())
+        self.assertIn("Pruned 2 event(s) and 1 unlinked processing exception(s)", out.getvalue())
+        archive, = os.listdir(archive_dir)
+        with gzip.open(os.path.join(archive_dir, archive), "rb") as f:
+            records = [json.loads(line.decode("utf-8")) for line in f]
+        self.assertEqual([record["object"] for record in records], ["event", "event", "event_processing_exception"])
+        self.assertEqual(records[0]["stripe_id"], "evt_001")
+        self.assertEqual(records[0]["webhook_message"], {"id": "evt_001"})
+        self.assertEqual([exception["message"] for exception in records[0]["exceptions"]], ["boom"])
+        self.assertEqual(records[2]["message"], "unlinked")
+
+    def test_prune_events_dry_run(self):
+        self.create_prunable_events()
+        out = six.StringIO()
+        management.call_command("prune_events", dry_run=True, stdout=out)
+        self.assertEqual(Event.objects.count(), 5)
+        self.assertIn("Would prune 2 event(s) and 1 unlinked processing exception(s)", out.getvalue())
+        self.assertIn("customer.updated: 2", out.getvalue())
+        self.assertIn("Keeping 1 event(s) referenced by transfers", out.getvalue())
+
+    @override_settings(PINAX_STRIPE_PRUNE_TRANSFER_EVENTS=True)
+    def test_prune_events_referenced_by_transfers(self):
+        self.create_prunable_events()
+        management.call_command("prune_events", no_archive=True, stdout=six.StringIO())
+        self.assertFalse(Event.objects.filter(stripe_id="evt_005").exists())
+        self.assertIsNone(Transfer.objects.get(stripe_id="tr_001").event)
+
+    def test_prune_events_requires_archive(self):
+        with self.assertRaises(CommandError):
+            management.call_command("prune_events", stdout=six.StringIO())
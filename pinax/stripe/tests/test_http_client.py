@@ -0,0 +1,152 @@
+import threading
+
+from django.test import TestCase
+
+import stripe
+from mock import Mock, patch
+
+from ..http_client import (
+    HTTPClient,
+    PooledRequestsClient,
+    cache_requests,
+    count_requests,
+    install
+)
+from .stripe_server import StripeServer
+
+
+class HTTPClientTests(TestCase):
+
+    def setUp(self):
+        self.inner = Mock()
+        self.inner.name = "mock"
+        self.inner.request.return_value = ("{}", 200, {})
+        self.client = HTTPClient(self.inner)
+
+    def test_installed(self):
+        self.assertIsInstance(stripe.default_http_client, HTTPClient)
+        self.assertIsInstance(stripe.default_http_client.client, PooledRequestsClient)
+        self.assertIs(install(), stripe.default_http_client)
+
+    def test_install(self):
+        with patch("stripe.default_http_client", None):
+            client = install(pool_size=2, connect_timeout=1, read_timeout=2, max_retries=3)
+            self.assertIsInstance(client.client, PooledRequestsClient)
+            self.assertEquals(client.client._timeout, (1, 2))
+            adapter = client.client._session.session.get_adapter("https://api.stripe.com")
+            self.assertEquals(adapter._pool_maxsize, 2)
+            self.assertEquals(adapter.max_retries.total, 3)
+
+    def test_install_wraps_configured_client(self):
+        with patch("stripe.default_http_client", self.inner):
+            client = install()
+            self.assertIsInstance(client, HTTPClient)
+            self.assertIs(client.client, self.inner)
+
+    def test_request(self):
+        response = self.client.request("get", "https://api.stripe.com/v1/charges", {})
+        self.assertEquals(response, ("{}", 200, {}))
+        self.inner.request.assert_called_once_with("get", "https://api.stripe.com/v1/charges", {}, None)
+        self.assertEquals(self.client.name, "mock")
+
+    def test_count_requests(self):
+        self.client.request("get", "https://api.stripe.com/v1/charges", {})
+        with count_requests() as outer:
+            self.client.request("get", "https://api.stripe.com/v1/charges", {})
+            with count_requests() as inner:
+                self.client.request("post", "https://api.stripe.com/v1/charges", {}, "amount=100")
+            self.client.request("get", "https://api.stripe.com/v1/charges", {})
+        self.client.request("get", "https://api.stripe.com/v1/charges", {})
+        self.assertEquals(outer.count, 3)
+        self.assertEquals(inner.count, 1)
+
+    def test_close(self):
+        self.client.close()
+        self.assertTrue(self.inner.close.called)
+
+    def test_cache_requests(self):
+        url = "https://api.stripe.com/v1/charges/ch_XXX?expand%5B%5D=balance_transaction"
+        headers = {"Authorization": "Bearer sk_test_XXX"}
+        with cache_requests():
+            self.client.request("get", url, headers)
+            with cache_requests():
+                self.client.request("get", url, headers)
+            self.assertEquals(self.client.request("get", url, headers), ("{}", 200, {}))
+            self.client.request("get", url, dict(headers, **{"Stripe-Account": "acct_XXX"}))
+            self.client.request("get", "https://api.stripe.com/v1/charges/ch_XXX", headers)
+        self.assertEquals(self.inner.request.call_count, 3)
+        self.client.request("get", url, headers)
+        self.assertEquals(self.inner.request.call_count, 4)
+
+    def test_cache_requests_cleared_by_writes(self):
+        url = "https://api.stripe.com/v1/customers/cus_XXX"
+        with cache_requests():
+            self.client.request("get", url, {})
+            self.client.request("post", url, {}, "description=test")
+            self.client.request("get", url, {})
+        self.assertEquals(self.inner.request.call_count, 3)
+
+    def test_cache_requests_errors_not_cached(self):
+        self.inner.request.return_value = ("{}", 404, {})
+        url = "https://api.stripe.com/v1/customers/cus_XXX"
+        with cache_requests(), count_requests() as counter:
+            self.client.request("get", url, {})
+            self.client.request("get", url, {})
+        self.assertEquals(counter.count, 2)
+
+    def test_cached_requests_not_counted(self):
+        url = "https://api.stripe.com/v1/customers/cus_XXX"
+        with cache_requests(), count_requests() as counter:
+            self.client.request("get", url, {})
+            self.client.request("get", url, {})
+        self.assertEquals(counter.count, 1)
+
+
+class PooledRequestsClientTests(TestCase):
+
+    def setUp(self):
+        self.client = PooledRequestsClient(connect_timeout=1, read_timeout=1)
+
+    def tearDown(self):
+        self.client.close()
+
+    def test_connections_reused(self):
+        with StripeServer() as server:
+            server.add("/v1/charges/ch_XXX", {"id": "ch_XXX", "object": "charge"})
+            for _ in range(3):
+                content, status, _ = self.client.request("get", server.url + "/v1/charges/ch_XXX", {})
+                self.assertEquals(status, 200)
+            self.assertEquals(len(server.requests), 3)
+            self.assertEquals(len(server.connections), 1)
+
+    def test_session_per_thread(self):
+        with StripeServer() as server:
+            server.add("/v1/charges/ch_XXX", {"id": "ch_XXX", "object": "charge"})
+
+            def request():
+                self.client.request("get", server.url + "/v1/charges/ch_XXX", {})
+                self.client.request("get", server.url + "/v1/charges/ch_XXX", {})
+                self.client.close()
+            threads = [threading.Thread(target=request) for _ in range(2)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertEquals(len(server.requests), 4)
+            self.assertEquals(len(server.connections), 2)
+
+    def test_read_timeout(self):
+        with StripeServer() as server:
+            server.delay = 1.5
+            with self.assertRaises(stripe.error.APIConnectionError):
+                self.client.request("get", server.url + "/v1/charges/ch_XXX", {})
+
+    def test_stripe_api(self):
+        with StripeServer() as server:
+            server.add("/v1/charges/ch_XXX", {"id": "ch_XXX", "object": "charge", "amount": 100})
+            with patch("stripe.api_base", server.url), patch("stripe.default_http_client", HTTPClient(self.client)):
+                charge = stripe.Charge.retrieve("ch_XXX")
+                self.assertEquals(charge.amount, 100)
+                with self.assertRaises(stripe.error.InvalidRequestError):
+                    stripe.Charge.retrieve("ch_YYY")
+            self.assertEquals(len(server.connections), 1)
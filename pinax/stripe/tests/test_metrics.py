@@ -0,0 +1,46 @@
+from django.contrib.auth import get_user_model
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import override_settings
+
+import stripe
+from mock import ANY, Mock, patch
+
+from ..actions import charges
+from ..metrics import get_action, get_resource, time_queries
+
+
+class MetricsTests(TestCase):
+
+    def test_get_resource(self):
+        self.assertEquals(get_resource("https://api.stripe.com/v1/charges"), "charges")
+        self.assertEquals(get_resource("https://api.stripe.com/v1/charges/ch_XXX?expand[]=balance_transaction"), "charges")
+        self.assertEquals(get_resource("https://api.stripe.com/v1/customers/cus_XXX/sources/card_XXX"), "customers/sources")
+        self.assertEquals(get_resource("https://api.stripe.com/v1/charges/ch_XXX/capture"), "charges/capture")
+
+    def test_get_action(self):
+        self.assertEquals(get_action(), "tests.test_metrics.test_get_action")
+
+    def test_api_call(self):
+        inner = Mock()
+        inner.name = "mock"
+        inner.request.return_value = ('{"id": "ch_XXX", "object": "charge"}', 200, {})
+        backend = Mock()
+        with patch.object(stripe.default_http_client, "client", inner), override_settings(PINAX_STRIPE_METRICS_BACKEND=backend):
+            charges.retrieve("ch_XXX")
+        backend.api_call.assert_called_once_with(
+            resource="charges",
+            method="get",
+            duration=ANY,
+            status=200,
+            retries=0,
+            action="charges.retrieve"
+        )
+
+    def test_time_queries(self):
+        with time_queries() as timer:
+            get_user_model().objects.count()
+        if hasattr(connection, "execute_wrapper"):
+            self.assertGreater(timer.duration, 0)
+        else:
+            self.assertIsNone(timer)
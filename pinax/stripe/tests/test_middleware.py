@@ -1,9 +1,15 @@
+import datetime
+
 from django.contrib.auth import authenticate, get_user_model, login, logout
+from django.core.cache import cache
+from django.db import connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
 from django.utils import timezone
 
-from mock import Mock
+from mock import Mock, patch
 
+from ..actions import customers, subscriptions
 from ..conf import settings
 from ..middleware import ActiveSubscriptionMiddleware
 from ..models import Customer, Plan, Subscription
@@ -27,7 +33,7 @@ class ActiveSubscriptionMiddlewareTests(TestCase):
     urls = "pinax.stripe.tests.urls"
 
     def setUp(self):
-        self.middleware = ActiveSubscriptionMiddleware()
+        cache.clear()
         self.request = Mock()
         self.request.META = {}
         self.request.session = DummySession()
@@ -37,6 +43,8 @@ class ActiveSubscriptionMiddlewareTests(TestCase):
             "signup",
             "password_reset"
         )
+        # the exception URLs are read when the middleware is loaded
+        self.middleware = ActiveSubscriptionMiddleware()
 
         user = get_user_model().objects.create_user(username="patrick")
         user.set_password("eldarion")
@@ -117,3 +125,66 @@ class ActiveSubscriptionMiddlewareTests(TestCase):
         self.request.path = "/the/app/"
         response = self.middleware.process_request(self.request)
         self.assertIsNone(response)
+
+    def create_subscription(self, **kwargs):
+        customer = Customer.objects.create(
+            stripe_id="cus_1",
+            user=self.request.user
+        )
+        plan = Plan.objects.create(
+            amount=10,
+            currency="usd",
+            interval="monthly",
+            interval_count=1,
+            name="Pro"
+        )
+        return Subscription.objects.create(
+            customer=customer,
+            plan=plan,
+            quantity=1,
+            start=timezone.now(),
+            status="active",
+            cancel_at_period_end=False,
+            **kwargs
+        )
+
+    def test_active_subscription_is_cached(self):
+        self.create_subscription()
+        self.request.path = "/the/app/"
+        self.assertIsNone(self.middleware.process_request(self.request))
+        with CaptureQueriesContext(connection) as queries, patch("pinax.stripe.middleware.resolve") as ResolveMock:
+            self.assertIsNone(self.middleware.process_request(self.request))
+        self.assertEqual(len(queries), 0)
+        self.assertFalse(ResolveMock.called)
+
+    def test_no_subscription_is_cached_until_synced(self):
+        self.request.path = "/the/app/"
+        self.assertEqual(self.middleware.process_request(self.request).status_code, 302)
+        subscription = self.create_subscription()
+        self.assertEqual(self.middleware.process_request(self.request).status_code, 302)
+        subscriptions.invalidate_active_subscription(subscription.customer)
+        self.assertIsNone(self.middleware.process_request(self.request))
+
+    def test_cache_expires_with_the_subscription(self):
+        self.create_subscription(ended_at=timezone.now() + datetime.timedelta(seconds=60))
+        with patch("pinax.stripe.actions.subscriptions.caches") as CachesMock:
+            CachesMock.__getitem__.return_value.get.return_value = None
+            self.assertTrue(subscriptions.user_has_active_subscription(self.request.user))
+        _, kwargs = CachesMock.__getitem__.return_value.set.call_args
+        self.assertTrue(50 < kwargs["timeout"] <= 60)
+
+    def test_cache_disabled(self):
+        self.create_subscription()
+        self.request.path = "/the/app/"
+        with self.settings(PINAX_STRIPE_SUBSCRIPTION_CACHE_TIMEOUT=0):
+            self.middleware.process_request(self.request)
+            with CaptureQueriesContext(connection) as queries:
+                self.assertIsNone(self.middleware.process_request(self.request))
+        self.assertEqual(len(queries), 1)
+
+    def test_purge_forgets_active_subscription(self):
+        subscription = self.create_subscription()
+        self.request.path = "/the/app/"
+        self.assertIsNone(self.middleware.process_request(self.request))
+        customers.purge_local(subscription.customer)
+        self.assertEqual(self.middleware.process_request(self.request).status_code, 302)
@@ -7,8 +7,9 @@ import sys
 
 from django.contrib.auth import get_user_model
 from django.core.exceptions import ValidationError
-from django.db import models
+from django.db import connection, models
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext, override_settings
 from django.utils import timezone
 
 from mock import call, patch
@@ -278,6 +279,65 @@ class ModelTests(TestCase):
                     self.assertTrue(f.blank, msg="%s.%s should be blank=True" % (klass.__name__, f.name))
 
 
+@override_settings(PINAX_STRIPE_EVENT_COMPRESSION=True)
+class EventCompressionTests(TestCase):
+
+    message = {"id": "evt_001", "data": {"object": {"id": "cus_1", "object": "customer"}}}
+
+    def test_compressed(self):
+        Event.objects.create(stripe_id="evt_001", kind="customer.updated", webhook_message=self.message, validated_message=self.message)
+        row = Event.objects.filter(stripe_id="evt_001").values("webhook_message", "validated_message", "compressed_messages").get()
+        self.assertEquals(row["webhook_message"], "null")
+        self.assertIsNone(row["validated_message"])
+        self.assertIsNotNone(row["compressed_messages"])
+        event = Event.objects.get(stripe_id="evt_001")
+        self.assertEquals(event.webhook_message, self.message)
+        self.assertEquals(event.validated_message, self.message)
+
+    def test_validated_message_differs(self):
+        Event.objects.create(stripe_id="evt_001", kind="customer.updated", webhook_message=self.message)
+        event = Event.objects.get(stripe_id="evt_001")
+        self.assertIsNone(event.validated_message)
+        validated = dict(self.message, livemode=False)
+        event.validated_message = validated
+        event.valid = True
+        event.save(update_fields=["validated_message", "valid"])
+        event = Event.objects.get(stripe_id="evt_001")
+        self.assertEquals(event.validated_message, validated)
+        self.assertEquals(event.webhook_message, self.message)
+
+    def test_set_before_decompressing(self):
+        Event.objects.create(stripe_id="evt_001", kind="customer.updated", webhook_message=self.message)
+        event = Event.objects.get(stripe_id="evt_001")
+        event.validated_message = {"id": "evt_001"}
+        self.assertEquals(event.webhook_message, self.message)
+        self.assertEquals(event.validated_message, {"id": "evt_001"})
+
+    def test_decompressed_once_disabled(self):
+        Event.objects.create(stripe_id="evt_001", kind="customer.updated", webhook_message=self.message)
+        event = Event.objects.get(stripe_id="evt_001")
+        with override_settings(PINAX_STRIPE_EVENT_COMPRESSION=False):
+            event.save()
+        row = Event.objects.filter(stripe_id="evt_001").values("webhook_message", "compressed_messages").get()
+        self.assertIsNone(row["compressed_messages"])
+        self.assertEquals(Event.objects.get(stripe_id="evt_001").webhook_message, self.message)
+
+    @override_settings(PINAX_STRIPE_EVENT_COMPRESSION=False)
+    def test_uncompressed_update_fields(self):
+        Event.objects.create(stripe_id="evt_001", kind="customer.updated", webhook_message=self.message)
+        event = Event.objects.get(stripe_id="evt_001")
+        event.validated_message = self.message
+        event.valid = True
+        with CaptureQueriesContext(connection) as queries:
+            event.save(update_fields=["validated_message", "valid"])
+        self.assertEquals(len(queries), 1)
+        sql = queries[0]["sql"]
+        self.assertIn("validated_message", sql)
+        self.assertNotIn("webhook_message", sql)
+        self.assertNotIn("compressed_messages", sql)
+        self.assertEquals(Event.objects.get(stripe_id="evt_001").validated_message, self.message)
+
+
 class StripeObjectTests(TestCase):
 
     @patch("stripe.Charge.retrieve")
@@ -0,0 +1,115 @@
+from django.core.cache import cache
+from django.test import TestCase
+from django.test.utils import override_settings
+
+from mock import Mock, patch
+
+from .. import ratelimit
+from ..http_client import HTTPClient
+
+LIVE = {"Authorization": "Bearer sk_live_XXX"}
+TEST = {"Authorization": "Bearer sk_test_XXX"}
+
+
+class Clock(object):
+
+    def __init__(self, now=1000.5):
+        self.now = now
+        self.sleeps = []
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+@override_settings(PINAX_STRIPE_RATE_LIMITS={"live": 4, "test": 2})
+class RateLimitTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.clock = Clock()
+        patcher = patch("pinax.stripe.ratelimit.time", self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_get_bucket(self):
+        self.assertEquals(ratelimit.get_bucket(LIVE), ("live", "platform"))
+        self.assertEquals(ratelimit.get_bucket(TEST), ("test", "platform"))
+        self.assertEquals(ratelimit.get_bucket(dict(LIVE, **{"Stripe-Account": "acct_XXX"})), ("live", "acct_XXX"))
+
+    def test_get_budget(self):
+        self.assertEquals(ratelimit.get_budget("live"), 4)
+        with ratelimit.priority(ratelimit.BATCH):
+            self.assertEquals(ratelimit.current_priority(), ratelimit.BATCH)
+            self.assertEquals(ratelimit.get_budget("live"), 2)
+            self.assertEquals(ratelimit.get_budget("test"), 1)
+        self.assertEquals(ratelimit.current_priority(), ratelimit.INTERACTIVE)
+
+    def test_acquire(self):
+        ratelimit.acquire(TEST)
+        ratelimit.acquire(TEST)
+        self.assertEquals(self.clock.sleeps, [])
+        ratelimit.acquire(TEST)
+        self.assertEquals(self.clock.sleeps, [0.5])
+
+    def test_acquire_separate_buckets(self):
+        ratelimit.acquire(TEST)
+        ratelimit.acquire(TEST)
+        ratelimit.acquire(LIVE)
+        ratelimit.acquire(dict(TEST, **{"Stripe-Account": "acct_XXX"}))
+        self.assertEquals(self.clock.sleeps, [])
+
+    def test_acquire_batch(self):
+        ratelimit.acquire(LIVE)
+        ratelimit.acquire(LIVE)
+        with ratelimit.priority(ratelimit.BATCH):
+            ratelimit.acquire(LIVE)
+            self.assertEquals(self.clock.sleeps, [0.5])
+        ratelimit.acquire(LIVE)
+        self.assertEquals(self.clock.sleeps, [0.5])
+
+    @override_settings(PINAX_STRIPE_RATE_LIMIT_BACKOFF=1, PINAX_STRIPE_RATE_LIMIT_MAX_BACKOFF=3)
+    def test_backoff(self):
+        self.assertEquals([ratelimit.backoff(TEST) for _ in range(3)], [1, 2, 3])
+        ratelimit.acquire(TEST)
+        self.assertEquals(self.clock.sleeps, [3])
+        ratelimit.acquire(LIVE)
+        self.assertEquals(self.clock.sleeps, [3])
+
+
+@override_settings(PINAX_STRIPE_RATE_LIMIT_ENABLED=True, PINAX_STRIPE_RATE_LIMIT_RETRIES=2)
+class RateLimitedClientTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.clock = Clock()
+        patcher = patch("pinax.stripe.ratelimit.time", self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.inner = Mock()
+        self.client = HTTPClient(self.inner)
+
+    def test_retry_after_429(self):
+        self.inner.request.side_effect = [("{}", 429, {}), ("{}", 200, {})]
+        response = self.client.request("post", "https://api.stripe.com/v1/charges", TEST, "amount=100")
+        self.assertEquals(response, ("{}", 200, {}))
+        self.assertEquals(self.inner.request.call_count, 2)
+        self.assertEquals(self.clock.sleeps, [1])
+
+    def test_retries_exhausted(self):
+        self.inner.request.return_value = ("{}", 429, {})
+        response = self.client.request("get", "https://api.stripe.com/v1/charges", TEST)
+        self.assertEquals(response, ("{}", 429, {}))
+        self.assertEquals(self.inner.request.call_count, 3)
+        self.assertEquals(self.clock.sleeps, [1, 2])
+
+    @override_settings(PINAX_STRIPE_RATE_LIMIT_ENABLED=False)
+    def test_disabled(self):
+        self.inner.request.return_value = ("{}", 429, {})
+        response = self.client.request("get", "https://api.stripe.com/v1/charges", TEST)
+        self.assertEquals(response, ("{}", 429, {}))
+        self.assertEquals(self.inner.request.call_count, 1)
+        self.assertIsNone(cache.get("pinax-stripe-ratelimit:test:platform:level"))
@@ -1,13 +1,21 @@
 import datetime
 import decimal
 
+from django.db import connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
 from django.utils import timezone
 
+from ..models import Charge, Customer, Plan
 from ..utils import (
     convert_amount_for_api,
     convert_amount_for_db,
-    convert_tstamp
+    convert_tstamp,
+    reset_write_stats,
+    save_changes,
+    snapshot,
+    update_with_defaults,
+    write_stats
 )
 
 
@@ -76,3 +84,61 @@ class ConvertAmountForApiTests(TestCase):
         expected = 999
         actual = convert_amount_for_api(decimal.Decimal("9.99"), currency=None)
         self.assertEquals(expected, actual)
+
+
+class SaveChangesTests(TestCase):
+
+    def setUp(self):
+        reset_write_stats()
+        self.plan = Plan.objects.create(
+            stripe_id="pro",
+            amount=decimal.Decimal("19.99"),
+            currency="usd",
+            interval="month",
+            interval_count=1,
+            name="Pro",
+            metadata={"tier": "pro"}
+        )
+
+    def test_unchanged_is_not_written(self):
+        original = snapshot(self.plan)
+        self.plan.name = "Pro"
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEquals(save_changes(self.plan, original), [])
+        self.assertEquals(len(queries), 0)
+        self.assertEquals(write_stats(), {"saved": 0, "skipped": 1})
+
+    def test_only_changed_fields_are_written(self):
+        original = snapshot(self.plan)
+        self.plan.name = "Pro Plan"
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEquals(save_changes(self.plan, original), ["name"])
+        self.assertEquals(len(queries), 1)
+        self.assertNotIn("amount", queries[0]["sql"])
+        self.assertEquals(Plan.objects.get().name, "Pro Plan")
+        self.assertEquals(write_stats(), {"saved": 1, "skipped": 0})
+
+    def test_mutated_json_is_a_change(self):
+        original = snapshot(self.plan)
+        self.plan.metadata["tier"] = "gold"
+        self.assertEquals(save_changes(self.plan, original), ["metadata"])
+        self.assertEquals(Plan.objects.get().metadata, {"tier": "gold"})
+
+    def test_foreign_keys_are_compared_by_id(self):
+        customer = Customer.objects.create(stripe_id="cus_1")
+        Charge.objects.create(stripe_id="ch_1", customer=customer)
+        charge = Charge.objects.get(stripe_id="ch_1")
+        with CaptureQueriesContext(connection) as queries:
+            update_with_defaults(charge, {"customer": customer}, False)
+        self.assertEquals(len(queries), 0)
+
+    def test_update_with_defaults_created(self):
+        with CaptureQueriesContext(connection) as queries:
+            update_with_defaults(self.plan, {"name": "Pro Plan"}, True)
+        self.assertEquals(len(queries), 0)
+        self.assertEquals(write_stats(), {"saved": 0, "skipped": 0})
+
+    def test_reset_write_stats(self):
+        update_with_defaults(self.plan, {"name": "Pro"}, False)
+        reset_write_stats()
+        self.assertEquals(write_stats(), {"saved": 0, "skipped": 0})
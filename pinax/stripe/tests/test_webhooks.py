@@ -1,14 +1,20 @@
+import datetime
 import decimal
+import hashlib
+import hmac
 import json
+import time
 
 from django.contrib.auth import get_user_model
 from django.dispatch import Signal
 from django.test import TestCase
 from django.test.client import Client
+from django.test.utils import override_settings
+from django.utils import timezone
 
 import six
 import stripe
-from mock import patch
+from mock import Mock, patch
 
 from . import (
     PLAN_CREATED_TEST_DATA,
@@ -17,6 +23,7 @@ from . import (
 )
 from ..models import (
     Account,
+    Charge,
     Customer,
     Event,
     EventProcessingException,
@@ -28,6 +35,7 @@ from ..webhooks import (
     AccountExternalAccountCreatedWebhook,
     AccountUpdatedWebhook,
     ChargeCapturedWebhook,
+    ChargeDisputeCreatedWebhook,
     CustomerDeletedWebhook,
     CustomerSourceCreatedWebhook,
     CustomerSourceDeletedWebhook,
@@ -35,7 +43,9 @@ from ..webhooks import (
     CustomerUpdatedWebhook,
     InvoiceCreatedWebhook,
     Webhook,
-    registry
+    registry,
+    retry_delay,
+    verify_signature
 )
 
 try:
@@ -44,6 +54,16 @@ except ImportError:
     from django.core.urlresolvers import reverse
 
 
+def sign(payload, secret="whsec_XXX", timestamp=None):
+    timestamp = int(time.time()) if timestamp is None else timestamp
+    signature = hmac.new(
+        secret.encode("utf-8"),
+        "{}.{}".format(timestamp, payload).encode("utf-8"),
+        hashlib.sha256
+    ).hexdigest()
+    return "t={},v1={}".format(timestamp, signature)
+
+
 class WebhookRegistryTest(TestCase):
 
     def test_get_signal(self):
@@ -54,6 +74,49 @@ class WebhookRegistryTest(TestCase):
         self.assertIsNone(registry.get_signal("not a webhook"))
 
 
+class VerifySignatureTest(TestCase):
+
+    payload = '{"id": "evt_XXX"}'
+
+    def test_verify_signature(self):
+        self.assertTrue(verify_signature(self.payload, sign(self.payload), secrets=["whsec_XXX"]))
+
+    def test_verify_signature_bytes_payload(self):
+        self.assertTrue(verify_signature(self.payload.encode("utf-8"), sign(self.payload), secrets="whsec_XXX"))
+
+    def test_verify_signature_rotated_secret(self):
+        header = sign(self.payload, secret="whsec_NEW")
+        self.assertTrue(verify_signature(self.payload, header, secrets=["whsec_OLD", "whsec_NEW"]))
+
+    def test_verify_signature_wrong_secret(self):
+        self.assertFalse(verify_signature(self.payload, sign(self.payload), secrets=["whsec_YYY"]))
+
+    def test_verify_signature_tampered_payload(self):
+        header = sign(self.payload)
+        self.assertFalse(verify_signature('{"id": "evt_YYY"}', header, secrets=["whsec_XXX"]))
+
+    def test_verify_signature_expired(self):
+        header = sign(self.payload, timestamp=int(time.time()) - 600)
+        self.assertFalse(verify_signature(self.payload, header, secrets=["whsec_XXX"], tolerance=300))
+
+    def test_verify_signature_missing_header(self):
+        self.assertFalse(verify_signature(self.payload, None, secrets=["whsec_XXX"]))
+        self.assertFalse(verify_signature(self.payload, "garbage", secrets=["whsec_XXX"]))
+
+    def test_verify_signature_no_secrets(self):
+        with self.settings(PINAX_STRIPE_WEBHOOK_SIGNING_SECRETS=[]):
+            self.assertFalse(verify_signature(self.payload, sign(self.payload)))
+
+    def test_check_signature_retrieve_strategy(self):
+        with self.settings(PINAX_STRIPE_WEBHOOK_SIGNING_SECRETS=["whsec_XXX"]):
+            self.assertFalse(AccountUpdatedWebhook.check_signature(self.payload, sign(self.payload)))
+
+    def test_check_signature_deauthorize_always_retrieves(self):
+        with self.settings(PINAX_STRIPE_WEBHOOK_VALIDATION="signature", PINAX_STRIPE_WEBHOOK_SIGNING_SECRETS=["whsec_XXX"]):
+            self.assertTrue(AccountUpdatedWebhook.check_signature(self.payload, sign(self.payload)))
+            self.assertFalse(AccountApplicationDeauthorizeWebhook.check_signature(self.payload, sign(self.payload)))
+
+
 class WebhookTests(TestCase):
 
     event_data = {
@@ -105,6 +168,46 @@ class WebhookTests(TestCase):
         "type": "transfer.created"
     }
 
+    def stripe_api(self):
+        client = Mock()
+        client.name = "mock"
+
+        def request(method, url, headers, post_data=None):
+            data = self.event_data if "/v1/events/" in url else self.event_data["data"]["object"]
+            return json.dumps(data), 200, {}
+        client.request.side_effect = request
+        return patch.object(stripe.default_http_client, "client", client)
+
+    def test_webhook_stats(self):
+        registry.reset_stats()
+        event = Event.objects.create(stripe_id="evt_001", kind="transfer.created", webhook_message=self.event_data)
+        with self.stripe_api():
+            registry.get(event.kind)(event).process()
+        self.assertEquals(registry.stats(), {"transfer.created": {"events": 1, "api_calls": 2}})
+        event = Event.objects.create(stripe_id="evt_002", kind="transfer.created", webhook_message=self.event_data)
+        with self.stripe_api(), self.settings(PINAX_STRIPE_WEBHOOK_PAYLOAD_FIRST=True):
+            registry.get(event.kind)(event).process()
+        self.assertEquals(registry.stats(), {"transfer.created": {"events": 2, "api_calls": 3}})
+        registry.reset_stats()
+        self.assertEquals(registry.stats(), {})
+
+    def test_webhook_metrics(self):
+        backend = Mock()
+        event = Event.objects.create(stripe_id="evt_001", kind="transfer.created", webhook_message=self.event_data)
+        with self.stripe_api(), self.settings(PINAX_STRIPE_METRICS_BACKEND=backend):
+            registry.get(event.kind)(event).process()
+        self.assertEquals(backend.api_call.call_count, 2)
+        self.assertEquals(
+            [kwargs["action"] for _, kwargs in backend.api_call.call_args_list],
+            ["webhooks.retrieve_event", "webhooks.process_webhook"]
+        )
+        _, kwargs = backend.webhook.call_args
+        self.assertEquals(kwargs["name"], "transfer.created")
+        self.assertEquals(kwargs["api_calls"], 2)
+        for key in ["duration", "validate_time", "db_time", "api_time"]:
+            self.assertGreaterEqual(kwargs[key], 0)
+        self.assertGreaterEqual(kwargs["duration"], kwargs["validate_time"])
+
     def test_webhook_init(self):
         event = Event(kind=None)
         webhook = Webhook(event)
@@ -124,6 +227,62 @@ class WebhookTests(TestCase):
         self.assertEquals(resp.status_code, 200)
         self.assertTrue(Event.objects.filter(kind="transfer.created").exists())
 
+    @patch("stripe.Event.retrieve")
+    @patch("stripe.Transfer.retrieve")
+    def test_webhook_enqueued(self, TransferMock, StripeEventMock):
+        msg = json.dumps(self.event_data)
+        with self.settings(PINAX_STRIPE_ENQUEUE_WEBHOOKS=True):
+            resp = Client().post(
+                reverse("pinax_stripe_webhook"),
+                six.u(msg),
+                content_type="application/json"
+            )
+        self.assertEquals(resp.status_code, 200)
+        event = Event.objects.get(kind="transfer.created")
+        self.assertFalse(event.processed)
+        self.assertIsNone(event.valid)
+        self.assertFalse(StripeEventMock.called)
+        self.assertFalse(TransferMock.called)
+
+    @patch("stripe.Event.retrieve")
+    @patch("stripe.Transfer.retrieve")
+    def test_webhook_signature_validation(self, TransferMock, StripeEventMock):
+        TransferMock.return_value = self.event_data["data"]["object"]
+        msg = json.dumps(self.event_data)
+        with self.settings(PINAX_STRIPE_WEBHOOK_VALIDATION="signature", PINAX_STRIPE_WEBHOOK_SIGNING_SECRETS=["whsec_XXX"]):
+            resp = Client().post(
+                reverse("pinax_stripe_webhook"),
+                six.u(msg),
+                content_type="application/json",
+                HTTP_STRIPE_SIGNATURE=sign(msg)
+            )
+        self.assertEquals(resp.status_code, 200)
+        event = Event.objects.get(kind="transfer.created")
+        self.assertTrue(event.valid)
+        self.assertTrue(event.processed)
+        self.assertEquals(event.validated_message, self.event_data)
+        self.assertFalse(StripeEventMock.called)
+        self.assertTrue(TransferMock.called)
+
+    @patch("stripe.Event.retrieve")
+    @patch("stripe.Transfer.retrieve")
+    def test_webhook_signature_validation_bad_signature(self, TransferMock, StripeEventMock):
+        StripeEventMock.return_value.to_dict.return_value = self.event_data
+        TransferMock.return_value = self.event_data["data"]["object"]
+        msg = json.dumps(self.event_data)
+        with self.settings(PINAX_STRIPE_WEBHOOK_VALIDATION="signature", PINAX_STRIPE_WEBHOOK_SIGNING_SECRETS=["whsec_XXX"]):
+            resp = Client().post(
+                reverse("pinax_stripe_webhook"),
+                six.u(msg),
+                content_type="application/json",
+                HTTP_STRIPE_SIGNATURE=sign(msg, secret="whsec_YYY")
+            )
+        self.assertEquals(resp.status_code, 200)
+        event = Event.objects.get(kind="transfer.created")
+        self.assertTrue(event.valid)
+        self.assertTrue(event.processed)
+        self.assertTrue(StripeEventMock.called)
+
     @patch("stripe.Event.retrieve")
     @patch("stripe.Transfer.retrieve")
     def test_webhook_associated_with_stripe_account(self, TransferMock, StripeEventMock):
@@ -148,19 +307,63 @@ class WebhookTests(TestCase):
             [("ach_XXXXXXXXXXXX",), {"stripe_account": "acc_XXX"}],
         ])
 
-    def test_webhook_duplicate_event(self):
-        data = {"id": 123}
-        Event.objects.create(stripe_id=123, livemode=True)
-        msg = json.dumps(data)
+    @patch("stripe.Event.retrieve")
+    @patch("stripe.Transfer.retrieve")
+    def test_process_saves_event_once(self, TransferMock, StripeEventMock):
+        StripeEventMock.return_value.to_dict.return_value = self.event_data
+        TransferMock.return_value = self.event_data["data"]["object"]
+        event = Event.objects.create(stripe_id=self.event_data["id"], kind="transfer.created", webhook_message=self.event_data)
+        save = Event.save
+        with patch.object(Event, "save", autospec=True, side_effect=save) as SaveMock:
+            registry.get(event.kind)(event).process()
+        self.assertEquals(SaveMock.call_count, 1)
+        self.assertEquals(SaveMock.call_args[1]["update_fields"], Webhook.event_update_fields)
+        event.refresh_from_db()
+        self.assertTrue(event.valid)
+        self.assertTrue(event.processed)
+        self.assertEquals(event.validated_message, self.event_data)
+
+    @patch("stripe.Event.retrieve")
+    @patch("stripe.Transfer.retrieve")
+    def test_process_validated_event_is_not_retrieved(self, TransferMock, StripeEventMock):
+        TransferMock.return_value = self.event_data["data"]["object"]
+        event = Event.objects.create(
+            stripe_id=self.event_data["id"],
+            kind="transfer.created",
+            webhook_message=self.event_data,
+            validated_message=self.event_data
+        )
+        registry.get(event.kind)(event).process()
+        self.assertFalse(StripeEventMock.called)
+        event.refresh_from_db()
+        self.assertTrue(event.valid)
+        self.assertTrue(event.processed)
+
+    @patch("stripe.Event.retrieve")
+    def test_process_saves_invalid_event(self, StripeEventMock):
+        validated_data = json.loads(json.dumps(self.event_data))
+        validated_data["data"]["object"]["amount"] = 1
+        StripeEventMock.return_value.to_dict.return_value = validated_data
+        event = Event.objects.create(stripe_id=self.event_data["id"], kind="transfer.created", webhook_message=self.event_data)
+        registry.get(event.kind)(event).process()
+        event.refresh_from_db()
+        self.assertFalse(event.valid)
+        self.assertFalse(event.processed)
+        self.assertEquals(event.validated_message, validated_data)
+
+    @patch("stripe.Event.retrieve")
+    def test_webhook_duplicate_event(self, StripeEventMock):
+        Event.objects.create(stripe_id=self.event_data["id"], livemode=True, webhook_message={})
+        msg = json.dumps(self.event_data)
         resp = Client().post(
             reverse("pinax_stripe_webhook"),
             six.u(msg),
             content_type="application/json"
         )
         self.assertEquals(resp.status_code, 200)
-        dupe_event_exception = EventProcessingException.objects.get()
-        self.assertEqual(dupe_event_exception.message, "Duplicate event record")
-        self.assertEqual(str(dupe_event_exception.data), '{"id": 123}')
+        self.assertEquals(Event.objects.filter(stripe_id=self.event_data["id"]).count(), 1)
+        self.assertFalse(EventProcessingException.objects.exists())
+        self.assertFalse(StripeEventMock.called)
 
     def test_webhook_event_mismatch(self):
         event = Event(kind="account.updated")
@@ -197,6 +400,20 @@ class WebhookTests(TestCase):
             AccountExternalAccountCreatedWebhook(event).process()
         self.assertTrue(EventProcessingException.objects.filter(event=event).exists())
 
+    @patch("stripe.Event.retrieve")
+    @patch("pinax.stripe.webhooks.Webhook.process_webhook")
+    def test_process_exception_saves_event(self, ProcessWebhookMock, StripeEventMock):
+        message = {"data": {"object": {"id": "ba_XXX"}}}
+        StripeEventMock.return_value.to_dict.return_value = message
+        event = Event.objects.create(kind="account.external_account.created", webhook_message=message)
+        ProcessWebhookMock.side_effect = Exception("generic exception")
+        with self.assertRaises(Exception):
+            AccountExternalAccountCreatedWebhook(event).process()
+        event.refresh_from_db()
+        self.assertTrue(event.valid)
+        self.assertFalse(event.processed)
+        self.assertEquals(event.validated_message, message)
+
     @patch("pinax.stripe.actions.customers.link_customer")
     @patch("pinax.stripe.webhooks.Webhook.validate")
     @patch("pinax.stripe.webhooks.Webhook.process_webhook")
@@ -208,6 +425,48 @@ class WebhookTests(TestCase):
             AccountExternalAccountCreatedWebhook(event).process()
         self.assertTrue(EventProcessingException.objects.filter(event=event).exists())
 
+    @patch("pinax.stripe.actions.customers.link_customer")
+    @patch("pinax.stripe.webhooks.Webhook.validate")
+    @patch("pinax.stripe.webhooks.Webhook.process_webhook")
+    def test_process_exception_schedules_retry(self, ProcessWebhookMock, ValidateMock, LinkMock):
+        event = Event.objects.create(
+            kind="account.external_account.created", webhook_message={}, valid=True, processed=False,
+            claimed_by="worker", claimed_at=timezone.now()
+        )
+        ProcessWebhookMock.side_effect = Exception("boom")
+        with self.assertRaises(Exception):
+            AccountExternalAccountCreatedWebhook(event).process()
+        event.refresh_from_db()
+        self.assertEquals(event.attempts, 1)
+        self.assertEquals(event.last_error, "Exception: boom")
+        self.assertTrue(timezone.now() + datetime.timedelta(seconds=29) < event.next_attempt_at)
+        self.assertTrue(event.next_attempt_at < timezone.now() + datetime.timedelta(seconds=61))
+        self.assertIsNone(event.dead_lettered_at)
+        self.assertIsNone(event.claimed_at)
+
+    @override_settings(PINAX_STRIPE_EVENT_MAX_ATTEMPTS=3)
+    @patch("pinax.stripe.actions.customers.link_customer")
+    @patch("pinax.stripe.webhooks.Webhook.validate")
+    @patch("pinax.stripe.webhooks.Webhook.process_webhook")
+    def test_process_exception_dead_letter(self, ProcessWebhookMock, ValidateMock, LinkMock):
+        event = Event.objects.create(
+            kind="account.external_account.created", webhook_message={}, valid=True, processed=False,
+            attempts=2, next_attempt_at=timezone.now()
+        )
+        ProcessWebhookMock.side_effect = Exception("boom")
+        with self.assertRaises(Exception):
+            AccountExternalAccountCreatedWebhook(event).process()
+        event.refresh_from_db()
+        self.assertEquals(event.attempts, 3)
+        self.assertIsNone(event.next_attempt_at)
+        self.assertIsNotNone(event.dead_lettered_at)
+
+    @patch("pinax.stripe.webhooks.random.uniform", side_effect=lambda low, high: (low, high))
+    def test_retry_delay(self, UniformMock):
+        self.assertEquals(retry_delay(1), (30, 60))
+        self.assertEquals(retry_delay(3), (120, 240))
+        self.assertEquals(retry_delay(10), (1800, 3600))
+
     @patch("pinax.stripe.actions.customers.link_customer")
     @patch("pinax.stripe.webhooks.Webhook.validate")
     def test_process_return_none(self, ValidateMock, LinkMock):
@@ -241,6 +500,52 @@ class ChargeWebhookTest(TestCase):
         self.assertEquals(kwargs["expand"], ["balance_transaction"])
         self.assertEquals(kwargs["stripe_account"], "acc_A")
 
+    @patch("stripe.Charge.retrieve")
+    @patch("pinax.stripe.actions.charges.sync_charge_from_stripe_data")
+    def test_process_webhook_dispute(self, SyncMock, RetrieveMock):
+        event = Event.objects.create(kind=ChargeDisputeCreatedWebhook.name, webhook_message={}, valid=True, processed=False)
+        event.validated_message = dict(data=dict(object=dict(id="dp_XXX", object="dispute", charge="ch_XXX")))
+        ChargeDisputeCreatedWebhook(event).process_webhook()
+        self.assertTrue(SyncMock.called)
+        args, kwargs = RetrieveMock.call_args
+        self.assertEquals(args, ("ch_XXX",))
+        self.assertEquals(kwargs["expand"], ["balance_transaction"])
+
+    @patch("stripe.Charge.retrieve")
+    @patch("pinax.stripe.actions.charges.sync_charge_from_stripe_data")
+    def test_process_webhook_payload_first(self, SyncMock, RetrieveMock):
+        Charge.objects.create(stripe_id="ch_XXX", fee=decimal.Decimal("1.00"))
+        event = Event.objects.create(kind=ChargeCapturedWebhook.name, webhook_message={}, valid=True, processed=False)
+        data = dict(id="ch_XXX", object="charge", balance_transaction="txn_XXX")
+        event.validated_message = dict(data=dict(object=data))
+        with self.settings(PINAX_STRIPE_WEBHOOK_PAYLOAD_FIRST=True):
+            ChargeCapturedWebhook(event).process_webhook()
+        SyncMock.assert_called_once_with(data)
+        self.assertFalse(RetrieveMock.called)
+
+    @patch("stripe.Charge.retrieve")
+    @patch("pinax.stripe.actions.charges.sync_charge_from_stripe_data")
+    def test_process_webhook_payload_first_without_fee(self, SyncMock, RetrieveMock):
+        event = Event.objects.create(kind=ChargeCapturedWebhook.name, webhook_message={}, valid=True, processed=False)
+        event.validated_message = dict(data=dict(object=dict(id="ch_XXX", object="charge", balance_transaction="txn_XXX")))
+        with self.settings(PINAX_STRIPE_WEBHOOK_PAYLOAD_FIRST=True):
+            ChargeCapturedWebhook(event).process_webhook()
+        self.assertTrue(SyncMock.called)
+        args, kwargs = RetrieveMock.call_args
+        self.assertEquals(args, ("ch_XXX",))
+        self.assertEquals(kwargs["expand"], ["balance_transaction"])
+
+    @patch("stripe.Charge.retrieve")
+    @patch("pinax.stripe.actions.charges.sync_charge_from_stripe_data")
+    def test_process_webhook_payload_first_dispute(self, SyncMock, RetrieveMock):
+        event = Event.objects.create(kind=ChargeDisputeCreatedWebhook.name, webhook_message={}, valid=True, processed=False)
+        event.validated_message = dict(data=dict(object=dict(id="dp_XXX", object="dispute", charge="ch_XXX")))
+        with self.settings(PINAX_STRIPE_WEBHOOK_PAYLOAD_FIRST=True):
+            ChargeDisputeCreatedWebhook(event).process_webhook()
+        self.assertTrue(SyncMock.called)
+        args, _ = RetrieveMock.call_args
+        self.assertEquals(args, ("ch_XXX",))
+
 
 class CustomerDeletedWebhookTest(TestCase):
 
@@ -364,6 +669,20 @@ class CustomerSubscriptionCreatedWebhookTest(TestCase):
         self.assertTrue(SyncMock.called)
         self.assertTrue(SubSyncMock.called)
 
+    @patch("pinax.stripe.actions.subscriptions.sync_subscription_from_stripe_data")
+    @patch("pinax.stripe.actions.customers.sync_customer")
+    def test_process_webhook_payload_first(self, SyncMock, SubSyncMock):
+        event = Event.objects.create(
+            kind=CustomerSubscriptionCreatedWebhook.name,
+            customer=Customer.objects.create(),
+            validated_message={"data": {"object": {}}},
+            valid=True,
+            processed=False)
+        with self.settings(PINAX_STRIPE_WEBHOOK_PAYLOAD_FIRST=True):
+            CustomerSubscriptionCreatedWebhook(event).process_webhook()
+        self.assertFalse(SyncMock.called)
+        self.assertTrue(SubSyncMock.called)
+
     @patch("pinax.stripe.actions.subscriptions.sync_subscription_from_stripe_data")
     @patch("pinax.stripe.actions.customers.sync_customer")
     def test_process_webhook_no_customer(self, SyncMock, SubSyncMock):
@@ -412,6 +731,22 @@ class InvoiceCreatedWebhookTest(TestCase):
 
 class TestTransferWebhooks(TestCase):
 
+    @patch("stripe.Transfer.retrieve")
+    def test_transfer_created_payload_first(self, TransferMock):
+        event = Event.objects.create(
+            stripe_id=TRANSFER_CREATED_TEST_DATA["id"],
+            kind="transfer.created",
+            livemode=True,
+            webhook_message=TRANSFER_CREATED_TEST_DATA,
+            validated_message=TRANSFER_CREATED_TEST_DATA,
+            valid=True
+        )
+        with self.settings(PINAX_STRIPE_WEBHOOK_PAYLOAD_FIRST=True):
+            registry.get(event.kind)(event).process_webhook()
+        self.assertFalse(TransferMock.called)
+        transfer = Transfer.objects.get(stripe_id="tr_XXXXXXXXXXXX")
+        self.assertEquals(transfer.amount, decimal.Decimal("4.55"))
+
     @patch("stripe.Event.retrieve")
     @patch("stripe.Transfer.retrieve")
     def test_transfer_created(self, TransferMock, EventMock):
@@ -576,6 +911,22 @@ class AccountWebhookTest(TestCase):
         AccountUpdatedWebhook(event).process_webhook()
         self.assertTrue(SyncMock.called)
 
+    @patch("stripe.Account.retrieve")
+    @patch("pinax.stripe.actions.accounts.sync_account_from_stripe_data")
+    def test_process_webhook_payload_first(self, SyncMock, RetrieveMock):
+        event = Event.objects.create(
+            kind=AccountUpdatedWebhook.name,
+            webhook_message={},
+            valid=True,
+            processed=False
+        )
+        account = dict(id="acct_XXX", object="account")
+        event.validated_message = dict(data=dict(object=account))
+        with self.settings(PINAX_STRIPE_WEBHOOK_PAYLOAD_FIRST=True):
+            AccountUpdatedWebhook(event).process_webhook()
+        SyncMock.assert_called_once_with(account)
+        self.assertFalse(RetrieveMock.called)
+
     @patch("stripe.Event.retrieve")
     def test_process_deauthorize(self, RetrieveMock):
         data = {"data": {"object": {"id": "evt_001"}},
@@ -604,6 +955,11 @@ class AccountWebhookTest(TestCase):
             "The provided key 'sk_test_********************ABCD' does not have access to account 'acc_aa' (or that account does not exist). Application access may have been revoked.")
         with self.assertRaises(stripe.error.PermissionError):
             AccountApplicationDeauthorizeWebhook(event).process()
+        event.refresh_from_db()
+        self.assertEquals(event.attempts, 1)
+        self.assertIsNone(event.next_attempt_at)
+        self.assertIsNotNone(event.dead_lettered_at)
+        self.assertEquals(RetrieveMock.call_count, 1)
 
     @patch("stripe.Event.retrieve")
     def test_process_deauthorize_with_authorizes_account(self, RetrieveMock):
@@ -617,6 +973,11 @@ class AccountWebhookTest(TestCase):
         RetrieveMock.return_value.to_dict.return_value = data
         with self.assertRaises(ValueError):
             AccountApplicationDeauthorizeWebhook(event).process()
+        event.refresh_from_db()
+        self.assertEquals(event.attempts, 1)
+        self.assertIsNone(event.next_attempt_at)
+        self.assertIsNotNone(event.dead_lettered_at)
+        self.assertTrue(Account.objects.get(pk=self.account.pk).authorized)
 
     @patch("stripe.Event.retrieve")
     def test_process_deauthorize_with_delete_account(self, RetrieveMock):
@@ -1,7 +1,11 @@
 from __future__ import unicode_literals
 
+import calendar
+import copy
 import datetime
 import decimal
+import threading
+import time
 
 from django.conf import settings
 from django.utils import timezone
@@ -22,6 +26,18 @@ def convert_tstamp(response, field_name=None):
         )
 
 
+def convert_datetime_for_api(value):
+    """
+    The reverse of `convert_tstamp`
+
+    Returns:
+        the Unix timestamp of a datetime, for filters such as created[gte]
+    """
+    if timezone.is_aware(value):
+        return calendar.timegm(value.utctimetuple())
+    return int(time.mktime(value.timetuple()))
+
+
 # currencies those amount=1 means 100 cents
 # https://support.stripe.com/questions/which-zero-decimal-currencies-does-stripe-support
 ZERO_DECIMAL_CURRENCIES = [
@@ -44,12 +60,76 @@ def convert_amount_for_api(amount, currency="usd"):
 
 def update_with_defaults(obj, defaults, created):
     if not created:
+        original = snapshot(obj)
         for key in defaults:
             setattr(obj, key, defaults[key])
-        obj.save()
+        save_changes(obj, original)
     return obj
 
 
+_write_stats = {"saved": 0, "skipped": 0}
+_write_stats_lock = threading.Lock()
+
+
+def snapshot(obj):
+    """
+    Returns:
+        the current values of the fields of a model instance, to be given to
+        `save_changes` once the instance has been updated
+    """
+    values = {}
+    for field in obj._meta.concrete_fields:
+        value = getattr(obj, field.attname)
+        if isinstance(value, (dict, list)):
+            value = copy.deepcopy(value)
+        values[field.attname] = value
+    return values
+
+
+def save_changes(obj, original):
+    """
+    Save only the fields of a model instance that differ from a snapshot,
+    skipping the write altogether when none do
+
+    Args:
+        obj: a model instance
+        original: the values returned by `snapshot` before the instance was
+                  updated
+
+    Returns:
+        the names of the fields that were saved
+    """
+    if obj._state.adding:
+        obj.save()
+        return [field.name for field in obj._meta.concrete_fields]
+    changed = [
+        field.name
+        for field in obj._meta.concrete_fields
+        if getattr(obj, field.attname) != original[field.attname]
+    ]
+    with _write_stats_lock:
+        _write_stats["saved" if changed else "skipped"] += 1
+    if changed:
+        obj.save(update_fields=changed)
+    return changed
+
+
+def write_stats():
+    """
+    Returns:
+        a dict with the number of synced objects that were `saved` because
+        they changed, and `skipped` because they did not, since the process
+        started or `reset_write_stats` was called
+    """
+    with _write_stats_lock:
+        return dict(_write_stats)
+
+
+def reset_write_stats():
+    with _write_stats_lock:
+        _write_stats.update(saved=0, skipped=0)
+
+
 CURRENCY_SYMBOLS = {
     "aud": "\u0024",
     "cad": "\u0024",
@@ -16,11 +16,12 @@ from django.views.generic.edit import FormMixin
 
 import stripe
 
-from .actions import customers, events, exceptions, sources, subscriptions
+from .actions import customers, events, sources, subscriptions
 from .conf import settings
 from .forms import PaymentMethodForm, PlanForm
 from .mixins import CustomerMixin, LoginRequiredMixin, PaymentsContextMixin
-from .models import Card, Event, Invoice, Subscription
+from .models import Card, Invoice, Subscription
+from .webhooks import registry
 
 
 class InvoiceListView(LoginRequiredMixin, CustomerMixin, ListView):
@@ -198,15 +199,22 @@ class Webhook(View):
     def post(self, request, *args, **kwargs):
         body = smart_str(self.request.body)
         data = json.loads(body)
-        event = Event.objects.filter(stripe_id=data["id"]).first()
-        if event:
-            exceptions.log_exception(body, "Duplicate event record", event=event)
-        else:
-            events.add_event(
-                stripe_id=data["id"],
-                kind=data["type"],
-                livemode=data["livemode"],
-                api_version=data["api_version"],
-                message=data
-            )
+        events.add_event(
+            stripe_id=data["id"],
+            kind=data["type"],
+            livemode=data["livemode"],
+            api_version=data["api_version"],
+            message=data,
+            process=not settings.PINAX_STRIPE_ENQUEUE_WEBHOOKS,
+            validated=self.signature_verified(data["type"])
+        )
         return HttpResponse()
+
+    def signature_verified(self, kind):
+        WebhookClass = registry.get(kind)
+        if WebhookClass is None:
+            return False
+        return WebhookClass.check_signature(
+            self.request.body,
+            self.request.META.get("HTTP_STRIPE_SIGNATURE")
+        )
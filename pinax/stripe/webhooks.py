@@ -1,11 +1,20 @@
+import datetime
+import hashlib
+import hmac
 import json
+import logging
+import random
+import threading
+import time
 
 from django.dispatch import Signal
+from django.utils import timezone
+from django.utils.encoding import force_bytes
 
 import stripe
-from six import with_metaclass
+from six import string_types, with_metaclass
 
-from . import models
+from . import catalog, http_client, metrics, models
 from .actions import (
     accounts,
     charges,
@@ -20,11 +29,15 @@ from .actions import (
 from .conf import settings
 from .utils import obfuscate_secret_key
 
+logger = logging.getLogger(__name__)
+
 
 class WebhookRegistry(object):
 
     def __init__(self):
         self._registry = {}
+        self._stats = {}
+        self._stats_lock = threading.Lock()
 
     def register(self, webhook):
         self._registry[webhook.name] = {
@@ -53,6 +66,24 @@ class WebhookRegistry(object):
             for key in self.keys()
         }
 
+    def record(self, name, api_calls):
+        with self._stats_lock:
+            stats = self._stats.setdefault(name, {"events": 0, "api_calls": 0})
+            stats["events"] += 1
+            stats["api_calls"] += api_calls
+
+    def stats(self):
+        """
+        The number of events processed and of Stripe API requests they made,
+        per kind of event, since the process started
+        """
+        with self._stats_lock:
+            return {name: dict(stats) for name, stats in self._stats.items()}
+
+    def reset_stats(self):
+        with self._stats_lock:
+            self._stats.clear()
+
     def __getitem__(self, name):
         return self._registry[name]
 
@@ -61,6 +92,96 @@ registry = WebhookRegistry()
 del WebhookRegistry
 
 
+def parse_signature_header(header):
+    """
+    Args:
+        header: the value of a `Stripe-Signature` header
+
+    Returns:
+        a tuple of the timestamp (None if it is missing or not an integer)
+        and the list of `v1` signatures
+    """
+    timestamp = None
+    signatures = []
+    for item in header.split(","):
+        key, _, value = item.strip().partition("=")
+        if key == "t":
+            timestamp = value
+        elif key == "v1":
+            signatures.append(value)
+    try:
+        timestamp = int(timestamp)
+    except (TypeError, ValueError):
+        timestamp = None
+    return timestamp, signatures
+
+
+def is_timestamp_recent(timestamp, tolerance):
+    """
+    Returns:
+        True if the timestamp is at most `tolerance` seconds away from now,
+        or if there is no tolerance
+    """
+    return not tolerance or abs(time.time() - timestamp) <= tolerance
+
+
+def verify_signature(payload, header, secrets=None, tolerance=None):
+    """
+    Verify the `Stripe-Signature` header sent along with a webhook
+
+    Args:
+        payload: the raw body of the webhook request
+        header: the value of the `Stripe-Signature` header
+        secrets: optionally, the endpoint signing secret(s) to check against,
+                 defaults to `PINAX_STRIPE_WEBHOOK_SIGNING_SECRETS`
+        tolerance: optionally, the maximum age of the signature in seconds,
+                   defaults to `PINAX_STRIPE_WEBHOOK_SIGNATURE_TOLERANCE`
+
+    Returns:
+        True if a `v1` signature matches one of the secrets and its timestamp
+        is recent enough, otherwise False
+    """
+    if secrets is None:
+        secrets = settings.PINAX_STRIPE_WEBHOOK_SIGNING_SECRETS
+    if isinstance(secrets, string_types):
+        secrets = [secrets]
+    if tolerance is None:
+        tolerance = settings.PINAX_STRIPE_WEBHOOK_SIGNATURE_TOLERANCE
+    if not header or not secrets:
+        return False
+
+    timestamp, signatures = parse_signature_header(header)
+    if timestamp is None or not signatures or not is_timestamp_recent(timestamp, tolerance):
+        return False
+
+    signed_payload = force_bytes(timestamp) + b"." + force_bytes(payload)
+    for secret in secrets:
+        expected = hmac.new(force_bytes(secret), signed_payload, hashlib.sha256).hexdigest()
+        if any(hmac.compare_digest(force_bytes(expected), force_bytes(s)) for s in signatures):
+            return True
+    return False
+
+
+def retry_delay(attempts):
+    """
+    The delay before retrying an event that failed, doubling with each
+    attempt from PINAX_STRIPE_EVENT_RETRY_DELAY up to
+    PINAX_STRIPE_EVENT_RETRY_MAX_DELAY seconds, and spread randomly over its
+    upper half so that events failing together are not retried together
+
+    Args:
+        attempts: the number of failed attempts so far
+
+    Returns:
+        the delay in seconds
+    """
+    delay = min(
+        settings.PINAX_STRIPE_EVENT_RETRY_DELAY * 2 ** (attempts - 1),
+        settings.PINAX_STRIPE_EVENT_RETRY_MAX_DELAY
+    )
+    return random.uniform(delay / 2.0, delay)
+
+
 class Registerable(type):
     def __new__(cls, clsname, bases, attrs):
         newclass = super(Registerable, cls).__new__(cls, clsname, bases, attrs)
@@ -72,37 +193,86 @@ class Registerable(type):
 class Webhook(with_metaclass(Registerable, object)):
 
     name = None
+    # How incoming events are validated: "retrieve" fetches the event from
+    # the Stripe API, "signature" trusts payloads whose `Stripe-Signature`
+    # header was verified when they were received. Defaults to the
+    # PINAX_STRIPE_WEBHOOK_VALIDATION setting.
+    validation = None
+    # the Event fields changed while processing, written once at the end
+    event_update_fields = ["validated_message", "valid", "customer", "processed", "stripe_account"]
+    # the Event fields changed when processing fails
+    event_retry_fields = ["attempts", "next_attempt_at", "last_error", "dead_lettered_at", "claimed_by", "claimed_at"]
+    # the catalog model (Plan, Coupon, Product or Sku) whose cached object is
+    # dropped from `pinax.stripe.catalog` once the event is processed
+    catalog_model = None
+    # whether process_webhook only syncs the object of the event from Stripe,
+    # so that it may be skipped for an event followed by a newer one about
+    # the same object, see `pinax.stripe.actions.events.coalesce_events`
+    coalesce = False
+    # the exceptions raised while processing that no retry can fix, e.g. for
+    # a forged event; the event is moved to the dead letters right away
+    dead_letter_exceptions = ()
 
     def __init__(self, event):
         if event.kind != self.name:
             raise Exception("The Webhook handler ({}) received the wrong type of Event ({})".format(self.name, event.kind))
         self.event = event
         self.stripe_account = None
+        self.validate_time = 0
+        self.coalesced = False
+        self.hold_signal = False
+
+    @classmethod
+    def get_validation(cls):
+        return cls.validation or settings.PINAX_STRIPE_WEBHOOK_VALIDATION
+
+    @classmethod
+    def check_signature(cls, payload, header):
+        """
+        Check the signature of a received payload, if this webhook is
+        validated by signature.
+
+        Returns:
+            True if the payload can be trusted without fetching the event
+        """
+        if cls.get_validation() != "signature":
+            return False
+        verified = verify_signature(payload, header)
+        if not verified:
+            logger.warning("Invalid or missing Stripe-Signature for a %s event, falling back to retrieving it", cls.name)
+        return verified
 
     def validate(self):
         """
         Validate incoming events.
 
-        We fetch the event data to ensure it is legit.
-        For Connect accounts we must fetch the event using the `stripe_account`
-        parameter.
+        We fetch the event data to ensure it is legit, unless the message is
+        already known to be authentic (its signature was verified when it was
+        received, or it was listed from the Stripe API by `sync_since`) and
+        this webhook does not insist on fetching it. For Connect accounts we
+        must fetch the event using the `stripe_account` parameter.
+
+        The changes to the event are saved by `process`.
         """
         self.stripe_account = models.Account.objects.filter(
             stripe_id=self.event.webhook_message.get("account")).first()
         self.event.stripe_account = self.stripe_account
+        if self.validation == "retrieve" or self.event.validated_message is None:
+            self.event.validated_message = self.retrieve_event()
+        self.event.valid = self.is_event_valid(self.event.webhook_message["data"], self.event.validated_message["data"])
+
+    def retrieve_event(self):
         evt = stripe.Event.retrieve(
             self.event.stripe_id,
             stripe_account=getattr(self.stripe_account, "stripe_id", None)
         )
-        self.event.validated_message = json.loads(
+        return json.loads(
             json.dumps(
                 evt.to_dict(),
                 sort_keys=True,
                 cls=stripe.StripeObjectEncoder
             )
         )
-        self.event.valid = self.is_event_valid(self.event.webhook_message["data"], self.event.validated_message["data"])
-        self.event.save()
 
     @staticmethod
     def is_event_valid(webhook_message_data, validated_message_data):
@@ -117,36 +287,135 @@ class Webhook(with_metaclass(Registerable, object)):
         if signal:
             return signal.send(sender=self.__class__, event=self.event)
 
-    def process(self):
+    @property
+    def payload_first(self):
+        """
+        Whether process_webhook should sync from the event data rather than
+        fetch the objects again, see PINAX_STRIPE_WEBHOOK_PAYLOAD_FIRST
+        """
+        return settings.PINAX_STRIPE_WEBHOOK_PAYLOAD_FIRST
+
+    def save_event(self):
+        self.event.save(update_fields=self.event_update_fields)
+
+    def process(self, coalesced=False, hold_signal=False):
+        """
+        Validate and process the event
+
+        Args:
+            coalesced: True if a newer event about the same object was already
+                       processed, in which case the event is validated, linked
+                       to its customer, signaled and marked processed, but
+                       process_webhook is not called
+            hold_signal: True to stop before sending the signal, leaving the
+                         event unprocessed until `release_signal` is called
+        """
+        self.coalesced = coalesced
+        self.hold_signal = hold_signal
         if self.event.processed:
             return
-        self.validate()
+        started = time.time()
+        with http_client.cache_requests(), http_client.count_requests() as requests, metrics.time_queries() as queries:
+            try:
+                self.validate_and_process()
+            except Exception as e:
+                self.schedule_retry(e)
+                raise
+            finally:
+                registry.record(self.name, requests.count)
+                duration = time.time() - started
+                settings.PINAX_STRIPE_METRICS_BACKEND.webhook(
+                    name=self.name,
+                    duration=duration,
+                    validate_time=self.validate_time,
+                    db_time=queries.duration if queries is not None else max(0, duration - requests.duration),
+                    api_time=requests.duration,
+                    api_calls=requests.count
+                )
+
+    def schedule_retry(self, exception):
+        """
+        Schedule the event to be processed again by process_events after
+        `retry_delay`, or move it to the dead letters once it failed
+        PINAX_STRIPE_EVENT_MAX_ATTEMPTS times or when the exception is one of
+        `dead_letter_exceptions`. The claim of the event, if any, is released.
+        """
+        event = self.event
+        event.attempts += 1
+        event.last_error = "{}: {}".format(exception.__class__.__name__, exception)
+        event.claimed_by = ""
+        event.claimed_at = None
+        if event.attempts >= settings.PINAX_STRIPE_EVENT_MAX_ATTEMPTS or isinstance(exception, self.dead_letter_exceptions):
+            event.next_attempt_at = None
+            event.dead_lettered_at = timezone.now()
+            logger.error("Giving up on %s event %s after %d attempts: %s", self.name, event.stripe_id, event.attempts, event.last_error)
+        else:
+            event.next_attempt_at = timezone.now() + datetime.timedelta(seconds=retry_delay(event.attempts))
+        event.save(update_fields=self.event_retry_fields)
+
+    def validate_and_process(self):
+        started = time.time()
+        try:
+            self.validate()
+        finally:
+            self.validate_time = time.time() - started
         if not self.event.valid:
+            self.save_event()
             return
 
-        try:
-            customers.link_customer(self.event)
+        self.run_step(self.process_and_signal)
+
+    def process_and_signal(self):
+        customers.link_customer(self.event, save=False)
+        if not self.coalesced:
             self.process_webhook()
-            self.send_signal()
-            self.event.processed = True
-            self.event.save()
+        if self.catalog_model is not None:
+            catalog.invalidate(self.catalog_model, self.event.message["data"]["object"].get("id"))
+        if not self.hold_signal:
+            self.signal_processed()
+
+    def signal_processed(self):
+        self.send_signal()
+        self.event.processed = True
+
+    def release_signal(self):
+        """
+        Send the signal held back by `process(hold_signal=True)` and mark the
+        event processed, scheduling a retry if a receiver raises
+        """
+        self.hold_signal = False
+        if self.event.processed or not self.event.valid:
+            return
+        try:
+            self.run_step(self.signal_processed)
+        except Exception as e:
+            self.schedule_retry(e)
+            raise
+
+    def run_step(self, step):
+        try:
+            step()
         except Exception as e:
             data = None
             if isinstance(e, stripe.StripeError):
                 data = e.http_body
             exceptions.log_exception(data=data, exception=e, event=self.event)
             raise e
+        finally:
+            self.save_event()
 
     def process_webhook(self):
         return
 
 
 class AccountWebhook(Webhook):
+    coalesce = True
 
     def process_webhook(self):
-        accounts.sync_account_from_stripe_data(
-            stripe.Account.retrieve(self.event.message["data"]["object"]["id"])
-        )
+        account = self.event.message["data"]["object"]
+        if not self.payload_first or account.get("object") != "account":
+            account = stripe.Account.retrieve(account["id"])
+        accounts.sync_account_from_stripe_data(account)
 
 
 class AccountUpdatedWebhook(AccountWebhook):
@@ -157,6 +426,12 @@ class AccountUpdatedWebhook(AccountWebhook):
 class AccountApplicationDeauthorizeWebhook(Webhook):
     name = "account.application.deauthorized"
     description = "Occurs whenever a user deauthorizes an application. Sent to the related application only."
+    # the outcome of fetching the event is what tells us the account was
+    # really disconnected, so a signature is not enough here
+    validation = "retrieve"
+    # a hostile or unverifiable event stays so, retrying it would only call
+    # the Stripe API again
+    dead_letter_exceptions = (ValueError, stripe.error.PermissionError)
 
     def validate(self):
         """
@@ -245,13 +520,31 @@ class BitcoinReceiverTransactionCreatedWebhook(Webhook):
 
 
 class ChargeWebhook(Webhook):
+    coalesce = True
 
     def process_webhook(self):
+        data = self.event.message["data"]["object"]
+        if data.get("object") == "dispute":
+            # disputes carry the id of their charge
+            data = {"id": data["charge"]}
+        elif self.payload_first and data.get("object") == "charge" and not self.needs_balance_transaction(data):
+            charges.sync_charge_from_stripe_data(data)
+            return
         charges.sync_charge(
-            self.event.message["data"]["object"]["id"],
+            data["id"],
             stripe_account=self.event.stripe_account_stripe_id,
         )
 
+    @staticmethod
+    def needs_balance_transaction(data):
+        """
+        Event data only has the id of the balance transaction, so the charge
+        is only fetched when its fee is not known yet
+        """
+        if not data.get("balance_transaction") or not isinstance(data["balance_transaction"], string_types):
+            return False
+        return not models.Charge.objects.filter(stripe_id=data["id"], fee__isnull=False).exists()
+
 
 class ChargeCapturedWebhook(ChargeWebhook):
     name = "charge.captured"
@@ -303,17 +596,21 @@ class ChargeDisputeUpdatedWebhook(ChargeWebhook):
     description = "Occurs when the dispute is updated (usually with evidence)."
 
 
-class CouponCreatedWebhook(Webhook):
+class CouponWebhook(Webhook):
+    catalog_model = models.Coupon
+
+
+class CouponCreatedWebhook(CouponWebhook):
     name = "coupon.created"
     description = "Occurs whenever a coupon is created."
 
 
-class CouponDeletedWebhook(Webhook):
+class CouponDeletedWebhook(CouponWebhook):
     name = "coupon.deleted"
     description = "Occurs whenever a coupon is deleted."
 
 
-class CouponUpdatedWebhook(Webhook):
+class CouponUpdatedWebhook(CouponWebhook):
     name = "coupon.updated"
     description = "Occurs whenever a coupon is updated."
 
@@ -335,6 +632,7 @@ class CustomerDeletedWebhook(Webhook):
 class CustomerUpdatedWebhook(Webhook):
     name = "customer.updated"
     description = "Occurs whenever any property of a customer changes."
+    coalesce = True
 
     def process_webhook(self):
         if self.event.customer:
@@ -358,6 +656,7 @@ class CustomerDiscountUpdatedWebhook(Webhook):
 
 
 class CustomerSourceWebhook(Webhook):
+    coalesce = True
 
     def process_webhook(self):
         sources.sync_payment_source_from_stripe_data(
@@ -385,6 +684,7 @@ class CustomerSourceUpdatedWebhook(CustomerSourceWebhook):
 
 
 class CustomerSubscriptionWebhook(Webhook):
+    coalesce = True
 
     def process_webhook(self):
         if self.event.validated_message:
@@ -393,9 +693,11 @@ class CustomerSubscriptionWebhook(Webhook):
                 self.event.validated_message["data"]["object"],
             )
 
-        if self.event.customer:
+        if self.event.customer and not self.payload_first:
             customers.sync_customer(self.event.customer)
 
+        subscriptions.invalidate_active_subscription(self.event.customer)
+
 
 class CustomerSubscriptionCreatedWebhook(CustomerSubscriptionWebhook):
     name = "customer.subscription.created"
@@ -418,6 +720,7 @@ class CustomerSubscriptionUpdatedWebhook(CustomerSubscriptionWebhook):
 
 
 class InvoiceWebhook(Webhook):
+    coalesce = True
 
     def process_webhook(self):
         invoices.sync_invoice_from_stripe_data(
@@ -487,6 +790,8 @@ class PaymentCreatedWebhook(Webhook):
 
 
 class PlanWebhook(Webhook):
+    catalog_model = models.Plan
+    coalesce = True
 
     def process_webhook(self):
         plans.sync_plan(self.event.message["data"]["object"], self.event)
@@ -500,6 +805,7 @@ class PlanCreatedWebhook(PlanWebhook):
 class PlanDeletedWebhook(Webhook):
     name = "plan.deleted"
     description = "Occurs whenever a plan is deleted."
+    catalog_model = models.Plan
 
 
 class PlanUpdatedWebhook(PlanWebhook):
@@ -507,12 +813,16 @@ class PlanUpdatedWebhook(PlanWebhook):
     description = "Occurs whenever a plan is updated."
 
 
-class ProductCreatedWebhook(Webhook):
+class ProductWebhook(Webhook):
+    catalog_model = models.Product
+
+
+class ProductCreatedWebhook(ProductWebhook):
     name = "product.created"
     description = "Occurs whenever a product is created."
 
 
-class ProductUpdatedWebhook(Webhook):
+class ProductUpdatedWebhook(ProductWebhook):
     name = "product.updated"
     description = "Occurs whenever a product is updated."
 
@@ -545,13 +855,13 @@ class SKUUpdatedWebhook(Webhook):
 class TransferWebhook(Webhook):
 
     def process_webhook(self):
-        transfers.sync_transfer(
-            stripe.Transfer.retrieve(
-                self.event.message["data"]["object"]["id"],
+        transfer = self.event.message["data"]["object"]
+        if not self.payload_first:
+            transfer = stripe.Transfer.retrieve(
+                transfer["id"],
                 stripe_account=self.event.stripe_account_stripe_id,
-            ),
-            self.event
-        )
+            )
+        transfers.sync_transfer(transfer, self.event)
 
 
 class TransferCreatedWebhook(TransferWebhook):
@@ -609,31 +919,35 @@ class OrderReturnCreatedWebhook(Webhook):
     description = "Occurs whenever an order return created."
 
 
-class SkuCreatedWebhook(Webhook):
+class SkuWebhook(Webhook):
+    catalog_model = models.Sku
+
+
+class SkuCreatedWebhook(SkuWebhook):
     name = "sku.created"
     description = "Occurs whenever a SKU is created."
 
 
-class SkuDeletedWebhook(Webhook):
+class SkuDeletedWebhook(SkuWebhook):
     name = "sku.deleted"
     description = "Occurs whenever a SKU is deleted."
 
 
-class SkuUpdatedWebhook(Webhook):
+class SkuUpdatedWebhook(SkuWebhook):
     name = "sku.updated"
     description = "Occurs whenever a SKU is updated."
 
 
-class ProductCreatedWebhook(Webhook):
+class ProductCreatedWebhook(ProductWebhook):
     name = "product.created"
     description = "Occurs whenever a product is created."
 
 
-class ProductDeletedWebhook(Webhook):
+class ProductDeletedWebhook(ProductWebhook):
     name = "product.deleted"
     description = "Occurs whenever a product is deleted."
 
 
-class ProductUpdatedWebhook(Webhook):
+class ProductUpdatedWebhook(ProductWebhook):
     name = "product.updated"
     description = "Occurs whenever a product is updated."